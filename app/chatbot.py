@@ -1,10 +1,15 @@
 import os
 import pathlib
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-
-from backend.rag.ollama_rag import OllamaRAG
+from app.intent_router import IntentRouter
+from app.rasa_client import RasaClient
+from backend.rag.answer_cache import AnswerCache, context_key
+from backend.rag.embeddings import embedding_key
+from backend.rag.ollama_rag import OllamaRAG, ResponseMetadata
 
 
 class ChatBot:
@@ -17,6 +22,13 @@ class ChatBot:
         self.base_dir = pathlib.Path(os.path.abspath(os.path.dirname(__file__))).resolve().parents[0]
         self.model, self.dataset_path, self.embedding_db_path, = None, None, None
         self.embedding_db_path_alternative, self.alternative_dataset = None, None
+        self.answer_cache = None
+        self.rasa = RasaClient(os.environ.get("RASA_URL", "http://rasa:5005"))
+        self.speculative_rag = True
+        self.router = None
+        self.executor = ThreadPoolExecutor(max_workers=4)  # speculative retrieval of concurrent sessions
+        self.speculation = {"used": 0, "discarded": 0, "overlap_ms": 0.0, "discarded_ms": 0.0}
+        self._speculation_lock = threading.Lock()
 
     def _set_embedding(self, embedding_db: str, embedding_db_alternative: str):
         """
@@ -35,32 +47,218 @@ class ChatBot:
         self.alternative_dataset = os.path.join(self.base_dir, "data/")
 
     def setup(self, embedding_db: str, text_gen_model: str, embedding_model: str,
-              reranking_model: str, embedding_database_alternative: str):
+              reranking_model: str, embedding_database_alternative: str,
+              answer_cache: bool = True, answer_cache_threshold: float = 0.97, update_index: bool = False,
+              embedding_backend: str = None, reranking_backend: str = None, context_compression: bool = None,
+              speculative_rag: bool = True, intent_router: bool = False):
         """
         Main Method to set up the chatbot with the given parameters.
+        :param update_index: whether to incrementally update the vector databases with the current data
+        :param embedding_backend: "torch" or "onnx", defaults to the EMBEDDING_BACKEND environment variable or torch
+        :param reranking_backend: "torch" or "onnx", defaults to the RERANKING_BACKEND environment variable or torch
+        :param context_compression: whether to compress the context to the most relevant sentences before the
+               generation, defaults to the CONTEXT_COMPRESSION environment variable or off
+        :param speculative_rag: whether retrieval and reranking run while Rasa classifies the query,
+               the result is discarded if Rasa answers the query
+        :param intent_router: whether confident queries skip the Rasa NLU, see IntentRouter. Off until its
+               thresholds are evaluated against Rasa
+        :param answer_cache: whether to answer repeated questions from the semantic answer cache
+        :param answer_cache_threshold: minimum cosine similarity to a cached question
         """
+        self.speculative_rag = speculative_rag
         self._set_embedding(embedding_db, embedding_database_alternative)
         self._set_dataset()
         self.model = OllamaRAG(self.embedding_db_path, self.dataset_path, text_gen_model.lower(), embedding_model,
-                               reranking_model, self.alternative_dataset, self.embedding_db_path_alternative)
+                               reranking_model, self.alternative_dataset, self.embedding_db_path_alternative,
+                               update_index=update_index,
+                               score_cache_path=os.path.join(self.base_dir, "backend/rag/score_cache.sqlite3"),
+                               context_compression=context_compression if context_compression is not None else
+                               os.environ.get("CONTEXT_COMPRESSION", "false").lower() == "true",
+                               embedding_backend=embedding_backend or os.environ.get("EMBEDDING_BACKEND", "torch"),
+                               reranking_backend=reranking_backend or os.environ.get("RERANKING_BACKEND", "torch"))
+        nlu_path = os.path.join(self.base_dir, "backend/rasa/data/nlu.yml")
+        if intent_router and os.path.isfile(nlu_path):
+            self.router = IntentRouter(self.model.embedding_llm.embed_queries, nlu_path,
+                                       os.path.join(self.dataset_path, "question_answer_set"),
+                                       cache_path=os.path.join(self.base_dir, "app/intent_router_centroids.npz"),
+                                       model_key=embedding_key(self.model.embed_model_name,
+                                                               self.model.embedding_llm.client))
+        if answer_cache:
+            self.answer_cache = AnswerCache(os.path.join(self.base_dir, "backend/rag/answer_cache.sqlite3"),
+                                            self.model.index_version(), threshold=answer_cache_threshold)
+
+    def _lookup_answer(self, query: str, chat_history):
+        """
+        Looks up the query in the semantic answer cache, only answers given in the same conversation context match.
+        :param query: user question
+        :param chat_history: recent conversation
+        :return: tuple of (cached response or None, query embedding)
+        """
+        if self.answer_cache is None:
+            return None, None
+        query_embedding = self.model.embed_queries([query])[0]
+        return self.answer_cache.lookup(query_embedding, context_key(chat_history)), query_embedding
+
+    def _store_answer(self, query: str, chat_history, query_embedding, response: tuple):
+        """
+        Stores a generated RAG answer in the semantic answer cache. Out of scope answers are not cached, neither are
+        direct answers of the QA set, they are cheap and the cache would drop their source.
+        :param chat_history: recent conversation the answer depends on
+        :param response: tuple: (answer, relevant_docs, reranked_docs, confidence)
+        """
+        answer, relevant_docs, reranked_docs, confidence = response
+        if self.answer_cache is None or (relevant_docs and relevant_docs[0] == "none"):
+            return
+        self.answer_cache.store(query, query_embedding, answer, relevant_docs, reranked_docs, confidence,
+                                context_key(chat_history))
+
+    def _parse(self, query: str) -> dict:
+        """
+        Sends the query to the Rasa NLU, repeated questions are served from the parse cache of the client.
+        :param query: user question
+        :return: parse result of Rasa containing the intent and entities
+        """
+        return self.rasa.parse(query)
 
-    def run(self, query, chat_history):
+    def _is_rag_query(self, parse_result: dict) -> bool:
+        """
+        Decides whether the query should be answered with RAG instead of Rasa.
+        """
+        return parse_result["intent"]["name"] in ("out_of_scope", "nlu_fallback")
+
+    def _route(self, query: str, chat_history, query_embedding=None):
+        """
+        Classifies the query with the intent router and, in its ambiguous band, with Rasa.
+        With speculative RAG, the retrieval and reranking of the query run at the same time as the Rasa request
+        in the background, they are cancelled before the next stage if Rasa claims the intent.
+        :param query: user question
+        :param chat_history: simple list of past conversation
+        :param query_embedding: embedding of the query if it is already known
+        :return: tuple of (parse result, result of prepare_response or None)
+        """
+        if self.router is not None:
+            if query_embedding is None:
+                query_embedding = self.model.embed_queries([query])[0]
+            route = self.router.route(query_embedding)
+            if route.target is not None:
+                return self.router.parse_result(route), None
+        if not self.speculative_rag:
+            return self._parse(query), None
+        cancelled, timings = threading.Event(), {}
+        retrieval = self.executor.submit(self.model.prepare_response, query, chat_history, 5.0, -2.0, cancelled,
+                                         timings)
+        parse_start = time.perf_counter()
+        parse_result = self._parse(query)
+        parse_time = (parse_start, time.perf_counter())
+        if self._is_rag_query(parse_result):
+            prepared = retrieval.result()
+            self._record_speculation(True, parse_time, timings)
+            return parse_result, prepared
+        cancelled.set()
+        if not retrieval.cancel():  # the stage that is already running finishes in the background
+            retrieval.add_done_callback(lambda _: self._record_speculation(False, parse_time, timings))
+        else:
+            self._record_speculation(False, parse_time, timings)
+        return parse_result, None
+
+    def _record_speculation(self, used: bool, parse_time: tuple, timings: dict):
+        """
+        Reports how long every retrieval stage overlapped with the Rasa parse request.
+        :param used: whether the retrieval result was used for the answer
+        :param parse_time: (start, end) perf_counter times of the parse request
+        :param timings: (start, end) perf_counter times of the completed retrieval stages
+        """
+        parse_start, parse_end = parse_time
+        overlaps = {stage: max(0.0, min(end, parse_end) - max(start, parse_start))
+                    for stage, (start, end) in timings.items()}
+        overlap = sum(overlaps.values())
+        duration = sum(end - start for start, end in timings.values())
+        with self._speculation_lock:
+            if used:
+                self.speculation["used"] += 1
+                self.speculation["overlap_ms"] += 1000 * overlap
+            else:
+                self.speculation["discarded"] += 1
+                self.speculation["discarded_ms"] += 1000 * duration
+        stages = ", ".join(f"{stage} {1000 * overlaps[stage]:.0f}/{1000 * (end - start):.0f} ms"
+                           for stage, (start, end) in timings.items())
+        print(f"Speculative retrieval {'used' if used else 'discarded'}: Rasa parse "
+              f"{1000 * (parse_end - parse_start):.0f} ms, overlap {stages or 'none'}.")
+
+    def _rasa_response(self, parse_result: dict, conversation_id: str = None):
+        """
+        Triggers the classified intent in Rasa and returns its answer.
+        :param parse_result: parse result of Rasa
+        :param conversation_id: ID of the chat session, defaults to the ID of this chatbot
+        :return: tuple: (answer, relevant_docs, reranked_docs, confidence)
+        """
+        messages = self.rasa.trigger_intent(conversation_id or str(self.conversation_id),
+                                            parse_result["intent"]["name"], parse_result["entities"])
+        return (messages[0]["text"] if messages else "", [], [],
+                f"RASA confidence: {parse_result['intent']['confidence']}")
+
+    def run(self, query, chat_history, conversation_id: str = None):
         """
         Main method to run the chatbot with the given query.
         This method decides whether to use Rasa or RAG to answer the query.
         :param chat_history: recent conversation as string
         :param query: user question
+        :param conversation_id: ID of the chat session, every session has its own Rasa conversation
         :return: response from the chatbot as tuple: (answer, relevant_docs, reranked_docs, similarity_score)
         """
-        response = requests.post("http://rasa:5005/model/parse", json={"text": query, "message_id": query.strip()})
+        start = time.perf_counter()
+        cached, query_embedding = self._lookup_answer(query, chat_history)
+        if cached is not None:
+            self.answer_cache.record_latency(True, time.perf_counter() - start)
+            return cached
+
+        parse_result, prepared = self._route(query, chat_history, query_embedding)
+
+        if self._is_rag_query(parse_result):
+            prepared = prepared or self.model.prepare_response(query, chat_history, 5.0, -2.0)
+            response = self.model.get_response(query, chat_history, 5.0, -2.0, prepared)
+            if prepared[2].direct_answer is None:
+                self._store_answer(query, chat_history, query_embedding, response)
+        else:
+            response = self._rasa_response(parse_result, conversation_id)
+        if self.answer_cache is not None:
+            self.answer_cache.record_latency(False, time.perf_counter() - start)
+        return response
+
+    def stream(self, query, chat_history, conversation_id: str = None):
+        """
+        Streaming version of run.
+        Yields the answer as text chunks and a ResponseMetadata record as last element.
+        Answers of Rasa are complete at once and therefore yielded as a single chunk.
+        :param chat_history: recent conversation as string
+        :param query: user question
+        :param conversation_id: ID of the chat session, every session has its own Rasa conversation
+        :return: iterator over text chunks followed by the ResponseMetadata
+        """
+        start = time.perf_counter()
+        cached, query_embedding = self._lookup_answer(query, chat_history)
+        if cached is not None:
+            answer, relevant_docs, reranked_docs, confidence = cached
+            yield answer
+            yield ResponseMetadata(relevant_docs, reranked_docs, confidence)
+            self.answer_cache.record_latency(True, time.perf_counter() - start)
+            return
+
+        parse_result, prepared = self._route(query, chat_history, query_embedding)
 
-        if (response.json()["intent"]["name"] == "out_of_scope" or
-                response.json()["intent"]["name"] == "nlu_fallback"):
-            return self.model.get_response(query, chat_history, 5.0, -2.0)
+        if self._is_rag_query(parse_result):
+            answer = ""
+            for chunk in self.model.stream_response(query, chat_history, 5.0, -2.0, prepared):
+                if isinstance(chunk, ResponseMetadata):
+                    if chunk.direct_answer is None:
+                        self._store_answer(query, chat_history, query_embedding,
+                                           (answer, chunk.relevant_docs, chunk.reranked_docs, chunk.confidence))
+                else:
+                    answer += chunk
+                yield chunk
         else:
-            real_response = requests.post("http://rasa:5005/conversations/test_id/trigger_intent", json={
-                                              "name": response.json()["intent"]["name"],
-                                              "entities": response.json()["entities"]
-                                          })
-            return (real_response.json()['messages'][0]['text'], [], [],
-                    f"RASA confidence: {response.json()['intent']['confidence']}")
+            answer, relevant_docs, reranked_docs, confidence = self._rasa_response(parse_result, conversation_id)
+            yield answer
+            yield ResponseMetadata(relevant_docs, reranked_docs, confidence)
+        if self.answer_cache is not None:
+            self.answer_cache.record_latency(False, time.perf_counter() - start)
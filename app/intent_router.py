@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import yaml
+
+from scripts.qa_retriever import get_data
+
+"""
+Embedding pre-router in front of Rasa.
+Every intent of the Rasa NLU training data gets a centroid of its e5 query embeddings, the questions of the QA set and
+the out_of_scope examples form the centroid of RAG. A query that is clearly closest to the RAG centroid goes straight
+to RAG, a query that is clearly closest to an intent without entities triggers that intent directly. Only queries in
+the ambiguous band, and intents that need the entities of the Rasa NLU, are sent to /model/parse.
+The centroids are cached on disk together with a fingerprint of the embedding model and the examples, so they are
+only computed again when the training data or the model change.
+The default thresholds are starting values that are not validated on data yet. python -m scripts.benchmark router
+evaluates them and a grid around them against Rasa and records the bypass rate, the accuracy of the bypassed routes
+and the saved latency in app/intent_router_eval.md, the defaults should be taken from that table. Until then the
+router is off, ChatBot.setup(intent_router=True) enables it.
+"""
+
+RAG = "rag"
+RAG_INTENTS = ("out_of_scope", "nlu_fallback")
+ENTITY = re.compile(r"\[([^\]]+)\]\([^)]*\)|\[([^\]]+)\]\{[^}]*\}")
+
+
+def load_nlu_examples(nlu_path: str) -> tuple:
+    """
+    Reads the training examples of the Rasa NLU data, entity annotations are replaced by their text.
+    :param nlu_path: path to nlu.yml
+    :return: tuple of (dict of intent -> examples, set of intents with annotated entities)
+    """
+    with open(nlu_path, encoding="utf-8") as file:
+        data = yaml.safe_load(file)
+    examples, entity_intents = {}, set()
+    for item in data.get("nlu", []):
+        if "intent" not in item:
+            continue
+        for line in item.get("examples", "").splitlines():
+            example = line.strip()[2:].strip() if line.strip().startswith("- ") else ""
+            if not example:
+                continue
+            if ENTITY.search(example):
+                entity_intents.add(item["intent"])
+            examples.setdefault(item["intent"], []).append(ENTITY.sub(lambda m: m.group(1) or m.group(2), example))
+    return examples, entity_intents
+
+
+@dataclass
+class Route:
+    target: Optional[str]  # "rag", "rasa" or None for the ambiguous band
+    intent: str  # closest intent, "rag" for the centroid of RAG
+    similarity: float  # cosine similarity to the closest centroid
+    margin: float  # difference to the similarity of the second closest centroid
+
+
+class IntentRouter:
+    def __init__(self, embed_queries: Callable[[List[str]], List[List[float]]], nlu_path: str, qa_path: str,
+                 min_similarity: float = 0.85, min_margin: float = 0.03, cache_path: Optional[str] = None,
+                 model_key: str = ""):
+        """
+        :param embed_queries: function to embed texts with the query instruction, e.g. E5Embeddings.embed_queries
+        :param nlu_path: path to the nlu.yml of Rasa
+        :param qa_path: path to the question-answer set, its questions are examples of RAG
+        :param min_similarity: minimum similarity to the closest centroid for a confident route
+        :param min_margin: minimum margin to the second closest centroid for a confident route
+        :param cache_path: path to the .npz file of the cached centroids, they are always computed if None
+        :param model_key: name of the embedding model and backend, part of the fingerprint of the cache
+        """
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.examples, self.entity_intents = load_nlu_examples(nlu_path)
+        rag_examples = [question.strip() for question in get_data(qa_path)]
+        for intent in RAG_INTENTS:
+            rag_examples += self.examples.get(intent, [])
+
+        self.labels: List[str] = [RAG] + [intent for intent in self.examples if intent not in RAG_INTENTS]
+        groups: Dict[str, List[str]] = {RAG: rag_examples}
+        groups.update({intent: self.examples[intent] for intent in self.labels[1:]})
+        fingerprint = hashlib.sha256(json.dumps([model_key, self.labels, groups], ensure_ascii=False)
+                                     .encode("utf-8")).hexdigest()
+        self.centroids = self._load_centroids(cache_path, fingerprint)
+        if self.centroids is None:
+            centroids = []
+            for label in self.labels:
+                embeddings = np.array(embed_queries(groups[label]), dtype=np.float32)
+                centroid = embeddings.mean(axis=0)
+                centroids.append(centroid / np.linalg.norm(centroid))
+            self.centroids = np.stack(centroids)
+            if cache_path:
+                np.savez(f"{cache_path}.tmp.npz", centroids=self.centroids, fingerprint=fingerprint)
+                os.replace(f"{cache_path}.tmp.npz", cache_path)
+        self.counts = {"rag": 0, "rasa": 0, "ambiguous": 0}
+        self._lock = threading.Lock()
+        print(f"Intent router: {len(self.labels) - 1} intents and {len(rag_examples)} RAG examples.")
+
+    @staticmethod
+    def _load_centroids(cache_path: Optional[str], fingerprint: str) -> Optional[np.ndarray]:
+        """
+        :return: the cached centroids, None if there are none for the current model and examples
+        """
+        if not cache_path or not os.path.isfile(cache_path):
+            return None
+        try:
+            with np.load(cache_path) as cached:
+                if str(cached["fingerprint"]) == fingerprint:
+                    return cached["centroids"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Cached router centroids could not be read ({e}), computing them again.")
+        return None
+
+    def classify(self, query_embedding: List[float]) -> Route:
+        """
+        Classifies a query without counting it, e.g. for the evaluation.
+        :param query_embedding: normalized query embedding
+        """
+        similarities = self.centroids @ np.asarray(query_embedding, dtype=np.float32)
+        second, first = np.argsort(similarities)[-2:]
+        label, similarity = self.labels[first], float(similarities[first])
+        margin = similarity - float(similarities[second])
+        target = None
+        if similarity >= self.min_similarity and margin >= self.min_margin:
+            if label == RAG:
+                target = RAG
+            elif label not in self.entity_intents:  # the entities can only be extracted by the Rasa NLU
+                target = "rasa"
+        return Route(target, label, similarity, margin)
+
+    def route(self, query_embedding: List[float]) -> Route:
+        """
+        Classifies a query and counts the route.
+        :param query_embedding: normalized query embedding
+        """
+        route = self.classify(query_embedding)
+        with self._lock:
+            self.counts[route.target or "ambiguous"] += 1
+        return route
+
+    def parse_result(self, route: Route) -> dict:
+        """
+        :return: parse result in the format of Rasa for a confident route
+        """
+        intent = "nlu_fallback" if route.target == RAG else route.intent
+        return {"intent": {"name": intent, "confidence": route.similarity}, "entities": []}
+
+    def stats(self, parse_ms: float = 0.0) -> dict:
+        """
+        :param parse_ms: average latency of a parse request to estimate the saved time
+        :return: dict with the amount of queries routed to RAG, to Rasa and to the Rasa NLU (ambiguous),
+                 the share that skipped the Rasa NLU and the estimated saved time in ms
+        """
+        with self._lock:
+            total = sum(self.counts.values())
+            bypassed = total - self.counts["ambiguous"]
+            return {**self.counts, "bypass_rate": bypassed / total if total else 0.0, "saved_ms": bypassed * parse_ms}
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+HTTP client for the Rasa server.
+All requests share one pooled session with timeouts and retries. Parse results are cached by the exact text,
+because the entities refer to the characters of the text they were extracted from. Every chat session triggers its
+intents on a conversation of its own, so concurrent users do not share one Rasa tracker.
+"""
+
+FALLBACK_PARSE = {"intent": {"name": "nlu_fallback", "confidence": 0.0}, "entities": []}
+
+
+class RasaClient:
+    def __init__(self, base_url: str = "http://rasa:5005", timeout: tuple = (3.05, 10.0), retries: int = 2,
+                 pool_size: int = 16, cache_size: int = 1024, cache_ttl: float = 3600.0):
+        """
+        :param base_url: URL of the Rasa server
+        :param timeout: (connect, read) timeout of a request in seconds
+        :param retries: amount of retries after connection errors, parse requests are also retried on 502/503/504
+        :param pool_size: maximum amount of pooled connections
+        :param cache_size: maximum amount of cached parse results, 0 disables the cache
+        :param cache_ttl: time in seconds after which a parse result expires, e.g. after Rasa was retrained
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.hits, self.misses, self.errors = 0, 0, 0
+        self.parse_time = 0.0  # seconds spent on parse requests to the server
+        self.session = requests.Session()
+        # triggering an intent runs actions and changes the tracker, so it is only retried if the connection
+        # failed before anything was sent; parse requests have no side effects and are also retried on 502/503/504
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, connect=retries, read=0, status=0,
+                                                backoff_factor=0.1))
+        parse_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                    max_retries=Retry(total=retries, connect=retries, read=0, status=retries,
+                                                      status_forcelist=[502, 503, 504], allowed_methods=None,
+                                                      backoff_factor=0.1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.mount(f"{self.base_url}/model/parse", parse_adapter)
+        self._cache: OrderedDict[str, tuple] = OrderedDict()  # text -> (parse result, time)
+        self._lock = threading.Lock()
+
+    def _cached(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] >= time.time() - self.cache_ttl:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def _store(self, key: str, parse_result: dict):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[key] = (parse_result, time.time())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def parse(self, text: str) -> dict:
+        """
+        Classifies the text with the Rasa NLU, repeated texts are served from the cache.
+        If Rasa is not reachable, the text is classified as nlu_fallback and answered with RAG.
+        :param text: user question
+        :return: parse result of Rasa containing the intent and entities, must not be modified
+        """
+        parse_result = self._cached(text)
+        if parse_result is not None:
+            return parse_result
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.base_url}/model/parse",
+                                         json={"text": text, "message_id": text.strip()}, timeout=self.timeout)
+            response.raise_for_status()
+            parse_result = response.json()
+            with self._lock:
+                self.parse_time += time.perf_counter() - start
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Rasa parse failed ({e}), answering with RAG.")
+            return FALLBACK_PARSE
+        self._store(text, parse_result)
+        return parse_result
+
+    def trigger_intent(self, conversation_id: str, intent: str, entities: list) -> List[dict]:
+        """
+        Triggers the intent in the given conversation.
+        :param conversation_id: ID of the Rasa tracker, one per chat session
+        :param intent: name of the intent
+        :param entities: entities of the parse result
+        :return: messages of the bot
+        """
+        response = self.session.post(f"{self.base_url}/conversations/{conversation_id}/trigger_intent",
+                                     json={"name": intent, "entities": entities}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get("messages", [])
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the cache hits and misses, the hit rate, the current size, the failed parse requests
+                 and the average latency of a successful parse request to the server in ms
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            requests_sent = self.misses - self.errors
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "size": len(self._cache), "errors": self.errors,
+                    "avg_parse_ms": 1000 * self.parse_time / requests_sent if requests_sent else 0.0}
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+"""
+Semantic answer cache in front of the chatbot.
+Answers are stored together with the embedding of their query in a local SQLite database, so that they survive
+restarts of the app. A new query is answered from the cache if the cosine similarity to a cached query is above
+the threshold and both were asked in the same conversation context, so a follow-up question is not answered with
+the answer to the same words in another conversation. All entries are dropped when the vector databases are rebuilt.
+Stored answers are appended to the in-memory matrix, the last use of hits is written in batches and the database is
+only pruned once it holds more than max_entries answers. Pending hits are flushed when the cache is discarded, e.g.
+when Streamlit reloads the chatbot, and at exit.
+"""
+
+
+def context_key(chat_history) -> str:
+    """
+    Only the role and the text of the messages are part of the key, the avatar, the retrieved context and the
+    confidence shown in the UI are not.
+    :param chat_history: previous messages of the conversation
+    :return: key of the conversation context, empty for a question without previous messages
+    """
+    if not chat_history:
+        return ""
+    messages = json.dumps([[message.origin, message.message] for message in chat_history], ensure_ascii=False)
+    return hashlib.blake2b(messages.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def serialize_docs(docs: list) -> str:
+    return json.dumps([doc if isinstance(doc, str) else {"page_content": doc.page_content, "metadata": doc.metadata}
+                       for doc in docs])
+
+
+def deserialize_docs(data: str) -> list:
+    return [doc if isinstance(doc, str) else Document(page_content=doc["page_content"], metadata=doc["metadata"])
+            for doc in json.loads(data)]
+
+
+class AnswerCache:
+    def __init__(self, db_path: str, index_version: str, threshold: float = 0.97, ttl: float = 3600 * 24 * 7,
+                 max_entries: int = 5000, low_water: float = 0.9, touch_batch_size: int = 64):
+        """
+        Initializes the answer cache and drops all entries of an outdated index version.
+        :param db_path: path to the SQLite file
+        :param index_version: fingerprint of the vector databases the answers are based on
+        :param threshold: minimum cosine similarity between two queries to return a cached answer
+        :param ttl: time in seconds after which an entry expires
+        :param max_entries: maximum amount of entries, the least recently used entries are evicted
+        :param low_water: share of max_entries the database is pruned to once it holds more than max_entries answers
+        :param touch_batch_size: amount of hits after which their last use is written even without new answers
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.low_water = low_water
+        self.touch_batch_size = touch_batch_size
+        self._touched = {}  # id -> last use of hits that is not written to the database yet
+        self.hits, self.misses = 0, 0
+        self.hit_latency, self.miss_latency = 0.0, 0.0  # accumulated response time in seconds
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(answers)")]
+        if columns and "context" not in columns:  # answers of an older version without the conversation context
+            self._connection.execute("DROP TABLE answers")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, query TEXT, context TEXT, embedding BLOB, answer TEXT,
+                relevant_docs TEXT, reranked_docs TEXT, confidence TEXT, created_at REAL, last_used REAL);
+            CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used);
+        """)
+        weakref.finalize(self, AnswerCache._flush_touched, self._connection, self._lock, self._touched)
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+        if row is None or row[0] != index_version:
+            self._connection.execute("DELETE FROM answers")
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)", (index_version,))
+            print("Answer cache invalidated because the vector databases changed.")
+        self._connection.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - ttl,))
+        self._connection.commit()
+        self._load()
+
+    def _load(self):
+        """
+        Loads all embeddings into memory for the similarity search.
+        The matrix has spare rows, so stored answers can be appended without copying it.
+        """
+        rows = self._connection.execute("SELECT id, context, embedding FROM answers").fetchall()
+        self._ids: List[int] = [row[0] for row in rows]
+        self._contexts: List[str] = [row[1] for row in rows]
+        self._size = len(rows)
+        self._db_size = len(rows)
+        dimension = len(rows[0][2]) // 4 if rows else 0
+        self._embeddings = np.zeros((max(self.max_entries + 1, self._size), dimension), dtype=np.float32)
+        for i, row in enumerate(rows):
+            self._embeddings[i] = np.frombuffer(row[2], dtype=np.float32)
+
+    def _append(self, answer_id: int, context: str, embedding: np.ndarray):
+        if self._embeddings.shape[1] != len(embedding):  # the first answer defines the dimension
+            self._embeddings = np.zeros((self._embeddings.shape[0], len(embedding)), dtype=np.float32)
+        if self._size == self._embeddings.shape[0]:
+            self._embeddings = np.concatenate([self._embeddings, np.zeros_like(self._embeddings)])
+        self._embeddings[self._size] = embedding
+        self._ids.append(answer_id)
+        self._contexts.append(context)
+        self._size += 1
+
+    def _write_touched(self):
+        """
+        Writes the last use of the pending hits, the caller holds the lock and commits.
+        """
+        self._write_pending(self._connection, self._touched)
+
+    @staticmethod
+    def _write_pending(connection: sqlite3.Connection, touched: dict):
+        if touched:
+            connection.executemany("UPDATE answers SET last_used = ? WHERE id = ?",
+                                   [(last_used, answer_id) for answer_id, last_used in touched.items()])
+            touched.clear()
+
+    @staticmethod
+    def _flush_touched(connection: sqlite3.Connection, lock: threading.Lock, touched: dict):
+        """
+        Writes and commits the pending hits, does not reference the cache so it can run as its finalizer.
+        """
+        with lock:
+            if touched:
+                AnswerCache._write_pending(connection, touched)
+                connection.commit()
+
+    def lookup(self, query_embedding: List[float], context: str = "") -> Optional[tuple]:
+        """
+        Returns the cached answer of the most similar query, if it is similar enough and not expired.
+        :param query_embedding: normalized embedding of the user question
+        :param context: key of the conversation context, see context_key
+        :return: tuple: (answer, relevant_docs, reranked_docs, confidence) or None
+        """
+        result = None
+        with self._lock:
+            if self._size:
+                similarities = self._embeddings[:self._size] @ np.asarray(query_embedding, dtype=np.float32)
+                same_context = np.fromiter((other == context for other in self._contexts), dtype=bool,
+                                           count=self._size)
+                similarities = np.where(same_context, similarities, -1.0)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    row = self._connection.execute(
+                        "SELECT answer, relevant_docs, reranked_docs, confidence, created_at FROM answers "
+                        "WHERE id = ?", (self._ids[best],)).fetchone()
+                    if row and row[4] >= time.time() - self.ttl:
+                        self._touched[self._ids[best]] = time.time()
+                        if len(self._touched) >= self.touch_batch_size:
+                            self._write_touched()
+                            self._connection.commit()
+                        result = (row[0], deserialize_docs(row[1]), deserialize_docs(row[2]), row[3])
+
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def record_latency(self, hit: bool, seconds: float):
+        """
+        Records the total response time of a request that was answered from the cache or not.
+        """
+        with self._lock:
+            if hit:
+                self.hit_latency += seconds
+            else:
+                self.miss_latency += seconds
+
+    def store(self, query: str, query_embedding: List[float], answer: str, relevant_docs: list,
+              reranked_docs: list, confidence: str, context: str = ""):
+        """
+        Stores an answer. Once there are more than max_entries answers, expired and least recently used entries
+        are evicted down to the low-water mark.
+        :param context: key of the conversation context, see context_key
+        """
+        now = time.time()
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        with self._lock:
+            self._write_touched()
+            cursor = self._connection.execute(
+                "INSERT INTO answers (query, context, embedding, answer, relevant_docs, reranked_docs, confidence, "
+                "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (query, context, embedding.tobytes(), answer, serialize_docs(relevant_docs),
+                 serialize_docs(reranked_docs), confidence, now, now))
+            self._db_size += 1
+            if self._db_size > self.max_entries:
+                self._connection.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl,))
+                excess = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - \
+                    int(self.max_entries * self.low_water)
+                if excess > 0:
+                    self._connection.execute(
+                        "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used LIMIT ?)",
+                        (excess,))
+                self._connection.commit()
+                self._load()
+            else:
+                self._connection.commit()
+                self._append(cursor.lastrowid, context, embedding)
+
+    def flush(self):
+        """
+        Writes the last use of the pending hits to the database.
+        """
+        self._flush_touched(self._connection, self._lock, self._touched)
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._connection.execute("DELETE FROM answers")
+            self._connection.commit()
+            self._load()
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the amount of hits and misses, the hit rate and the average response times in ms
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "avg_hit_ms": 1000 * self.hit_latency / self.hits if self.hits else 0.0,
+                    "avg_miss_ms": 1000 * self.miss_latency / self.misses if self.misses else 0.0,
+                    "size": self._size}
@@ -0,0 +1,92 @@
+import re
+import threading
+from typing import Callable, List
+
+from langchain_core.documents import Document
+
+"""
+Context compression between reranking and generation.
+The context documents are split into sentences, which are scored against the query with the cross-encoder.
+Only the best sentences within a token budget are passed to the LLM, which shortens the prompt prefill.
+Sentences with links are always kept, so the LLM can still refer the user to the right page.
+"""
+
+SENTENCE_BREAK = re.compile(r"(?<=[.!?:])\s+(?=[A-ZÄÖÜ0-9\"'(])|\n+")
+URL = re.compile(r"https?://|www\.")
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in SENTENCE_BREAK.split(text) if sentence and sentence.strip()]
+
+
+class ContextCompressor:
+    def __init__(self, score_pairs: Callable[[List[List[str]]], List[float]], count_tokens: Callable[[str], int],
+                 token_budget: int = 512):
+        """
+        :param score_pairs: function that scores (query, sentence) pairs, e.g. OllamaRAG.score_pairs
+        :param count_tokens: function that returns the amount of tokens of a text
+        :param token_budget: maximum amount of tokens of the compressed context
+        """
+        self.score_pairs = score_pairs
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.tokens_before, self.tokens_after = 0, 0
+        self._lock = threading.Lock()
+
+    def compress(self, query: str, docs: List[Document]) -> List[Document]:
+        """
+        Keeps the sentences with links, the titles and then the best scoring sentences until the budget is used up.
+        The selected sentences stay in their original order, gaps are marked with "...".
+        :param query: user question
+        :param docs: context documents, they are not modified because they may be shared
+        :return: compressed copies of the documents, the documents themselves if they already fit into the budget
+        """
+        sentences = []  # (document index, position, sentence, tokens)
+        for i, doc in enumerate(docs):
+            for position, sentence in enumerate(split_sentences(doc.page_content)):
+                sentences.append((i, position, sentence, self.count_tokens(sentence)))
+        before = sum(tokens for _, _, _, tokens in sentences)
+        if before <= self.token_budget:
+            return docs
+
+        selected, used = set(), 0
+        for key, (i, position, sentence, tokens) in enumerate(sentences):
+            is_title = position == 0 and sentence == docs[i].metadata.get("title", "").strip()
+            if URL.search(sentence) or is_title:
+                selected.add(key)
+                used += tokens
+        candidates = [key for key in range(len(sentences)) if key not in selected]
+        scores = self.score_pairs([[query, sentences[key][2]] for key in candidates])
+        for score, key in sorted(zip(scores, candidates), reverse=True):
+            if used + sentences[key][3] <= self.token_budget:
+                selected.add(key)
+                used += sentences[key][3]
+
+        compressed = []
+        for i, doc in enumerate(docs):
+            parts, previous = [], -1
+            for key in sorted(selected):
+                if sentences[key][0] != i:
+                    continue
+                if sentences[key][1] != previous + 1 and parts:
+                    parts.append("...")
+                parts.append(sentences[key][2])
+                previous = sentences[key][1]
+            if parts:
+                compressed.append(Document(page_content=" ".join(parts), metadata=doc.metadata))
+
+        with self._lock:
+            self.tokens_before += before
+            self.tokens_after += used
+        print(f"Context compression: {before} -> {used} tokens, {before - used} prefill tokens saved "
+              f"({1 - used / before:.0%}).")
+        return compressed
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the context tokens before and after the compression and the saved share
+        """
+        with self._lock:
+            saved = self.tokens_before - self.tokens_after
+            return {"tokens_before": self.tokens_before, "tokens_after": self.tokens_after,
+                    "saved": saved / self.tokens_before if self.tokens_before else 0.0}
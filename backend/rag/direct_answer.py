@@ -0,0 +1,116 @@
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from backend.rag.embeddings import normalize_query
+from scripts.qa_retriever import get_data
+
+"""
+Direct answers for questions of the curated question-answer set.
+If a user asks one of the QA questions almost verbatim, the stored answer is returned without an LLM generation.
+Translations of the pairs are read from data/question_answer_translations.json, e.g.
+{"<question of the QA set>": {"de": {"question": "...", "answer": "..."}}}
+"""
+
+TRANSLATIONS_FILE = "question_answer_translations.json"
+GERMAN_WORDS = {"der", "die", "das", "und", "ist", "ich", "wie", "was", "wo", "wann", "welche", "kann", "gibt", "es",
+                "ein", "eine", "für", "mit", "den", "dem", "hochschule", "studium", "bewerbung", "mich",
+                "mir", "nicht", "auf", "zu", "im", "wer", "muss", "bei", "von", "meine", "mein"}
+ENGLISH_WORDS = {"the", "and", "is", "i", "how", "what", "where", "when", "which", "can", "there", "a", "an", "for",
+                 "with", "at", "to", "do", "does", "university", "study", "application", "me", "my", "not", "on",
+                 "in", "who", "must", "of", "are", "apply"}
+
+
+def detect_language(text: str) -> str:
+    """
+    Lightweight language detection for German and English queries based on frequent words and umlauts.
+    :return: "de" or "en"
+    """
+    words = re.findall(r"\w+", text.casefold())
+    german = sum(word in GERMAN_WORDS for word in words) + 2 * len(re.findall(r"[äöüß]", text.casefold()))
+    english = sum(word in ENGLISH_WORDS for word in words)
+    return "de" if german > english else "en"
+
+
+@dataclass
+class DirectAnswer:
+    question: str
+    answer: str
+    language: str
+    source: str
+    score: float  # reranking score of the QA chunk
+    similarity: float  # cosine similarity between the query and the closest variant of the question
+
+
+class DirectAnswerIndex:
+    def __init__(self, data_path: str, embed_queries: Callable[[List[str]], List[List[float]]],
+                 score_threshold: float = 8.0, similarity_threshold: float = 0.94):
+        """
+        Index of the QA questions and their translations.
+        :param data_path: path to the data folder, containing the question-answer set folder
+        :param embed_queries: function to embed texts with the query instruction of the retrievers
+        :param score_threshold: minimum reranking score of the top QA chunk
+        :param similarity_threshold: minimum cosine similarity between the query and the question
+        """
+        self.score_threshold = score_threshold
+        self.similarity_threshold = similarity_threshold
+        self.answers: Dict[str, str] = {}  # normalized question -> answer
+        self.questions: Dict[str, str] = {}  # normalized question -> question
+        self.translations: Dict[str, dict] = {}  # normalized question -> language -> {"question", "answer"}
+
+        for question, answer in get_data(os.path.join(data_path, "question_answer_set")).items():
+            self.questions[normalize_query(question)] = question.strip()
+            self.answers[normalize_query(question)] = answer.strip()
+        translations_path = os.path.join(data_path, TRANSLATIONS_FILE)
+        if os.path.isfile(translations_path):
+            with open(translations_path, encoding="utf-8") as file:
+                for question, languages in json.load(file).items():
+                    if normalize_query(question) in self.answers:
+                        self.translations[normalize_query(question)] = languages
+
+        # every question is matched against the query in all of its languages
+        self.variant_rows: Dict[str, List[int]] = {}  # normalized question -> rows of its variants
+        variants = []
+        for key, question in self.questions.items():
+            for text in [question] + [pair["question"] for pair in self.translations.get(key, {}).values()]:
+                self.variant_rows.setdefault(key, []).append(len(variants))
+                variants.append(text)
+        self.variant_embeddings = np.array(embed_queries(variants), dtype=np.float32)
+        print(f"Direct answers: {len(self.questions)} questions, {len(self.translations)} with translations.")
+
+    def similarity(self, key: str, query_embedding: List[float]) -> float:
+        rows = self.variant_rows[key]
+        return float(np.max(self.variant_embeddings[rows] @ np.asarray(query_embedding, dtype=np.float32)))
+
+    def match(self, query: str, query_embedding: List[float], top_doc, top_score: float) -> Optional[DirectAnswer]:
+        """
+        Returns the stored answer if the top reranked chunk is a QA pair that closely matches the query.
+        :param query: user question
+        :param query_embedding: normalized embedding of the query
+        :param top_doc: top reranked document of the QA database, its title is the question
+        :param top_score: reranking score of the document
+        :return: DirectAnswer or None if the query has to be answered by the LLM
+        """
+        if top_score < self.score_threshold:
+            return None
+        key = normalize_query(top_doc.metadata.get("title", ""))
+        if key not in self.answers:
+            return None
+        similarity = self.similarity(key, query_embedding)
+        if similarity < self.similarity_threshold:
+            return None
+
+        language = detect_language(query)
+        question, answer = self.questions[key], self.answers[key]
+        translation = self.translations.get(key, {}).get(language)
+        if translation:
+            question, answer = translation["question"], translation["answer"]
+        elif language != "en":  # the QA set is written in English, the LLM answers in the language of the query
+            return None
+        urls = re.findall(r"https?://\S+", self.answers[key])
+        source = urls[0].rstrip(".,;)") if urls else top_doc.metadata.get("url", "")
+        return DirectAnswer(question, answer, language, source, top_score, similarity)
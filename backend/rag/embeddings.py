@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+"""
+Query embedding layer of the RAG pipeline.
+Every query is embedded once per request and the vectors of repeated questions are served from an LRU cache.
+The e5 model runs either in torch (sentence-transformers) or as int8 model in ONNX Runtime.
+"""
+
+EMBEDDING_BACKENDS = ["torch", "onnx"]
+
+
+def encoder_backend(encoder) -> str:
+    """
+    :return: backend of a loaded encoder, embeddings of different backends are not mixed in one artifact
+    """
+    return getattr(encoder, "backend", "torch")
+
+
+def embedding_key(model_name: str, encoder) -> str:
+    """
+    :return: name of the model and backend that produced the embeddings, recorded in the artifacts and the index
+             manifest and part of every chunk ID of the vector databases
+    """
+    return f"{model_name} ({encoder_backend(encoder)})"
+
+
+def load_encoder(model_name: str, backend: str = "torch", device: Optional[str] = None):
+    """
+    Loads the embedding model with the given backend.
+    The ONNX backend falls back to sentence-transformers with a warning if onnxruntime or onnx is not installed or
+    the export fails.
+    :param model_name: name of the embedding model
+    :param backend: "torch" or "onnx"
+    :param device: device of the torch model, defaults to cuda if available
+    :return: SentenceTransformer or OnnxEncoder, both provide encode() and the tokenizer
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {EMBEDDING_BACKENDS}")
+    if backend == "onnx":
+        try:
+            from backend.rag.onnx_runtime import OnnxEncoder
+            return OnnxEncoder.from_pretrained(model_name)
+        except Exception as e:
+            print(f"WARNING: ONNX embedding backend is not available ({type(e).__name__}: {e}), "
+                  f"falling back to sentence-transformers.")
+    import torch
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device=device or ("cuda" if torch.cuda.is_available() else "cpu"))
+
+
+class E5Embeddings(Embeddings):
+    def __init__(self, client, query_instruction: str = "query: ", embed_instruction: str = "passage: ",
+                 encode_kwargs: Optional[dict] = None):
+        """
+        LangChain embeddings for e5 models, equivalent to HuggingFaceBgeEmbeddings with any encoder backend.
+        :param client: SentenceTransformer or OnnxEncoder
+        :param query_instruction: prefix of queries
+        :param embed_instruction: prefix of documents
+        :param encode_kwargs: keyword arguments of encode(), embeddings are normalized by default
+        """
+        self.client = client
+        self.query_instruction = query_instruction
+        self.embed_instruction = embed_instruction
+        self.encode_kwargs = encode_kwargs or {"normalize_embeddings": True}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [self.embed_instruction + text.replace("\n", " ") for text in texts]
+        return self.client.encode(texts, **self.encode_kwargs).tolist()
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        queries = [self.query_instruction + query.replace("\n", " ") for query in queries]
+        return self.client.encode(queries, **self.encode_kwargs).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query for cache lookups: whitespace is collapsed and the text is case folded.
+    """
+    return " ".join(query.split()).casefold()
+
+
+class QueryEmbeddingCache:
+    def __init__(self, max_size: int = 2048):
+        """
+        Thread-safe LRU cache for query embeddings, keyed by the normalized query text.
+        :param max_size: maximum amount of cached embeddings
+        """
+        self.max_size = max_size
+        self.hits, self.misses = 0, 0
+        self._entries: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key: str, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the amount of hits, misses, the hit rate and the current size
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "size": len(self._entries)}
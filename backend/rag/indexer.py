@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from langchain_community.vectorstores.chroma import Chroma
+from langchain_core.documents import Document
+
+"""
+Incremental indexer for the Chroma vector databases.
+Every chunk gets a content hash as ID, so only new or changed chunks have to be embedded and vanished chunks
+can be deleted by ID. The manifest stored next to the database records the IDs and the chunking and embedding
+parameters. The embedding model and backend are part of the hashed parameters, so switching the backend replaces
+all vectors instead of mixing vectors of both backends in one database.
+"""
+
+MANIFEST_FILE = "index_manifest.json"
+
+
+def chunk_id(chunk: Document, params: dict) -> str:
+    """
+    Content hash of a chunk, changes if the title, text, url or the chunking/embedding parameters change.
+    """
+    content = json.dumps([chunk.metadata.get("title", ""), chunk.page_content, chunk.metadata.get("url", ""), params],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def read_manifest(db_path: str) -> Optional[dict]:
+    """
+    :return: manifest of the database, None if the database has no manifest
+    """
+    manifest_path = os.path.join(db_path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def read_manifest_digest(db_path: str) -> Optional[str]:
+    """
+    :return: digest of the indexed chunk IDs, None if the database has no manifest
+    """
+    manifest = read_manifest(db_path)
+    return manifest.get("digest") if manifest else None
+
+
+class IncrementalIndexer:
+    def __init__(self, vector_index: Chroma, db_path: str, params: dict, batch_size: int = 256):
+        """
+        :param vector_index: Chroma database to update
+        :param db_path: persist directory of the database, the manifest is stored there
+        :param params: chunking and embedding parameters, part of every chunk hash, the embedding model and backend
+               are expected under "embedding"
+        :param batch_size: amount of chunks embedded and added at once
+        """
+        self.vector_index = vector_index
+        self.db_path = db_path
+        self.params = params
+        self.batch_size = batch_size
+
+    def update(self, chunks: List[Document], embeddings: Optional[Dict[str, list]] = None) -> dict:
+        """
+        Synchronizes the database with the given chunks.
+        New or changed chunks are embedded and added, chunks that no longer exist are deleted.
+        :param chunks: all chunks that should be contained in the database
+        :param embeddings: precomputed passage embeddings by chunk ID, e.g. from the embed stage of the
+               ingestion pipeline, the chunks are embedded with the embedding function of the database if None
+        :return: dict with the amount of added, deleted and unchanged chunks
+        """
+        start = time.perf_counter()
+        wanted = {}
+        for chunk in chunks:
+            wanted.setdefault(chunk_id(chunk, self.params), chunk)  # identical chunks are only stored once
+
+        # the database itself is the ground truth, this also removes chunks of databases built without IDs
+        existing = set(self.vector_index.get(include=[])["ids"])
+        new_ids = [chunk_hash for chunk_hash in wanted if chunk_hash not in existing]
+        vanished_ids = [chunk_hash for chunk_hash in existing if chunk_hash not in wanted]
+
+        for i in range(0, len(vanished_ids), self.batch_size):
+            self.vector_index.delete(ids=vanished_ids[i:i + self.batch_size])
+        for i in range(0, len(new_ids), self.batch_size):
+            batch = new_ids[i:i + self.batch_size]
+            if embeddings is None:
+                self.vector_index.add_documents([wanted[chunk_hash] for chunk_hash in batch], ids=batch)
+            else:
+                self.vector_index._collection.add(
+                    ids=batch, embeddings=[list(map(float, embeddings[chunk_hash])) for chunk_hash in batch],
+                    documents=[wanted[chunk_hash].page_content for chunk_hash in batch],
+                    metadatas=[wanted[chunk_hash].metadata for chunk_hash in batch])
+            print(f"Added {min(i + self.batch_size, len(new_ids))}/{len(new_ids)} new chunks.")
+
+        self.write_manifest(wanted)
+        result = {"added": len(new_ids), "deleted": len(vanished_ids), "unchanged": len(wanted) - len(new_ids)}
+        print(f"Updated index '{self.db_path}' in {time.perf_counter() - start:.1f}s: {result}")
+        return result
+
+    def write_manifest(self, chunks: dict):
+        """
+        Writes the manifest with the chunk IDs and parameters of the current database state.
+        :param chunks: dict of chunk ID -> chunk
+        """
+        ids = sorted(chunks)
+        manifest = {
+            "params": self.params,
+            "digest": hashlib.sha256("".join(ids).encode("utf-8")).hexdigest(),
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "chunks": {chunk_hash: {"title": chunks[chunk_hash].metadata.get("title", ""),
+                                    "url": chunks[chunk_hash].metadata.get("url", "")} for chunk_hash in ids},
+        }
+        os.makedirs(self.db_path, exist_ok=True)
+        with open(os.path.join(self.db_path, MANIFEST_FILE), "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=1)
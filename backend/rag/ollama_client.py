@@ -0,0 +1,128 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+Generation client for the Ollama server.
+All requests share one pooled HTTP session and ask Ollama to keep the model loaded between requests.
+The prompt starts with the fixed instructions and only then contains the context, the chat history and the question,
+so consecutive requests share the instruction prefix and Ollama can reuse its KV cache for it.
+"""
+
+SYSTEM_PROMPT = """You are a chatbot that should answer questions about the Technical University of Applied Sciences Augsburg (THA). Questions can appear in German or English. You should provide the most relevant information based on the given context and answer either in English or German depending on the user question. Answer without introduction of yourself and provide only relevant information.  Only answer questions that are related to the THA. Use the following pieces of context to answer the user question at the end. If the answer is not contained in the context, just say that you don't know, don't try to make up an answer. Answer in German, if the user question appeared in German or answer in English if the user question appeared in English!
+"""
+PROMPT_TEMPLATE = SYSTEM_PROMPT + """CONTEXT: {context}
+{chat_history} USER: {question} ASSISTANT:"""
+
+
+def build_prompt(context: list, chat_history: str, question: str, document_separator: str = "\n\n") -> str:
+    """
+    Fills the prompt template, the documents of the context are joined like in a LangChain stuff chain.
+    :param context: context documents
+    :param chat_history: formatted chat history
+    :param question: user question
+    :param document_separator: separator between two documents
+    :return: the prompt, starting with the fixed SYSTEM_PROMPT
+    """
+    return PROMPT_TEMPLATE.format(context=document_separator.join(doc.page_content for doc in context),
+                                  chat_history=chat_history, question=question)
+
+
+class OllamaClient:
+    def __init__(self, model: str, base_url: str = "http://ollama-container:11434", temperature: float = 0.1,
+                 keep_alive: str = "30m", num_ctx: int = 4096, num_predict: int = 512,
+                 timeout: Tuple[float, Optional[float]] = (3.05, None), warmup_timeout: float = 120.0,
+                 pool_size: int = 8):
+        """
+        :param model: name of the Ollama model
+        :param base_url: URL of the Ollama server
+        :param temperature: sampling temperature
+        :param keep_alive: how long Ollama keeps the model loaded after a request, e.g. "30m" or -1 for ever
+        :param num_ctx: context window in tokens, the prompt including the context has to fit into it
+        :param num_predict: maximum amount of generated tokens
+        :param timeout: (connect, read) timeout of a generation request in seconds, a long answer on the CPU can take
+               minutes, so there is no read timeout by default
+        :param warmup_timeout: timeout of the warmup request in seconds
+        :param pool_size: maximum amount of pooled connections, also the maximum amount of parallel requests
+        """
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.temperature = temperature
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.num_predict = num_predict
+        self.timeout = timeout
+        self.warmup_timeout = warmup_timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        # only connection errors are retried, a failed generation is not sent twice
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def payload(self, prompt: str, stream: bool) -> dict:
+        return {"model": self.model, "prompt": prompt, "stream": stream, "keep_alive": self.keep_alive,
+                "options": {"temperature": self.temperature, "num_ctx": self.num_ctx,
+                            "num_predict": self.num_predict}}
+
+    def generate(self, prompt: str) -> str:
+        """
+        Generates the complete answer to the prompt.
+        """
+        response = self.session.post(f"{self.base_url}/api/generate", json=self.payload(prompt, False),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        """
+        Yields the answer to the prompt token by token as soon as Ollama produces them.
+        """
+        with self.session.post(f"{self.base_url}/api/generate", json=self.payload(prompt, True),
+                               timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("response"):
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
+
+    def generate_batch(self, prompts: List[str], max_concurrency: int = 4) -> List[str]:
+        """
+        Generates the answers to several prompts with at most max_concurrency parallel requests.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, self.pool_size))) as executor:
+            return list(executor.map(self.generate, prompts))
+
+    def warmup(self, prompt: Optional[str] = None):
+        """
+        Loads the model into memory and keeps it there. With a prompt, e.g. the fixed SYSTEM_PROMPT,
+        Ollama also evaluates the prompt once, so the KV cache of the prefix is ready for the first user.
+        Errors are only printed, the app also starts if Ollama is not reachable yet.
+        """
+        try:
+            payload = self.payload(prompt or "", False)
+            if prompt:
+                payload["options"]["num_predict"] = 1
+            response = self.session.post(f"{self.base_url}/api/generate", json=payload, timeout=self.warmup_timeout)
+            response.raise_for_status()
+            print(f"Loaded Ollama model '{self.model}' (keep_alive {self.keep_alive}).")
+        except requests.RequestException as e:
+            print(f"Ollama warmup failed: {e}")
+
+    def warmup_async(self, prompt: Optional[str] = None) -> threading.Thread:
+        """
+        Runs the warmup in a background thread, the model is loaded while the rest of the app starts.
+        """
+        thread = threading.Thread(target=self.warmup, args=(prompt,), daemon=True)
+        thread.start()
+        return thread
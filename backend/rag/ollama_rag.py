@@ -1,23 +1,48 @@
 import os
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
 
-import torch
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_community.embeddings.huggingface import HuggingFaceBgeEmbeddings
-from langchain_community.llms.ollama import Ollama
 from langchain_community.vectorstores.chroma import Chroma
 from langchain_core.documents import Document
-from langchain_core.prompts import PromptTemplate
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import CrossEncoder
 
-from scripts.information_retriever import WebsiteRetriever
-from scripts.qa_retriever import get_data_in_html_format
+from backend.rag.compression import ContextCompressor
+from backend.rag.direct_answer import DirectAnswer, DirectAnswerIndex
+from backend.rag.embeddings import E5Embeddings, QueryEmbeddingCache, embedding_key, encoder_backend, load_encoder, \
+    normalize_query
+from backend.rag.indexer import read_manifest, read_manifest_digest
+from backend.rag.ollama_client import SYSTEM_PROMPT, OllamaClient, build_prompt
+from backend.rag.reranker import get_reranker
+from backend.rag.retrieval_policy import RetrievalPolicy
+from backend.rag.score_cache import RerankScoreCache, score_key
+from scripts.ingest import IngestionPipeline
+
+
+@dataclass
+class ResponseMetadata:
+    """
+    Final record of a streamed response, contains everything except the answer text.
+    """
+    relevant_docs: list
+    reranked_docs: list
+    confidence: str
+    direct_answer: Optional[DirectAnswer] = None  # set if the stored answer of a QA pair is returned
 
 
 class OllamaRAG:
     def __init__(self, embedding_db_path: str, data_path: str, text_gen_model: str, embedding_model: str,
-                 reranking_model: str, alternative_data_path: str, alternative_embedding_db_path: str):
+                 reranking_model: str, alternative_data_path: str, alternative_embedding_db_path: str,
+                 reranking_batch_size: int = 32, reranking_device: str = None, warmup: bool = True,
+                 speculative_retrieval: bool = True, query_cache_size: int = 2048, update_index: bool = False,
+                 chunk_overlap: int = 48, embedding_backend: str = "torch", reranking_backend: str = "torch",
+                 direct_answers: bool = True, direct_answer_threshold: float = 8.0,
+                 direct_answer_similarity: float = 0.94, adaptive_retrieval: bool = False,
+                 score_cache_size: int = 50000, score_cache_path: Optional[str] = None,
+                 context_compression: bool = False, context_token_budget: int = 512,
+                 ollama_url: str = "http://ollama-container:11434", keep_alive: str = "30m", num_ctx: int = 4096,
+                 num_predict: int = 512):
         """
         Initializes the RAG model with the given parameters.
         :param embedding_db_path: path to the main database
@@ -27,17 +52,65 @@ class OllamaRAG:
         :param reranking_model: name of the reranking model
         :param alternative_data_path: path to the alternative dataset, either websites or QA set
         :param alternative_embedding_db_path: path to the alternative embedding database
+        :param reranking_batch_size: amount of (query, document) pairs scored in one forward pass
+        :param reranking_device: device for the reranking model, defaults to cuda if available
+        :param warmup: whether to run a warmup prediction when the reranking model is loaded
+               and to load the LLM in the background
+        :param speculative_retrieval: whether to search the main and alternative database in parallel,
+               otherwise the alternative database is only searched if the main database scores too low
+        :param query_cache_size: maximum amount of cached query embeddings
+        :param update_index: whether to run the ingestion pipeline and incrementally update the vector databases
+        :param chunk_overlap: amount of tokens shared by consecutive chunks of a document
+        :param embedding_backend: "torch" or "onnx" (int8 in ONNX Runtime, falls back to torch if unavailable)
+        :param reranking_backend: "torch" or "onnx" (int8 in ONNX Runtime, falls back to torch if unavailable)
+        :param direct_answers: whether to return the stored answer of a QA pair without generation
+               if the user asks its question almost verbatim
+        :param direct_answer_threshold: minimum reranking score of the QA chunk for a direct answer
+        :param direct_answer_similarity: minimum cosine similarity between the query and the QA question
+        :param adaptive_retrieval: whether the amount of reranked candidates depends on the dense relevance scores,
+               otherwise search_k candidates are retrieved and all of them are reranked. Off until the thresholds
+               of RetrievalPolicy are evaluated, see backend/rag/retrieval_policy.py
+        :param score_cache_size: maximum amount of cached reranking scores, 0 disables the cache
+        :param score_cache_path: path to the SQLite file of the reranking score cache, only kept in memory if None
+        :param context_compression: whether only the sentences of the context that are most relevant to the query
+               are passed to the LLM, shortens the prompt prefill
+        :param context_token_budget: maximum amount of context tokens if the context is compressed
+        :param ollama_url: URL of the Ollama server
+        :param keep_alive: how long Ollama keeps the LLM loaded after a request
+        :param num_ctx: context window of the LLM in tokens
+        :param num_predict: maximum amount of generated tokens
         """
         self.embedding_llm, self.vector_index, self.vector_index_alternative = None, None, None
-        self.retriever, self.retriever_alternative, self.llm, self.document_chain = None, None, None, None
-        self.llm = Ollama(model=text_gen_model, temperature=0.1, base_url='http://ollama-container:11434')
+        self.llm = OllamaClient(text_gen_model, ollama_url, temperature=0.1, keep_alive=keep_alive, num_ctx=num_ctx,
+                                num_predict=num_predict)
+        if warmup:  # the LLM is loaded while the databases and models are set up
+            self.llm.warmup_async(SYSTEM_PROMPT)
 
         self.embed_model_name: str = embedding_model
         self.reranking_model: str = reranking_model
+        self.reranking_batch_size: int = reranking_batch_size
+        self.search_k: int = 5  # amount of documents retrieved per database
+        self.retrieval_policy = RetrievalPolicy(base_k=self.search_k) if adaptive_retrieval else None
+        self.chunk_overlap: int = chunk_overlap
+        self.embedding_backend: str = embedding_backend
+        self.direct_answers: bool = direct_answers
+        self.direct_answer_threshold: float = direct_answer_threshold
+        self.direct_answer_similarity: float = direct_answer_similarity
+        self.direct_answer_index = None
+        self.context_compression: bool = context_compression
+        self.context_token_budget: int = context_token_budget
+        self.context_compressor = None
+        self.update_index: bool = update_index
+        self.embedding_db_path, self.alternative_embedding_db_path = None, None
+        self.speculative_retrieval: bool = speculative_retrieval
+        self.executor = ThreadPoolExecutor(max_workers=2)  # used to search both databases in parallel
+        self.query_embedding_cache = QueryEmbeddingCache(query_cache_size)
+        self.score_cache = RerankScoreCache(score_cache_size, score_cache_path) if score_cache_size else None
+        # shared across all instances of the process, the model is only loaded from disk once
+        self.reranker = get_reranker(reranking_model, max_length=512, batch_size=reranking_batch_size,
+                                     device=reranking_device, warmup=warmup, backend=reranking_backend)
 
-        self.docs = []
         self.setup(embedding_db_path, data_path, alternative_data_path, alternative_embedding_db_path)
-        self.create_document_chain()
 
     def setup(self, embedding_db_path: str, data_path: str, alternative_data_path: str,
               alternative_embedding_db_path: str):
@@ -50,89 +123,149 @@ class OllamaRAG:
         :param alternative_embedding_db_path: path to the alternative embedding database
         :return:
         """
-        model_name = self.embed_model_name
-        encode_kwargs = {'normalize_embeddings': True}
-        self.embedding_llm = HuggingFaceBgeEmbeddings(model_name=model_name, model_kwargs={
-            "device": "cuda" if torch.cuda.is_available() else "cpu"}, encode_kwargs=encode_kwargs, )
-        self.embedding_llm.query_instruction = "query: "  # used to embed queries
-        self.embedding_llm.embed_instruction = "passage: "  # used to embed documents
+        encoder = load_encoder(self.embed_model_name, self.embedding_backend)
+        # "query: " is used to embed queries, "passage: " to embed documents
+        self.embedding_llm = E5Embeddings(encoder, query_instruction="query: ", embed_instruction="passage: ",
+                                          encode_kwargs={'normalize_embeddings': True})
+        if self.context_compression:
+            # token counts of the e5 tokenizer, close to the ones of the LLM for German and English texts
+            tokenizer = encoder.tokenizer
+            self.context_compressor = ContextCompressor(
+                self.score_pairs, lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"]),
+                self.context_token_budget)
 
-        if os.path.isdir(embedding_db_path):
-            self.vector_index = Chroma(persist_directory=embedding_db_path, embedding_function=self.embedding_llm)
-        else:
-            if "websites.json" in data_path:
-                self.retrieve_data(data_path, True)
-            else:  # QA set retrieval
-                self.retrieve_data(data_path, False)
-            self.build_vector_database(embedding_db_path, False)
-
-        if os.path.isdir(alternative_embedding_db_path):
-            self.vector_index_alternative = Chroma(persist_directory=alternative_embedding_db_path,
-                                                   embedding_function=self.embedding_llm)
-        else:
-            self.retrieve_data(alternative_data_path, True)
-            self.build_vector_database(alternative_embedding_db_path, True)
+        self.embedding_db_path, self.alternative_embedding_db_path = embedding_db_path, alternative_embedding_db_path
+        self.vector_index = self.load_vector_database(embedding_db_path, data_path)
+        self.vector_index_alternative = self.load_vector_database(alternative_embedding_db_path, alternative_data_path,
+                                                                  True)
+
+        if self.direct_answers and "websites.json" not in data_path:  # only the QA set has stored answers
+            self.direct_answer_index = DirectAnswerIndex(data_path, self.embedding_llm.embed_queries,
+                                                         self.direct_answer_threshold, self.direct_answer_similarity)
+        if self.score_cache is not None:
+            self.score_cache.set_index_version(self.index_version())
 
-        self.retriever_alternative = self.vector_index_alternative.as_retriever(search_kwargs={"k": 5})
-        self.retriever = self.vector_index.as_retriever(search_kwargs={"k": 5})
-        self.create_document_chain()
+    def load_vector_database(self, embeddings_db_path: str, data_path: str, from_website: bool = False) -> Chroma:
+        """
+        Method to load a vector database built by the ingestion pipeline (python -m scripts.ingest).
+        If update_index is set, the pipeline is run first to incrementally update the database with the current data.
+        :param embeddings_db_path: path to the main or alternative database
+        :param data_path: path to the dataset, retrieves data from website if the path contains "websites.json"
+        :param from_website: whether the database contains the websites and PDF files or the QA set
+        :return: the loaded database
+        """
+        if self.update_index:
+            index = "website" if from_website or "websites.json" in data_path else "qa"
+            data_folder = os.path.dirname(data_path) if data_path.endswith(".json") else data_path
+            pipeline = IngestionPipeline(data_folder, embedding_model=self.embed_model_name,
+                                         reranking_model=self.reranking_model, chunk_overlap=self.chunk_overlap,
+                                         encoder=self.embedding_llm.client)
+            pipeline.run(index, db_path=embeddings_db_path)
+        elif not os.path.isdir(embeddings_db_path):
+            raise FileNotFoundError(f"Vector database '{embeddings_db_path}' does not exist. "
+                                    f"Build it with: python -m scripts.ingest")
+        manifest = read_manifest(embeddings_db_path)
+        indexed = manifest.get("params", {}).get("embedding") if manifest else None
+        expected = embedding_key(self.embed_model_name, self.embedding_llm.client)
+        if indexed and indexed != expected:
+            print(f"WARNING: the vectors of '{embeddings_db_path}' were embedded with {indexed}, but the queries are "
+                  f"embedded with {expected}. Rebuild the database with the same backend: python -m scripts.ingest "
+                  f"--embedding-backend {encoder_backend(self.embedding_llm.client)}")
+        return Chroma(persist_directory=embeddings_db_path, embedding_function=self.embedding_llm)
+
+    def index_version(self) -> str:
+        """
+        Fingerprint of both vector databases, changes whenever one of them is rebuilt or updated.
+        Uses the digest of the index manifest if available, otherwise the collection ID and size.
+        """
+        versions = []
+        for db_path, vector_index in ((self.embedding_db_path, self.vector_index),
+                                      (self.alternative_embedding_db_path, self.vector_index_alternative)):
+            versions.append(read_manifest_digest(db_path) or
+                            f"{vector_index._collection.id}:{vector_index._collection.count()}")
+        return "|".join(versions)
 
-    def retrieve_data(self, filepath: str, from_website: bool):
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
         """
-        Method to retrieve the data from the given filepath.
-        :param filepath: file path to the data
-        :param from_website: whether the data is from a website or QA set
-        :return: nothing, appends the documents to the docs list
+        Embeds the queries with the same query instruction as the vector search.
+        Repeated questions are served from the query embedding cache,
+        all remaining queries are embedded in one batched forward pass.
+        :param queries: user questions
+        :return: list of query embeddings
         """
-        self.docs = []
+        keys = [normalize_query(query) for query in queries]
+        embeddings = [self.query_embedding_cache.get(key) for key in keys]
+
+        missing = {}  # normalized query -> query, duplicates within the batch are only embedded once
+        for key, query, embedding in zip(keys, queries, embeddings):
+            if embedding is None:
+                missing.setdefault(key, query)
+        if missing:
+            vectors = self.embedding_llm.embed_queries(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            for key, vector in computed.items():
+                self.query_embedding_cache.put(key, vector)
+            embeddings = [embedding if embedding is not None else computed[key]
+                          for key, embedding in zip(keys, embeddings)]
+        return embeddings
 
-        if from_website:
-            website_data = WebsiteRetriever(filepath)
-            data = website_data.get_data(pdf_included=True)
-        else:  # QA set
-            data = get_data_in_html_format(filepath)
+    def search_by_vectors(self, embeddings: List[List[float]], alternative_search: bool = False, k: int = None):
+        """
+        Searches the main or alternative Chroma collection by vector.
+        Several embeddings are sent to Chroma in a single query.
+        :param embeddings: query embeddings
+        :param alternative_search: whether to search the alternative database
+        :param k: amount of results per embedding, defaults to search_k
+        :return: for each embedding a list of (document, relevance score) tuples
+        """
+        k = k or self.search_k
+        vector_index = self.vector_index_alternative if alternative_search else self.vector_index
+        relevance_score_fn = vector_index._select_relevance_score_fn()
+        if len(embeddings) == 1:
+            results = vector_index.similarity_search_by_vector_with_relevance_scores(embeddings[0], k=k)
+            return [[(doc, relevance_score_fn(distance)) for doc, distance in results]]
 
-        for document in data:
-            self.docs.append(
-                Document(page_content=document["title"] + document["text"],
-                         metadata={"url": document["url"], "title": document["title"]})
-            )
-        print(f"Loaded {len(self.docs)} documents.")
+        results = vector_index._collection.query(query_embeddings=embeddings, n_results=k,
+                                                 include=["documents", "metadatas", "distances"])
+        return [
+            [(Document(page_content=text, metadata=metadata or {}), relevance_score_fn(distance))
+             for text, metadata, distance in zip(results["documents"][i], results["metadatas"][i],
+                                                 results["distances"][i])]
+            for i in range(len(embeddings))
+        ]
 
-    def build_vector_database(self, embeddings_db_path: str, alternative: bool = False):
+    def retrieve_candidates_batch(self, queries: List[str], alternative_search: bool = False,
+                                  embeddings: List[List[float]] = None):
         """
-        Method to build the vector database from the given documents.
-        Chunks all documents according to the amount of chars.
-        :param embeddings_db_path: path to the main or alternative database
-        :param alternative: Whether to build the alternative database
-        """
-        chunk_size = 1850
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=70,
-                                                       separators=["\n", ".", "-"])
-        chunked = text_splitter.split_documents(self.docs)
-        print(f"Chunked {len(chunked)} documents.")
-
-        if alternative:
-            self.vector_index_alternative = Chroma.from_documents(chunked, self.embedding_llm,
-                                                                  persist_directory=embeddings_db_path)
-            self.vector_index_alternative.persist()
-        else:
-            self.vector_index = Chroma.from_documents(chunked, self.embedding_llm, persist_directory=embeddings_db_path)
-            self.vector_index.persist()
+        Retrieves the reranking candidates for several queries together with their dense relevance scores.
+        With the adaptive retrieval policy, the amount of candidates depends on the relevance scores.
+        :param queries: user questions
+        :param alternative_search: whether to retrieve from the alternative database
+        :param embeddings: precomputed query embeddings, the queries are embedded if not given
+        :return: for each query a tuple of documents and their relevance scores
+        """
+        if not queries:
+            return []
+        if embeddings is None:
+            embeddings = self.embed_queries(queries)
+        policy = self.retrieval_policy
+        results = self.search_by_vectors(embeddings, alternative_search, policy.max_k if policy else None)
+        candidates = []
+        for result in results:
+            depth = policy.depth([relevance for _, relevance in result]) if policy else len(result)
+            candidates.append(([doc for doc, _ in result[:depth]], [relevance for _, relevance in result[:depth]]))
+        return candidates
 
-    def create_document_chain(self):
+    def retrieve_documents_batch(self, queries: List[str], alternative_search: bool = False,
+                                 embeddings: List[List[float]] = None) -> List[List[Document]]:
         """
-        Method to set up the document chain for the LLM model.
-        Called on initialization and in the setup method.
+        Retrieves the relevant documents for several queries with a single embedding pass and Chroma query.
+        :param queries: user questions
+        :param alternative_search: whether to retrieve from the alternative database
+        :param embeddings: precomputed query embeddings, the queries are embedded if not given
+        :return: for each query a list of documents
         """
-        prompt = PromptTemplate(
-            template="""You are a chatbot that should answer questions about the Technical University of Applied Sciences Augsburg (THA). Questions can appear in German or English. You should provide the most relevant information based on the given context and answer either in English or German depending on the user question. Answer without introduction of yourself and provide only relevant information.  Only answer questions that are related to the THA. Use the following pieces of context to answer the user question at the end. 
-CONTEXT: {context} 
-If the answer is not contained in the context, just say that you don't know, don't try to make up an answer. Answer in German, if the user question appeared in German or answer in English if the user question appeared in English!
-{chat_history} USER: {question} ASSISTANT:""",
-            input_variables=["context", "chat_history", "question"]
-        )
-        self.document_chain = create_stuff_documents_chain(llm=self.llm, prompt=prompt)
+        return [docs for docs, _ in self.retrieve_candidates_batch(queries, alternative_search, embeddings)]
 
     def retrieve_documents(self, query: str, alternative_search: bool = False):
         """
@@ -141,10 +274,100 @@ If the answer is not contained in the context, just say that you don't know, don
         :param alternative_search: whether to retrieve from the alternative database
         :return: a list of documents. A document contains the page_content and metadata
         """
-        if alternative_search:
-            return self.retriever_alternative.get_relevant_documents(query)
-        else:
-            return self.retriever.get_relevant_documents(query)
+        return self.retrieve_documents_batch([query], alternative_search)[0]
+
+    def rerank_batch(self, queries: List[str], docs_per_query: List[List[Document]],
+                     relevances_per_query: List[List[float]] = None, min_scores: List[float] = None):
+        """
+        Reranks the search results of several queries, the (query, document) pairs are scored in batches
+        over all queries.
+        If the dense relevance scores are given, the retrieval policy decides which candidates are scored:
+        only the first one if the dense order is decisive and its score settles the threshold decisions, otherwise
+        the first stage and the remaining candidates only if they could still beat the current top 3.
+        :param queries: user questions
+        :param docs_per_query: retrieved documents for each query
+        :param relevances_per_query: dense relevance scores of the documents, sorted in descending order
+        :param min_scores: for each query the threshold its top score is compared with, e.g. rag_threshold,
+               a decisive first candidate that scores below it does not skip the other candidates
+        :return: for each query a tuple of reranked documents and their scores,
+                 candidates that were not scored follow in dense order with the score None
+        """
+        policy = self.retrieval_policy if relevances_per_query is not None else None
+        if relevances_per_query is None:
+            relevances_per_query = [[0.0] * len(docs) for docs in docs_per_query]
+
+        candidates = []  # for each query the unique (document, relevance) pairs in dense order
+        for docs, relevances in zip(docs_per_query, relevances_per_query):
+            unique = []
+            for doc, relevance in zip(docs, relevances):
+                if all(doc != other for other, _ in unique):
+                    unique.append((doc, relevance))
+            candidates.append(unique)
+
+        scores = [[] for _ in queries]  # scores of the first len(scores[i]) candidates of query i
+        first_stage = [policy.plan([relevance for _, relevance in unique]) if policy else len(unique)
+                       for unique in candidates]
+        self._score_candidates(queries, candidates, scores, first_stage)
+        if policy:
+            second_stage = []
+            direct_answer_threshold = self.direct_answer_threshold if self.direct_answer_index is not None else None
+            for i, unique in enumerate(candidates):
+                # a decisive first candidate that scores below a threshold could still be beaten by the others
+                decisive = policy.is_decisive([relevance for _, relevance in unique]) and (
+                    not scores[i] or policy.confirms(scores[i][0], min_scores[i] if min_scores else None,
+                                                     direct_answer_threshold))
+                scored, remaining = unique[:len(scores[i])], unique[len(scores[i]):]
+                if decisive or policy.can_exit(scores[i], [relevance for _, relevance in scored],
+                                               [relevance for _, relevance in remaining]):
+                    second_stage.append(len(scores[i]))
+                else:
+                    second_stage.append(len(unique))
+            self._score_candidates(queries, candidates, scores, second_stage)
+
+        results = []
+        for unique, query_scores in zip(candidates, scores):
+            sorted_docs = sorted(zip(query_scores, [doc for doc, _ in unique]), key=lambda i: i[0], reverse=True)
+            sorted_docs += [(None, doc) for doc, _ in unique[len(query_scores):]]
+            # Use a maximum of eight documents for reranking
+            results.append(([doc for _, doc in sorted_docs][0:8], [score for score, _ in sorted_docs][0:8]))
+        return results
+
+    def _score_candidates(self, queries: List[str], candidates: list, scores: List[List[float]], limits: List[int]):
+        """
+        Scores the candidates of all queries up to the given limits in one cross-encoder batch.
+        """
+        pairs, owners = [], []
+        for i, (query, unique) in enumerate(zip(queries, candidates)):
+            for doc, _ in unique[len(scores[i]):limits[i]]:
+                pairs.append([query, doc.page_content])
+                owners.append(i)
+        for i, score in zip(owners, self.score_pairs(pairs)):
+            scores[i].append(score)
+
+    def score_pairs(self, pairs: List[List[str]]) -> List[float]:
+        """
+        Scores (query, document) pairs with the cross-encoder, cached scores are reused.
+        :param pairs: list of [query, document] pairs
+        :return: list of scores in the order of the pairs
+        """
+        if not pairs:
+            return []
+        if self.score_cache is None:
+            return self.reranker.predict(pairs, batch_size=self.reranking_batch_size)
+        model = f"{self.reranking_model}:{self.reranker.backend}"
+        keys = [score_key(model, query, doc) for query, doc in pairs]
+        scores = self.score_cache.get_many(keys)
+        missing = {}  # key -> pair, duplicates are only scored once
+        for key, pair, score in zip(keys, pairs, scores):
+            if score is None:
+                missing.setdefault(key, pair)
+        if missing:
+            start = time.perf_counter()
+            computed = dict(zip(missing.keys(),
+                                self.reranker.predict(list(missing.values()), batch_size=self.reranking_batch_size)))
+            self.score_cache.put_many(computed, time.perf_counter() - start)
+            scores = [score if score is not None else computed[key] for key, score in zip(keys, scores)]
+        return scores
 
     def rerank_search_results(self, query: str, docs: list[Document]):
         """
@@ -153,52 +376,182 @@ If the answer is not contained in the context, just say that you don't know, don
         :param docs: retrieved documents
         :return: reranked documents and their scores
         """
-        unique_docs, pairs = [], []
-        for doc in docs:
-            if doc not in unique_docs:
-                unique_docs.append(doc)
-        cross_encoder = CrossEncoder(self.reranking_model, max_length=512)
-        for doc in unique_docs:
-            pairs.append([query, doc.page_content])
+        return self.rerank_batch([query], [docs])[0]
 
-        scores = cross_encoder.predict(pairs)
-
-        sorted_docs = list(zip(scores, unique_docs))
-        sorted_docs.sort(key=lambda i: i[0], reverse=True)
-        # Use a maximum of eight documents for reranking
-        reranked_docs = [doc for _, doc in sorted_docs][0:8]
-        scores = [score for score, _ in sorted_docs][0:8]
-        return reranked_docs, scores
-
-    def generate_response(self, query: str, docs: list[Document], chat_history):
+    def format_chat_history(self, chat_history) -> str:
         """
-        Generates a response based on the given query and documents.
-        Also includes the chat history and skips long answers within the history.
-        :param chat_history: last conversation messages as string
-        :param query: user input
-        :param docs: reranked docs
-        :return: dict containing the answer and context
+        Formats the chat history as string for the prompt and skips long answers within the history.
+        :param chat_history: last conversation messages
+        :return: the chat history as string
         """
         history_str = ""
         question = ""
-        
+
         for message in chat_history:
             text = message.message.replace("\n", " ")
             if len(text.split(" ")) > 350:
                 continue
-            
+
             if message.origin == "human":
                 question = f"USER: {text}"
             elif message.origin == "ai":
                 if question != "":
                     history_str += f"{question} ASSISTANT: {text}\n"
                     question = ""
-        
+        return history_str
+
+    def generation_prompt(self, query: str, docs: list[Document], chat_history) -> str:
+        """
+        Builds the prompt of the LLM, only the three best documents are used as context.
+        The context is compressed to the most relevant sentences if context compression is enabled.
+        """
         context = docs[0:3]
-        return self.document_chain.invoke({"context": context, "chat_history": history_str, "question": query})
+        if self.context_compressor is not None:
+            context = self.context_compressor.compress(query, context)
+        return build_prompt(context, self.format_chat_history(chat_history), query)
+
+    def generate_response(self, query: str, docs: list[Document], chat_history):
+        """
+        Generates a response based on the given query and documents.
+        Also includes the chat history and skips long answers within the history.
+        :param chat_history: last conversation messages as string
+        :param query: user input
+        :param docs: reranked docs
+        :return: the generated answer
+        """
+        return self.llm.generate(self.generation_prompt(query, docs, chat_history))
+
+    def stream_generate_response(self, query: str, docs: list[Document], chat_history) -> Iterator[str]:
+        """
+        Same as generate_response, but yields the answer token by token as soon as Ollama produces them.
+        :param chat_history: last conversation messages as string
+        :param query: user input
+        :param docs: reranked docs
+        :return: iterator over the generated text chunks
+        """
+        yield from self.llm.stream(self.generation_prompt(query, docs, chat_history))
+
+    def select_context(self, relevant_docs: List[Document], reranked_docs: List[Document], scores: List[float],
+                       alternative: bool, chat_history, rag_alternative_threshold: float,
+                       direct_answer: Optional[DirectAnswer] = None):
+        """
+        Decides which context is used for the generation based on the reranking scores.
+        :param relevant_docs: retrieved documents
+        :param reranked_docs: reranked documents
+        :param scores: reranking scores
+        :param alternative: whether the documents were retrieved from the alternative database
+        :param chat_history: simple list of past conversation
+        :param rag_alternative_threshold: see prepare_response
+        :param direct_answer: stored answer of a QA pair that matches the query
+        :return: tuple of (context docs, chat history used for generation, ResponseMetadata)
+        """
+        similarity_score = scores[0]
+        if direct_answer is not None:
+            return reranked_docs, chat_history, ResponseMetadata(relevant_docs, reranked_docs,
+                                                                 f"Direct answer: {similarity_score}", direct_answer)
+        if alternative and similarity_score < rag_alternative_threshold:
+            # answer without context, the documents are not modified because they may be shared
+            empty_doc = Document(page_content="", metadata={"url": "https://tha.de/", "title": "THA Website"})
+            return [empty_doc], [], ResponseMetadata(["none"], [empty_doc], f"Out of scope: {similarity_score}")
+        return reranked_docs, chat_history, ResponseMetadata(relevant_docs, reranked_docs,
+                                                             f"Similarity score: {similarity_score}")
+
+    def prepare_responses(self, queries: List[str], chat_histories: list,
+                          rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0,
+                          speculative: bool = None, cancelled: threading.Event = None, timings: dict = None):
+        """
+        Runs retrieval and reranking for several queries at once and decides which context is used for the generation.
+        Every stage is batched over all queries and the queries are only embedded once for both databases.
+        :param queries: user questions
+        :param chat_histories: simple list of past conversation for each query
+        :param rag_threshold: threshold value for the confidence score,
+               at which score the alternative database should be invoked
+        :param rag_alternative_threshold: threshold value for the confidence score,
+               at which score the chatbot should answer with no context.
+        :param speculative: whether to search both databases in parallel instead of searching the alternative
+               database only for low scoring queries, defaults to the speculative_retrieval setting
+        :param cancelled: event that stops the retrieval before the next stage, e.g. if Rasa answers the queries
+        :param timings: dict that receives the (start, end) perf_counter times of the embed, search and rerank stages
+        :return: for each query a tuple of (context docs, chat history used for generation, ResponseMetadata),
+                 None if the retrieval was cancelled
+        """
+        if speculative is None:
+            speculative = self.speculative_retrieval
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        embeddings = self.embed_queries(queries)
+        timings["embed"] = (start, time.perf_counter())
+        if cancelled is not None and cancelled.is_set():
+            return None
+
+        if speculative:
+            # search both databases in parallel and rerank all candidates in a single cross-encoder batch
+            primary = self.executor.submit(self.retrieve_candidates_batch, queries, False, embeddings)
+            alternative = self.executor.submit(self.retrieve_candidates_batch, queries, True, embeddings)
+            candidates, alternative_candidates = primary.result(), alternative.result()
+            timings["search"] = (timings["embed"][1], time.perf_counter())
+            if cancelled is not None and cancelled.is_set():
+                return None
+            relevant_docs = [docs for docs, _ in candidates]
+            alternative_docs = [docs for docs, _ in alternative_candidates]
+            ranked_all = self.rerank_batch(queries + queries, relevant_docs + alternative_docs,
+                                           [relevances for _, relevances in candidates + alternative_candidates],
+                                           [rag_threshold] * len(queries) + [rag_alternative_threshold] * len(queries))
+            ranked, alternative_ranked = ranked_all[:len(queries)], ranked_all[len(queries):]
+            fallback = [i for i, (_, scores) in enumerate(ranked) if scores[0] < rag_threshold]
+            for i in fallback:
+                relevant_docs[i], ranked[i] = alternative_docs[i], alternative_ranked[i]
+        else:
+            candidates = self.retrieve_candidates_batch(queries, embeddings=embeddings)
+            timings["search"] = (timings["embed"][1], time.perf_counter())
+            if cancelled is not None and cancelled.is_set():
+                return None
+            relevant_docs = [docs for docs, _ in candidates]
+            ranked = self.rerank_batch(queries, relevant_docs, [relevances for _, relevances in candidates],
+                                       [rag_threshold] * len(queries))
+            fallback = [i for i, (_, scores) in enumerate(ranked) if scores[0] < rag_threshold]
+            if fallback:
+                fallback_queries = [queries[i] for i in fallback]
+                alternative_candidates = self.retrieve_candidates_batch(fallback_queries, True,
+                                                                        [embeddings[i] for i in fallback])
+                alternative_ranked = self.rerank_batch(fallback_queries, [docs for docs, _ in alternative_candidates],
+                                                       [relevances for _, relevances in alternative_candidates],
+                                                       [rag_alternative_threshold] * len(fallback))
+                for i, (docs, _), result in zip(fallback, alternative_candidates, alternative_ranked):
+                    relevant_docs[i], ranked[i] = docs, result
+
+        direct_answers = [None] * len(queries)
+        if self.direct_answer_index is not None:
+            for i in range(len(queries)):
+                if i not in fallback:
+                    direct_answers[i] = self.direct_answer_index.match(queries[i], embeddings[i], ranked[i][0][0],
+                                                                       ranked[i][1][0])
+        timings["rerank"] = (timings["search"][1], time.perf_counter())
+
+        return [self.select_context(relevant_docs[i], ranked[i][0], ranked[i][1], i in fallback,
+                                    chat_histories[i], rag_alternative_threshold, direct_answers[i])
+                for i in range(len(queries))]
+
+    def prepare_response(self, query: str, chat_history,
+                         rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0,
+                         cancelled: threading.Event = None, timings: dict = None):
+        """
+        Runs retrieval and reranking and decides which context is used for the generation.
+        :param query: user question
+        :param chat_history: simple list of past conversation
+        :param rag_threshold: see prepare_responses
+        :param rag_alternative_threshold: see prepare_responses
+        :param cancelled: see prepare_responses
+        :param timings: see prepare_responses
+        :return: tuple of (context docs, chat history used for generation, ResponseMetadata),
+                 None if the retrieval was cancelled
+        """
+        prepared = self.prepare_responses([query], [chat_history], rag_threshold, rag_alternative_threshold,
+                                          cancelled=cancelled, timings=timings)
+        return prepared[0] if prepared is not None else None
 
     def get_response(self, query: str, chat_history,
-                     rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0):
+                     rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0, prepared: tuple = None):
         """
         Main method to generate the response from the user question.
         :param query: user question
@@ -208,24 +561,58 @@ If the answer is not contained in the context, just say that you don't know, don
         :param rag_alternative_threshold: threshold value for the confidence score,
                at which score the chatbot should answer with no context.
                This is implemented to avoid hallucinated answers.
+        :param prepared: result of prepare_response if the retrieval already ran, e.g. speculatively
         :return: the answer, context and the reranked documents
         """
+        docs, history, metadata = prepared or self.prepare_response(query, chat_history, rag_threshold,
+                                                                    rag_alternative_threshold)
+        if metadata.direct_answer is not None:  # the question is part of the QA set, no generation needed
+            return metadata.direct_answer.answer, metadata.relevant_docs, metadata.reranked_docs, metadata.confidence
+        response = self.generate_response(query, docs, history)
+        return response, metadata.relevant_docs, metadata.reranked_docs, metadata.confidence
 
-        relevant_docs: List[Document] = self.retrieve_documents(query)
-        reranked_docs, scores = self.rerank_search_results(query, relevant_docs)
-        
-        if scores[0] < rag_threshold:
-            relevant_docs: List[Document] = self.retrieve_documents(query, alternative_search=True)
-            reranked_docs, scores_alternative = self.rerank_search_results(query, relevant_docs)
-            similarity_score = scores_alternative[0]
-            if scores_alternative[0] < rag_alternative_threshold:
-                reranked_docs[0].page_content = ""
-                reranked_docs[0].metadata = {"url": "https://tha.de/", "title": "THA Website"}
-                response = self.generate_response(query, [reranked_docs[0]], [])
-                return response, ["none"], [reranked_docs[0]], f"Out of scope: {similarity_score}"
-            else:
-                response = self.generate_response(query, reranked_docs, chat_history)
+    def get_responses(self, queries: List[str], chat_histories: list = None,
+                      rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0, max_concurrency: int = 4):
+        """
+        Batched version of get_response, e.g. for offline evaluation or several concurrent users.
+        Retrieval and reranking are batched over all queries, the generation requests are sent to Ollama
+        with at most max_concurrency parallel requests.
+        :param queries: user questions
+        :param chat_histories: simple list of past conversation for each query, no history if not given
+        :param rag_threshold: see get_response
+        :param rag_alternative_threshold: see get_response
+        :param max_concurrency: maximum amount of parallel generation requests
+        :return: for each query a tuple of (answer, relevant_docs, reranked_docs, similarity_score)
+        """
+        if chat_histories is None:
+            chat_histories = [[] for _ in queries]
+        prepared = self.prepare_responses(queries, chat_histories, rag_threshold, rag_alternative_threshold)
+        generate = [i for i, (_, _, metadata) in enumerate(prepared) if metadata.direct_answer is None]
+        generated = self.llm.generate_batch([self.generation_prompt(queries[i], prepared[i][0], prepared[i][1])
+                                             for i in generate], max_concurrency)
+        answers = [metadata.direct_answer.answer if metadata.direct_answer is not None else None
+                   for _, _, metadata in prepared]
+        for i, answer in zip(generate, generated):
+            answers[i] = answer
+        return [(answer, metadata.relevant_docs, metadata.reranked_docs, metadata.confidence)
+                for answer, (_, _, metadata) in zip(answers, prepared)]
+
+    def stream_response(self, query: str, chat_history,
+                        rag_threshold: float = 5.0, rag_alternative_threshold: float = -2.0, prepared: tuple = None):
+        """
+        Streaming version of get_response.
+        Yields the answer as text chunks while it is generated and a ResponseMetadata record as last element.
+        :param query: user question
+        :param chat_history: simple list of past conversation
+        :param rag_threshold: see get_response
+        :param rag_alternative_threshold: see get_response
+        :param prepared: see get_response
+        :return: iterator over text chunks followed by the ResponseMetadata
+        """
+        docs, history, metadata = prepared or self.prepare_response(query, chat_history, rag_threshold,
+                                                                    rag_alternative_threshold)
+        if metadata.direct_answer is not None:
+            yield metadata.direct_answer.answer
         else:
-            similarity_score = scores[0]
-            response = self.generate_response(query, reranked_docs, chat_history)
-        return response, relevant_docs, reranked_docs, f"Similarity score: {similarity_score}"
+            yield from self.stream_generate_response(query, docs, history)
+        yield metadata
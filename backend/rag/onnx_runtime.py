@@ -0,0 +1,225 @@
+import inspect
+import os
+import shutil
+from typing import List, Optional
+
+import numpy as np
+
+"""
+ONNX Runtime inference for the transformer models of the RAG pipeline on CPU.
+Models are exported once with torch, dynamically quantized to int8 and stored in backend/rag/onnx/.
+onnxruntime is optional, the export and the int8 quantization also need the onnx package. Callers fall back to the
+torch models with a warning if one of them is not installed or the export fails.
+"""
+
+ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx")
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def onnx_model_dir(model_name: str, quantize: bool = True) -> str:
+    """
+    :return: folder of the exported model, e.g. backend/rag/onnx/intfloat--multilingual-e5-large-int8
+    """
+    return os.path.join(ONNX_DIR, model_name.replace("/", "--") + ("-int8" if quantize else "-fp32"))
+
+
+def export_onnx(model_name: str, output_dir: str, model_class: str = "AutoModel", output_name: str = "output",
+                quantize: bool = True, opset: int = 14) -> str:
+    """
+    Exports a Hugging Face model to ONNX with dynamic batch and sequence axes and optionally quantizes the weights
+    of the exported model to int8.
+    :param model_name: name of the model on Hugging Face
+    :param output_dir: folder for the model.onnx file and the tokenizer
+    :param model_class: transformers class used to load the model, e.g. AutoModelForSequenceClassification
+    :param output_name: name of the first output of the model, the last hidden state or the logits
+    :param quantize: whether to apply dynamic int8 quantization
+    :param opset: ONNX opset version
+    :return: path to the exported model
+    """
+    import torch
+    import transformers
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+    model = getattr(transformers, model_class).from_pretrained(model_name).eval()
+
+    # BERT models like the cross-encoder also need the token type IDs, XLM-RoBERTa models like e5 do not
+    input_names = [name for name in INPUT_NAMES if name in tokenizer.model_input_names]
+
+    class FirstOutput(torch.nn.Module):  # ModelOutput objects cannot be exported, only the tensor is needed
+        def __init__(self, wrapped):
+            super().__init__()
+            self.wrapped = wrapped
+
+        def forward(self, *inputs):
+            return self.wrapped(**dict(zip(input_names, inputs)))[0]
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+    model.config.save_pretrained(output_dir)
+    model_path = os.path.join(output_dir, "model.onnx")
+    # big models store the fp32 weights as external data files next to the graph, they get a folder of their own
+    fp32_dir = os.path.join(output_dir, "fp32")
+    fp32_path = os.path.join(fp32_dir, "model.onnx") if quantize else model_path
+    os.makedirs(os.path.dirname(fp32_path), exist_ok=True)
+    dummy = tokenizer(["query: warmup"], ["passage: warmup"], return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes[output_name] = {0: "batch"}
+    # the TorchScript exporter supports dynamic_axes, newer torch versions default to the dynamo exporter
+    exporter = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(FirstOutput(model), tuple(dummy[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=[output_name], dynamic_axes=dynamic_axes,
+                          opset_version=opset, **exporter)
+    if quantize:
+        quantize_dynamic(fp32_path, model_path, weight_type=QuantType.QInt8)
+        shutil.rmtree(fp32_dir)
+    print(f"Exported '{model_name}' to '{model_path}'.")
+    return model_path
+
+
+def create_session(model_path: str, threads: Optional[int] = None):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+
+def length_sorted_batches(lengths: List[int], batch_size: int) -> List[List[int]]:
+    """
+    Groups indices of inputs with similar token lengths, so every batch is only padded to its own longest input.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def pad_batch(encodings: dict, indices: List[int], pad_id: int, input_names: List[str]) -> dict:
+    """
+    Pads the given rows of a tokenizer output to the longest row among them.
+    :param encodings: tokenizer output without padding, dict of input name -> list of token ID lists
+    :param indices: rows of the batch
+    :param pad_id: ID of the padding token
+    :param input_names: inputs of the ONNX model
+    :return: dict of input name -> int64 matrix, the feed of the session
+    """
+    width = max(len(encodings["input_ids"][i]) for i in indices)
+    feed = {"input_ids": np.full((len(indices), width), pad_id, dtype=np.int64),
+            "attention_mask": np.zeros((len(indices), width), dtype=np.int64),
+            "token_type_ids": np.zeros((len(indices), width), dtype=np.int64)}
+    for row, i in enumerate(indices):
+        length = len(encodings["input_ids"][i])
+        feed["input_ids"][row, :length] = encodings["input_ids"][i]
+        feed["attention_mask"][row, :length] = 1
+        if "token_type_ids" in encodings:
+            feed["token_type_ids"][row, :length] = encodings["token_type_ids"][i]
+    return {name: feed[name] for name in input_names}
+
+
+class OnnxEncoder:
+    backend = "onnx"
+
+    def __init__(self, model_dir: str, max_length: int = 512, threads: Optional[int] = None):
+        """
+        Drop-in replacement for SentenceTransformer.encode of mean pooling models like multilingual-e5-large.
+        :param model_dir: folder with the exported model.onnx and the tokenizer
+        :param max_length: maximum amount of tokens per text, longer texts are truncated
+        :param threads: amount of intra-op threads, defaults to all cores
+        """
+        from transformers import AutoTokenizer
+
+        self.model_dir = model_dir
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = create_session(os.path.join(model_dir, "model.onnx"), threads)
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, model_dir: Optional[str] = None, quantize: bool = True, **kwargs):
+        """
+        Loads the exported model, exports it first if the folder does not contain one.
+        """
+        model_dir = model_dir or onnx_model_dir(model_name, quantize)
+        if not os.path.isfile(os.path.join(model_dir, "model.onnx")):
+            export_onnx(model_name, model_dir, "AutoModel", "last_hidden_state", quantize)
+        return cls(model_dir, **kwargs)
+
+    def encode(self, sentences: List[str], batch_size: int = 32, normalize_embeddings: bool = False,
+               **kwargs) -> np.ndarray:
+        """
+        Embeds the texts with mean pooling over the attention mask.
+        Other keyword arguments of SentenceTransformer.encode are accepted and ignored.
+        :return: matrix of embeddings in the order of the texts
+        """
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size, normalize_embeddings)[0]
+        if not sentences:
+            return np.zeros((0, 0), dtype=np.float32)
+        encodings = self.tokenizer(list(sentences), truncation=True, max_length=self.max_length)
+        embeddings: List[Optional[np.ndarray]] = [None] * len(sentences)
+        for batch in length_sorted_batches([len(ids) for ids in encodings["input_ids"]], batch_size):
+            feed = pad_batch(encodings, batch, self.tokenizer.pad_token_id, self.input_names)
+            hidden = self.session.run(None, feed)[0]
+            mask = feed["attention_mask"][:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for i, vector in zip(batch, pooled):
+                embeddings[i] = vector
+        return np.stack(embeddings).astype(np.float32)
+
+
+class OnnxCrossEncoder:
+    backend = "onnx"
+
+    def __init__(self, model_dir: str, max_length: int = 512, threads: Optional[int] = None):
+        """
+        Drop-in replacement for CrossEncoder.predict of sequence classification models.
+        :param model_dir: folder with the exported model.onnx, its config and the tokenizer
+        :param max_length: maximum amount of tokens per (query, document) pair
+        :param threads: amount of intra-op threads, defaults to all cores
+        """
+        from transformers import AutoConfig, AutoTokenizer
+
+        self.model_dir = model_dir
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.config = AutoConfig.from_pretrained(model_dir)
+        self.session = create_session(os.path.join(model_dir, "model.onnx"), threads)
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        # same default activation as sentence-transformers: the one stored in the config, else sigmoid for one label
+        activation = getattr(self.config, "sbert_ce_default_activation_function", None)
+        self.sigmoid = "Sigmoid" in activation if activation else self.config.num_labels == 1
+
+    @classmethod
+    def from_pretrained(cls, model_name: str, model_dir: Optional[str] = None, quantize: bool = True, **kwargs):
+        """
+        Loads the exported model, exports it first if the folder does not contain one.
+        """
+        model_dir = model_dir or onnx_model_dir(model_name, quantize)
+        if not os.path.isfile(os.path.join(model_dir, "model.onnx")):
+            export_onnx(model_name, model_dir, "AutoModelForSequenceClassification", "logits", quantize)
+        return cls(model_dir, **kwargs)
+
+    def predict(self, pairs: List[List[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """
+        Scores the pairs in batches of similar length, every batch is only padded to its own longest pair.
+        Other keyword arguments of CrossEncoder.predict are accepted and ignored.
+        :return: scores in the order of the pairs, one row of logits per pair for models with several labels
+        """
+        if not pairs:
+            return np.zeros(0, dtype=np.float32)
+        encodings = self.tokenizer([pair[0] for pair in pairs], [pair[1] for pair in pairs],
+                                   truncation="longest_first", max_length=self.max_length)
+        scores: List[Optional[np.ndarray]] = [None] * len(pairs)
+        for batch in length_sorted_batches([len(ids) for ids in encodings["input_ids"]], batch_size):
+            logits = self.session.run(None, pad_batch(encodings, batch, self.tokenizer.pad_token_id,
+                                                      self.input_names))[0]
+            if self.sigmoid:
+                logits = 1 / (1 + np.exp(-logits))
+            for i, row in zip(batch, logits):
+                scores[i] = row
+        scores = np.stack(scores).astype(np.float32)
+        return scores[:, 0] if self.config.num_labels == 1 else scores
@@ -0,0 +1,132 @@
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from sentence_transformers import CrossEncoder
+
+"""
+Process-wide registry for the cross-encoder reranking models.
+Loading a cross-encoder from disk is far more expensive than scoring a handful of pairs, so every model is
+loaded exactly once per process and shared by all chatbot instances (e.g. all Streamlit sessions).
+The cross-encoder runs either in torch or quantized to int8 in ONNX Runtime, both implement the Reranker interface.
+"""
+
+_registry: Dict[Tuple[str, int, str, str], "Reranker"] = {}
+_registry_lock = threading.Lock()
+
+
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class Reranker(ABC):
+    backend = None
+
+    def __init__(self, model_name: str, max_length: int = 512, batch_size: int = 32, device: Optional[str] = None):
+        """
+        Interface of the reranking backends, wraps a loaded cross-encoder.
+        :param model_name: name of the reranking model
+        :param max_length: maximum amount of tokens per (query, document) pair
+        :param batch_size: default amount of pairs scored in one forward pass
+        :param device: device to run the model on, defaults to cuda if available
+        """
+        self.model_name = model_name
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.device = device or default_device()
+        self._lock = threading.Lock()  # sessions share the model, scoring is serialized per model
+
+    @abstractmethod
+    def score(self, pairs: List[List[str]], batch_size: int) -> List[float]:
+        """
+        Scores the pairs with the model of the backend, called under the lock of the reranker.
+        """
+
+    def predict(self, pairs: List[List[str]], batch_size: Optional[int] = None) -> List[float]:
+        """
+        Scores the given (query, document) pairs.
+        :param pairs: list of [query, document] pairs
+        :param batch_size: overrides the default batch size
+        :return: list of scores in the order of the pairs
+        """
+        if not pairs:
+            return []
+        with self._lock:
+            scores = self.score(pairs, batch_size or self.batch_size)
+        return [float(score) for score in scores]
+
+    def warmup(self):
+        """
+        Runs a single prediction so that the first user query does not pay for lazy initialization.
+        """
+        self.predict([["warmup", "warmup"]])
+
+
+class CrossEncoderReranker(Reranker):
+    backend = "torch"
+
+    def __init__(self, model_name: str, max_length: int = 512, batch_size: int = 32, device: Optional[str] = None):
+        """
+        Cross-encoder of sentence-transformers in torch.
+        """
+        super().__init__(model_name, max_length, batch_size, device)
+        self.model = CrossEncoder(model_name, max_length=max_length, device=self.device)
+
+    def score(self, pairs: List[List[str]], batch_size: int) -> List[float]:
+        return self.model.predict(pairs, batch_size=batch_size, show_progress_bar=False)
+
+
+class OnnxReranker(Reranker):
+    backend = "onnx"
+
+    def __init__(self, model_name: str, max_length: int = 512, batch_size: int = 32, device: Optional[str] = None):
+        """
+        Cross-encoder quantized to int8 in ONNX Runtime, always runs on the CPU.
+        Pairs are scored in batches of similar length with dynamic padding.
+        """
+        from backend.rag.onnx_runtime import OnnxCrossEncoder
+
+        super().__init__(model_name, max_length, batch_size, "cpu")
+        self.model = OnnxCrossEncoder.from_pretrained(model_name, max_length=max_length)
+
+    def score(self, pairs: List[List[str]], batch_size: int) -> List[float]:
+        return self.model.predict(pairs, batch_size=batch_size)
+
+
+RERANKING_BACKENDS = {"torch": CrossEncoderReranker, "onnx": OnnxReranker}
+
+
+def get_reranker(model_name: str, max_length: int = 512, batch_size: int = 32,
+                 device: Optional[str] = None, warmup: bool = False, backend: str = "torch") -> Reranker:
+    """
+    Returns the shared reranker for the given model, loading it on first use.
+    The ONNX backend falls back to torch with a warning if onnxruntime or onnx is not installed or the export fails.
+    :param model_name: name of the reranking model
+    :param max_length: maximum amount of tokens per pair
+    :param batch_size: default batch size, only used when the model is loaded
+    :param device: device to run the model on, defaults to cuda if available
+    :param warmup: whether to run a warmup prediction after loading
+    :param backend: "torch" or "onnx"
+    :return: the shared reranker
+    """
+    if backend not in RERANKING_BACKENDS:
+        raise ValueError(f"Unknown reranking backend '{backend}', expected one of {list(RERANKING_BACKENDS)}")
+    device = device or default_device()
+    key = (model_name, max_length, device, backend)
+    with _registry_lock:
+        reranker = _registry.get(key)
+        if reranker is None:
+            try:
+                reranker = RERANKING_BACKENDS[backend](model_name, max_length, batch_size, device)
+            except Exception as e:
+                if backend == "torch":
+                    raise
+                print(f"WARNING: reranking backend '{backend}' is not available ({type(e).__name__}: {e}), "
+                      f"falling back to torch.")
+                reranker = CrossEncoderReranker(model_name, max_length, batch_size, device)
+            if warmup:
+                reranker.warmup()
+            _registry[key] = reranker
+            print(f"Loaded reranking model '{model_name}' ({reranker.backend}) on {reranker.device}.")
+    return reranker
@@ -0,0 +1,102 @@
+from typing import List, Optional
+
+"""
+Adaptive retrieval policy based on the dense relevance scores that Chroma returns for the candidates.
+It decides how many candidates are reranked, whether the cross-encoder is needed for the order at all and when
+the scoring of the remaining candidates can stop. A decisive first candidate is only accepted if its cross-encoder
+score settles the threshold decisions, otherwise the other candidates are scored as well.
+The defaults are starting values that are not validated on data yet. python -m scripts.benchmark retrieval replays
+them and a grid around them against full reranking of the QA questions and records the agreement of the context and
+the rag_threshold decision and the reranking latency in backend/rag/retrieval_policy_eval.md, the defaults should be
+taken from that table. Until then the policy is off, set adaptive_retrieval=True in OllamaRAG to enable it.
+"""
+
+
+class RetrievalPolicy:
+    def __init__(self, min_k: int = 3, base_k: int = 5, max_k: int = 10, dominant_gap: float = 0.05,
+                 flat_spread: float = 0.015, decisive_relevance: float = 0.75, decisive_gap: float = 0.08,
+                 first_stage: int = 5, exit_score: float = 5.0, exit_margin: float = 0.03,
+                 direct_answer_margin: float = 1.0):
+        """
+        :param min_k: amount of candidates if the top result clearly dominates
+        :param base_k: amount of candidates in the normal case
+        :param max_k: amount of candidates if the dense scores are flat, also the amount retrieved from Chroma
+        :param dominant_gap: relevance gap between the first and second result from which the first dominates
+        :param flat_spread: relevance spread of the first base_k results up to which the scores count as flat
+        :param decisive_relevance: minimum relevance of the first result to skip reranking the other candidates
+        :param decisive_gap: minimum gap between the first and second result to skip reranking the others
+        :param first_stage: amount of candidates scored by the cross-encoder before the early exit is checked
+        :param exit_score: minimum cross-encoder score of the current top 3 for the early exit
+        :param exit_margin: the remaining candidates must be this much less relevant than the current top 3
+        :param direct_answer_margin: a decisive first candidate that scores up to this much below the direct answer
+               threshold is not accepted, another candidate could still be the direct answer
+        """
+        self.min_k = min_k
+        self.base_k = base_k
+        self.max_k = max_k
+        self.dominant_gap = dominant_gap
+        self.flat_spread = flat_spread
+        self.decisive_relevance = decisive_relevance
+        self.decisive_gap = decisive_gap
+        self.first_stage = first_stage
+        self.exit_score = exit_score
+        self.exit_margin = exit_margin
+        self.direct_answer_margin = direct_answer_margin
+
+    def depth(self, relevances: List[float]) -> int:
+        """
+        Chooses the amount of candidates from the dense relevance scores, sorted in descending order.
+        """
+        if len(relevances) < 2:
+            return len(relevances)
+        if relevances[0] - relevances[1] >= self.dominant_gap:
+            return min(self.min_k, len(relevances))
+        spread = relevances[0] - relevances[min(self.base_k, len(relevances)) - 1]
+        if spread <= self.flat_spread:
+            return min(self.max_k, len(relevances))
+        return min(self.base_k, len(relevances))
+
+    def is_decisive(self, relevances: List[float]) -> bool:
+        """
+        Whether the dense order is clear enough that only the first candidate has to be scored,
+        its cross-encoder score is still needed for the confidence thresholds.
+        """
+        if len(relevances) < 2:
+            return True
+        return relevances[0] >= self.decisive_relevance and relevances[0] - relevances[1] >= self.decisive_gap
+
+    def confirms(self, score: float, min_score: Optional[float] = None,
+                 direct_answer_threshold: Optional[float] = None) -> bool:
+        """
+        Whether the cross-encoder score of a decisive first candidate settles the decisions that depend on the top
+        score, the other candidates can only raise it.
+        :param score: cross-encoder score of the first candidate
+        :param min_score: threshold of the fallback decision, e.g. rag_threshold, a lower score is not accepted
+        :param direct_answer_threshold: threshold of the direct answers, a score just below it is not accepted
+        """
+        if min_score is not None and score < min_score:
+            return False
+        return direct_answer_threshold is None or not \
+            direct_answer_threshold - self.direct_answer_margin <= score < direct_answer_threshold
+
+    def can_exit(self, scores: List[float], scored_relevances: List[float],
+                 remaining_relevances: List[float]) -> bool:
+        """
+        Whether the remaining candidates cannot beat the current top 3: the top 3 score high enough and every
+        remaining candidate is clearly less relevant than all of them.
+        :param scores: cross-encoder scores of the scored candidates
+        :param scored_relevances: dense relevance of the scored candidates
+        :param remaining_relevances: dense relevance of the candidates that are not scored yet
+        """
+        if not remaining_relevances:
+            return True
+        top = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:3]
+        if len(top) < 3 or scores[top[-1]] < self.exit_score:
+            return False
+        return max(remaining_relevances) <= min(scored_relevances[i] for i in top) - self.exit_margin
+
+    def plan(self, relevances: List[float]) -> int:
+        """
+        :return: amount of candidates scored in the first stage
+        """
+        return 1 if self.is_decisive(relevances) else min(self.first_stage, len(relevances))
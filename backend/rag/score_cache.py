@@ -0,0 +1,198 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from backend.rag.embeddings import normalize_query
+
+"""
+Cache for the cross-encoder scores of (query, chunk) pairs.
+A score only depends on the query, the chunk text and the reranking model, so popular questions that hit the same
+chunks again are not scored twice. The entries are kept in an LRU dict and optionally persisted in a local SQLite
+database, so that they survive restarts of the app. All entries are dropped when the vector databases are rebuilt.
+Hits only touch the in-memory LRU, their last use is written to the database in batches together with the next
+stored scores, and the database is only pruned once it grows beyond max_size. Pending hits are flushed when the
+cache is discarded and at exit.
+"""
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def score_key(model: str, query: str, chunk: str) -> str:
+    """
+    :return: cache key of the normalized query, the chunk content and the reranking model
+    """
+    return f"{model}|{text_hash(normalize_query(query))}|{text_hash(chunk)}"
+
+
+class RerankScoreCache:
+    def __init__(self, max_size: int = 50000, db_path: Optional[str] = None, low_water: float = 0.9,
+                 touch_batch_size: int = 1024):
+        """
+        Thread-safe LRU cache for reranking scores.
+        :param max_size: maximum amount of cached scores, in memory and in the database
+        :param db_path: path to the SQLite file, the cache only lives in memory if not given
+        :param low_water: share of max_size the database is pruned to once it holds more than max_size scores
+        :param touch_batch_size: amount of hits after which their last use is written even without new scores
+        """
+        self.max_size = max_size
+        self.low_water = low_water
+        self.touch_batch_size = touch_batch_size
+        self.hits, self.misses = 0, 0
+        self.scoring_time = 0.0  # seconds spent on scoring the misses, used to estimate the saved time
+        self._entries: OrderedDict[str, float] = OrderedDict()
+        self._index_version: Optional[str] = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._touched: Dict[str, float] = {}  # key -> last use of hits that is not written to the database yet
+        self._db_size = 0  # upper bound of the amount of rows in the database
+        if db_path:
+            self._connection = sqlite3.connect(db_path, check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL, last_used REAL);
+                CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used);
+            """)
+            weakref.finalize(self, RerankScoreCache._flush_touched, self._connection, self._lock, self._touched)
+            self._db_size = self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+            rows = self._connection.execute("SELECT key, score FROM scores ORDER BY last_used DESC LIMIT ?",
+                                            (max_size,)).fetchall()
+            for key, score in reversed(rows):  # least recently used first
+                self._entries[key] = score
+
+    def set_index_version(self, index_version: str):
+        """
+        Drops all entries if the vector databases changed since the scores were cached.
+        :param index_version: fingerprint of the vector databases
+        """
+        with self._lock:
+            stored = self._index_version
+            if self._connection is not None:
+                row = self._connection.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+                stored = row[0] if row else None
+            if stored != index_version:
+                self._entries.clear()
+                self._touched.clear()
+                if self._connection is not None:
+                    self._connection.execute("DELETE FROM scores")
+                    self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('index_version', ?)",
+                                             (index_version,))
+                    self._connection.commit()
+                    self._db_size = 0
+                if stored is not None:
+                    print("Reranking score cache invalidated because the vector databases changed.")
+            self._index_version = index_version
+
+    def get_many(self, keys: List[str]) -> List[Optional[float]]:
+        """
+        :return: the cached score of every key, None for misses
+        """
+        with self._lock:
+            scores = []
+            for key in keys:
+                score = self._entries.get(key)
+                if score is not None:
+                    self._entries.move_to_end(key)
+                scores.append(score)
+            hits = [key for key, score in zip(keys, scores) if score is not None]
+            self.hits += len(hits)
+            self.misses += len(keys) - len(hits)
+            if self._connection is not None and hits:
+                now = time.time()
+                self._touched.update((key, now) for key in hits)
+                if len(self._touched) >= self.touch_batch_size:
+                    self._write_touched()
+                    self._connection.commit()
+            return scores
+
+    def _write_touched(self):
+        """
+        Writes the last use of the pending hits, the caller holds the lock and commits.
+        """
+        self._write_pending(self._connection, self._touched)
+
+    @staticmethod
+    def _write_pending(connection: sqlite3.Connection, touched: Dict[str, float]):
+        if touched:
+            connection.executemany("UPDATE scores SET last_used = ? WHERE key = ?",
+                                   [(last_used, key) for key, last_used in touched.items()])
+            touched.clear()
+
+    @staticmethod
+    def _flush_touched(connection: sqlite3.Connection, lock: threading.Lock, touched: Dict[str, float]):
+        """
+        Writes and commits the pending hits, does not reference the cache so it can run as its finalizer.
+        """
+        with lock:
+            if touched:
+                RerankScoreCache._write_pending(connection, touched)
+                connection.commit()
+
+    def _prune(self):
+        """
+        Deletes the least recently used rows down to the low-water mark once the database holds more than
+        max_size rows, the caller holds the lock and commits.
+        """
+        if self._db_size <= self.max_size:
+            return
+        self._db_size = self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        if self._db_size <= self.max_size:
+            return
+        excess = self._db_size - int(self.max_size * self.low_water)
+        self._connection.execute(
+            "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)", (excess,))
+        self._db_size -= excess
+
+    def flush(self):
+        """
+        Writes the last use of the pending hits to the database.
+        """
+        if self._connection is not None:
+            self._flush_touched(self._connection, self._lock, self._touched)
+
+    def put_many(self, scores: Dict[str, float], seconds: float = 0.0):
+        """
+        Stores the scores and evicts the least recently used entries.
+        :param scores: dict of key -> score
+        :param seconds: time spent on scoring the pairs
+        """
+        with self._lock:
+            self.scoring_time += seconds
+            for key, score in scores.items():
+                self._entries[key] = score
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self._connection is not None and scores:
+                now = time.time()
+                self._write_touched()
+                self._connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                                             [(key, score, now) for key, score in scores.items()])
+                self._db_size += len(scores)
+                self._prune()
+                self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._touched.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM scores")
+                self._connection.commit()
+                self._db_size = 0
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the amount of hits and misses, the hit rate, the current size and the estimated time
+                 saved by the hits in ms
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            per_pair = self.scoring_time / self.misses if self.misses else 0.0
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "size": len(self._entries), "saved_ms": 1000 * per_pair * self.hits}
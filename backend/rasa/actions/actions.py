@@ -1,4 +1,4 @@
-from typing import Any, Text, Dict, List
+from typing import Any, Text, Dict, List, Optional
 
 from rasa_sdk import Action, Tracker
 from rasa_sdk.events import SlotSet
@@ -386,24 +386,150 @@ spell = SpellChecker()
 spell.word_frequency.load_words(known_words)
 
 
-def studiengang_contained(links, studiengang):
-    for key in links.keys():
-        if isinstance(key, tuple):
-            for k in key:
-                if studiengang in k:
-                    return True
-        elif studiengang in key:
-            return True
-    return False
-
-
-def get_value_by_partial_key(d, partial_key):
-    for key in d:
-        if isinstance(key, tuple) and partial_key in key:
-            return d[key]
-        elif key == partial_key:
-            return d[key]
-    return None
+def edit_distance(a: str, b: str) -> int:
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions and transpositions of neighbours,
+    the same edits as the candidates of pyspellchecker.
+    """
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def deletes(word: str, max_distance: int) -> set:
+    """
+    :return: the word and all strings that result from deleting up to max_distance characters
+    """
+    result, level = {word}, {word}
+    for _ in range(max_distance):
+        level = {variant[:i] + variant[i + 1:] for variant in level for i in range(len(variant))}
+        result |= level
+    return result
+
+
+class ProgramResolver:
+    """
+    Resolves the studiengang and study_type slots to study plans, built once when the action server starts.
+    Every alias of the link dicts is flattened into a hash map, every substring of the aliases into a set and
+    the words of the aliases and known_words into a SymSpell deletion index for the spelling correction.
+    """
+
+    def __init__(self, links: Dict[tuple, dict], vocabulary: List[str], max_distance: int = 2):
+        """
+        :param links: dict of (language, study type) -> dict of alias or alias tuple -> links
+        :param vocabulary: words that are corrected to, e.g. the words of the program names
+        :param max_distance: maximum edit distance of a spelling correction
+        """
+        self.max_distance = max_distance
+        self.aliases: Dict[tuple, Dict[str, list]] = {}  # (language, study type) -> alias -> links
+        self.substrings: Dict[tuple, set] = {}  # (language, study type) -> all substrings of the aliases
+        for key, study_plans in links.items():
+            self.aliases[key], self.substrings[key] = {}, set()
+            for aliases, study_plan in study_plans.items():
+                for alias in aliases if isinstance(aliases, tuple) else (aliases,):
+                    self.aliases[key].setdefault(alias, study_plan)  # the first program with an alias wins
+                    self.substrings[key].update(alias[i:j] for i in range(len(alias) + 1)
+                                                for j in range(i, len(alias) + 1))
+
+        self.vocabulary = {word.lower() for words in vocabulary for word in words.split()}
+        for study_plans in self.aliases.values():
+            self.vocabulary.update(word for alias in study_plans for word in alias.split())
+        self.index: Dict[str, List[str]] = {}  # deleted variant -> words of the vocabulary
+        for word in self.vocabulary:
+            for variant in deletes(word, max_distance):
+                self.index.setdefault(variant, []).append(word)
+        self._corrections: Dict[str, str] = {}
+
+    def correct_word(self, word: str) -> str:
+        """
+        Corrects the word like pyspellchecker up to an edit distance of one, unless that would turn a word of the
+        program names into another word. The search in the whole dictionary up to an edit distance of two, which
+        takes seconds for long unknown words and turned e.g. "architektur" into "architecture", is replaced by the
+        deletion index of the vocabulary, ties are broken by the word frequency.
+        """
+        correction = self._corrections.get(word)
+        if correction is not None:
+            return correction
+        lower = word.lower()
+        if spell.known([word]):
+            correction = word
+        else:
+            candidates = spell.known(spell.edit_distance_1(lower))
+            if candidates and (lower not in self.vocabulary or candidates & self.vocabulary):
+                if lower in self.vocabulary:
+                    candidates &= self.vocabulary
+                correction = max(sorted(candidates), key=spell.word_usage_frequency)
+            elif lower in self.vocabulary:
+                correction = lower
+            else:
+                candidates = {candidate for variant in deletes(lower, self.max_distance)
+                              for candidate in self.index.get(variant, [])}
+                scored = [(edit_distance(lower, candidate), -spell.word_usage_frequency(candidate), candidate)
+                          for candidate in candidates]
+                scored = [item for item in scored if item[0] <= self.max_distance]
+                correction = min(scored)[2] if scored else word
+        if len(self._corrections) < 10000:
+            self._corrections[word] = correction
+        return correction
+
+    def correct(self, text: str) -> str:
+        return " ".join(self.correct_word(word) for word in text.split())
+
+    def contained(self, language: str, study_type: str, studiengang: str) -> bool:
+        """
+        :return: whether the text is part of an alias of the programs
+        """
+        return studiengang in self.substrings[(language, study_type)]
+
+    def lookup(self, language: str, study_type: str, studiengang: str) -> Optional[list]:
+        """
+        :return: links of the program with the given alias, None if there is none
+        """
+        return self.aliases[(language, study_type)].get(studiengang.lower())
+
+
+resolver = ProgramResolver({("en", "bachelor"): bachelor_links_english, ("en", "master"): master_links_english,
+                            ("de", "bachelor"): bachelor_links_german, ("de", "master"): master_links_german},
+                           known_words + bachelor_synonyms + master_synonyms)
+
+
+def find_study_plan(studiengang: Optional[str], study_type: Optional[str], language: str) -> tuple:
+    """
+    Corrects the slots and looks up the study plan.
+    :param studiengang: value of the studiengang slot
+    :param study_type: value of the study_type slot
+    :param language: "en" or "de"
+    :return: tuple of (outcome, studiengang, study_type, links), outcome is one of "ask_program", "ask_study_type",
+             "unknown_program", "not_found" or "found"
+    """
+    if studiengang:
+        studiengang = resolver.correct(studiengang)
+    if study_type:
+        study_type = resolver.correct(study_type)
+
+    if studiengang is None:
+        return "ask_program", studiengang, study_type, None
+    in_bachelor = resolver.contained(language, "bachelor", studiengang)
+    in_master = resolver.contained(language, "master", studiengang)
+    if study_type is None:
+        return ("ask_study_type" if in_bachelor or in_master else "unknown_program"), studiengang, study_type, None
+
+    if in_bachelor and not in_master:
+        study_type = "bachelor"
+    elif in_master and not in_bachelor:
+        study_type = "masters"
+    website_link = None
+    if study_type in bachelor_synonyms:
+        website_link = resolver.lookup(language, "bachelor", str(studiengang))
+    elif study_type in master_synonyms:
+        website_link = resolver.lookup(language, "master", str(studiengang))
+    return ("found" if website_link is not None else "not_found"), studiengang, study_type, website_link
 
 
 class ProvideGeneralStudyplanEnglish(Action):
@@ -413,56 +539,20 @@ class ProvideGeneralStudyplanEnglish(Action):
     def run(self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
-        studiengang = tracker.get_slot("studiengang")
-        study_type = tracker.get_slot("study_type")
-
-        # spelling correction
-        if studiengang:
-            studiengang_words = studiengang.split()
-            corrected_studiengang_words = [spell.correction(word) or word for word in studiengang_words]
-            studiengang = " ".join(corrected_studiengang_words)
-
-        if study_type:
-            study_type_words = study_type.split()
-            corrected_study_type_words = [spell.correction(word) or word for word in study_type_words]
-            study_type = " ".join(corrected_study_type_words)
-
-        if studiengang is not None:
-            if study_type is None and (studiengang_contained(bachelor_links_english, studiengang) or
-                                       studiengang_contained(master_links_english, studiengang)):
-                dispatcher.utter_message("Bachelor or master?")
-            elif study_type is not None:
-                if (studiengang_contained(bachelor_links_english, studiengang) and
-                        not studiengang_contained(master_links_english, studiengang)):
-                    study_type = "bachelor"
-                elif (studiengang_contained(master_links_english, studiengang) and
-                      not studiengang_contained(bachelor_links_english, studiengang)):
-                    study_type = "masters"
-                try:
-                    website_link = None
-                    if study_type in bachelor_synonyms:
-                        website_link = get_value_by_partial_key(bachelor_links_english, str(studiengang).lower())
-                    elif study_type in master_synonyms:
-                        website_link = get_value_by_partial_key(master_links_english, str(studiengang).lower())
-
-                    if website_link is None:
-                        dispatcher.utter_message(text="Found no study plan. Is the course name correct?")
-                        return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-
-                    else:
-                        links_text = "\n".join(website_link)
-                        dispatcher.utter_message(
-                            f"Here is the study plan for {str(study_type)} {str(studiengang).title()}:\n{links_text}")
-                        return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-                except Exception as _:
-                    dispatcher.utter_message("An unknown error occurred, please try again.")
-            else:
-                dispatcher.utter_message(text="Found no study plan. Is the course name correct?")
-                return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-
-        else:
+        outcome, studiengang, study_type, website_link = find_study_plan(tracker.get_slot("studiengang"),
+                                                                         tracker.get_slot("study_type"), "en")
+        if outcome == "ask_program":
             dispatcher.utter_message("What are you currently studying?")
-
+        elif outcome == "ask_study_type":
+            dispatcher.utter_message("Bachelor or master?")
+        elif outcome == "found":
+            links_text = "\n".join(website_link)
+            dispatcher.utter_message(
+                f"Here is the study plan for {str(study_type)} {str(studiengang).title()}:\n{links_text}")
+            return [SlotSet("study_type", None), SlotSet("studiengang", None)]
+        else:
+            dispatcher.utter_message(text="Found no study plan. Is the course name correct?")
+            return [SlotSet("study_type", None), SlotSet("studiengang", None)]
         return []
 
 
@@ -473,55 +563,23 @@ class ProvideGeneralStudyplanGerman(Action):
     def run(self, dispatcher: CollectingDispatcher,
             tracker: Tracker,
             domain: Dict[Text, Any]) -> List[Dict[Text, Any]]:
-
-        studiengang = tracker.get_slot("studiengang")
-        study_type = tracker.get_slot("study_type")
-
-        if studiengang:
-            studiengang_words = studiengang.split()
-            corrected_studiengang_words = [spell.correction(word) or word for word in studiengang_words]
-            studiengang = " ".join(corrected_studiengang_words)
-
-        if study_type:
-            study_type_words = study_type.split()
-            corrected_study_type_words = [spell.correction(word) or word for word in study_type_words]
-            study_type = " ".join(corrected_study_type_words)
-
-        if studiengang is not None:
-            if study_type is None and (studiengang_contained(bachelor_links_german, studiengang) or
-                                       studiengang_contained(master_links_german, studiengang)):
-                dispatcher.utter_message("Bachelor oder Master?")
-            elif study_type is not None:
-                if (studiengang_contained(bachelor_links_german, studiengang) and
-                        not studiengang_contained(master_links_german, studiengang)):
-                    study_type = "bachelor"
-                elif (studiengang_contained(master_links_german, studiengang) and
-                      not studiengang_contained(bachelor_links_german, studiengang)):
-                    study_type = "masters"
-                try:
-                    website_link = None
-                    if study_type in bachelor_synonyms:
-                        website_link = get_value_by_partial_key(bachelor_links_german, str(studiengang).lower())
-                    elif study_type in master_synonyms:
-                        website_link = get_value_by_partial_key(master_links_german, str(studiengang).lower())
-
-                    if website_link is None:
-                        dispatcher.utter_message(
-                            text="Studienplan nicht gefunden. Ist der Name des Studiengangs korrekt?")
-                        return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-                    else:
-                        links_text = "\n".join(website_link)
-                        dispatcher.utter_message(
-                            f"Hier ist der Studienplan für {str(study_type)} {str(studiengang).title()}:\n{links_text} ")
-                        return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-                except Exception as _:
-                    dispatcher.utter_message("Ein unbekannter Fehler ist aufgetreten, bitte versuchen Sie es erneut.")
-            else:
-                dispatcher.utter_message(text="Studiengang nicht gefunden. Ist der Name des Studiengangs korrekt?")
-                return [SlotSet("study_type", None), SlotSet("studiengang", None)]
-        else:
+        outcome, studiengang, study_type, website_link = find_study_plan(tracker.get_slot("studiengang"),
+                                                                         tracker.get_slot("study_type"), "de")
+        if outcome == "ask_program":
             dispatcher.utter_message("Was studieren Sie derzeit?")
-
+        elif outcome == "ask_study_type":
+            dispatcher.utter_message("Bachelor oder Master?")
+        elif outcome == "found":
+            links_text = "\n".join(website_link)
+            dispatcher.utter_message(
+                f"Hier ist der Studienplan für {str(study_type)} {str(studiengang).title()}:\n{links_text} ")
+            return [SlotSet("study_type", None), SlotSet("studiengang", None)]
+        elif outcome == "not_found":
+            dispatcher.utter_message(text="Studienplan nicht gefunden. Ist der Name des Studiengangs korrekt?")
+            return [SlotSet("study_type", None), SlotSet("studiengang", None)]
+        else:
+            dispatcher.utter_message(text="Studiengang nicht gefunden. Ist der Name des Studiengangs korrekt?")
+            return [SlotSet("study_type", None), SlotSet("studiengang", None)]
         return []
 
 
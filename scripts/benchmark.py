@@ -0,0 +1,1121 @@
+import argparse
+import functools
+import os
+import re
+import statistics
+import sys
+import time
+from typing import List
+
+from scripts.qa_retriever import get_data
+
+"""
+Benchmarks for the chatbot pipeline. Run from the project folder, e.g.:
+python -m scripts.benchmark batch --queries 32
+The chatbot is set up with the same models and databases as the Streamlit app.
+"""
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def load_chatbot():
+    import app.chatbot as cb
+    chatbot = cb.ChatBot()
+    chatbot.setup("intfloat-qa", "marco/em_german_mistral_v01-coherent", "intfloat/multilingual-e5-large",
+                  "cross-encoder/msmarco-MiniLM-L6-en-de-v1", "intfloat-website")
+    return chatbot
+
+
+def load_queries(amount: int):
+    """
+    Uses the questions of the question-answer set as benchmark queries.
+    """
+    questions = [question.strip() for question in get_data(os.path.join(BASE_DIR, "data/question_answer_set"))]
+    return questions[:amount]
+
+
+def report(name: str, amount: int, seconds: float):
+    print(f"{name:<12} {amount} queries in {seconds:.2f}s ({amount / seconds:.2f} queries/s)")
+
+
+def write_report(path: str, title: str, setup: List[str], header: List[str], rows: List[list]):
+    """
+    Writes an evaluation as markdown table, e.g. next to the defaults it evaluates.
+    :param setup: lines describing the evaluation set, the reference and the command
+    :param header: column names
+    :param rows: table rows, the row of the current defaults is marked by the caller
+    """
+    command = " ".join(["python -m scripts.benchmark"] + sys.argv[1:])
+    lines = [f"# {title}", "", f"Recorded {time.strftime('%Y-%m-%d')} with `{command}`.", ""]
+    lines += [f"- {line}" for line in setup] + ["", "| " + " | ".join(header) + " |",
+                                                "|" + "---|" * len(header)]
+    lines += ["| " + " | ".join(str(value) for value in row) + " |" for row in rows]
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+    print(f"Evaluation written to {path}")
+
+
+def benchmark_batch(args):
+    """
+    Compares the sequential get_response loop with the batched get_responses pipeline.
+    """
+    model = load_chatbot().model
+    model.score_cache = None  # both pipelines have to score all pairs
+    queries = load_queries(args.queries)
+
+    start = time.perf_counter()
+    for query in queries:
+        if args.retrieval_only:
+            model.prepare_response(query, [])
+        else:
+            model.get_response(query, [])
+    sequential = time.perf_counter() - start
+    report("sequential", len(queries), sequential)
+
+    start = time.perf_counter()
+    if args.retrieval_only:
+        model.prepare_responses(queries, [[] for _ in queries])
+    else:
+        model.get_responses(queries, max_concurrency=args.concurrency)
+    batched = time.perf_counter() - start
+    report("batched", len(queries), batched)
+    print(f"Speedup: {sequential / batched:.2f}x")
+
+
+def legacy_filter_text_section(retriever, section_text, toc, index):
+    """
+    Reference copy of the former PDFRetriever.filter_text_section, which compiled one regex per subchapter,
+    inserted into a list of characters and searched the next chapter twice.
+    """
+    current_title = toc[index][1]
+    next_title = toc[index + 1][1] if index + 1 < len(toc) else None
+
+    if toc[index][0] == 2:
+        new_index = index + 1
+        section_text_list = list(section_text)
+        while new_index < len(toc) and toc[new_index][0] > 2:
+            pattern_subchapters = re.compile(re.escape(toc[new_index][1].strip()), re.MULTILINE)
+            match = pattern_subchapters.search(section_text)
+            if match:
+                section_text_list.insert(match.start(), '\n\n')
+            new_index += 1
+        section_text = ''.join(section_text_list)
+
+        pattern_chapter = re.compile(re.escape(current_title.strip()), re.MULTILINE)
+        match = pattern_chapter.search(section_text)
+
+        next_chapter = retriever.find_next_chapter(toc, index)[1] \
+            if retriever.find_next_chapter(toc, index) != -1 else None
+        if next_chapter:
+            pattern_next_chapter = re.compile(re.escape(next_chapter.strip()), re.MULTILINE)
+            match_next_chapter = pattern_next_chapter.search(section_text)
+            if match:
+                section_text = section_text[match.start():]
+                if match_next_chapter:
+                    section_text = section_text[:match_next_chapter.start()]
+    elif next_title:
+        pattern_subchapters = re.compile(re.escape(next_title.strip()), re.MULTILINE)
+        match = pattern_subchapters.search(section_text)
+        if match:
+            section_text = section_text[:match.start()]
+
+    return section_text
+
+
+def benchmark_pdf(args):
+    """
+    Compares the former and the current subchapter segmentation on the biggest PDFs and checks that both
+    produce the same sections.
+    """
+    import fitz
+    from scripts.information_retriever import PDFRetriever
+
+    retriever = PDFRetriever(os.path.join(BASE_DIR, "data/pdfs"), workers=1)
+    page_counts = {}
+    for pdf_file in retriever.pdf_files:
+        with fitz.open(pdf_file) as doc:
+            page_counts[pdf_file] = doc.page_count
+    biggest = sorted(page_counts, key=page_counts.get, reverse=True)[:args.pdfs]
+
+    total_legacy, total_current = 0.0, 0.0
+    for pdf_file in biggest:
+        with fitz.open(pdf_file) as doc:
+            toc = doc.get_toc(simple=True)
+            page_texts = [doc.load_page(page).get_text() for page in range(doc.page_count)]
+        next_chapters = retriever.find_next_chapters(toc)
+        inputs = []
+        for i, (level, _, page_num) in enumerate(toc):
+            if level <= 2:
+                next_page_num = toc[next_chapters[i]][2] if next_chapters[i] != -1 else len(page_texts) - 1
+                inputs.append((i, "".join(page_texts[page] for page in range(page_num - 1, next_page_num))))
+
+        start = time.perf_counter()
+        legacy = [legacy_filter_text_section(retriever, text, toc, i) for i, text in inputs]
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        current = [retriever.filter_text_section(text, toc, i, next_chapters) for i, text in inputs]
+        current_time = time.perf_counter() - start
+
+        total_legacy, total_current = total_legacy + legacy_time, total_current + current_time
+        print(f"{retriever.extract_title(pdf_file):<60} {page_counts[pdf_file]:>4} pages, {len(inputs):>4} sections: "
+              f"{legacy_time:.3f}s -> {current_time:.3f}s, identical: {legacy == current}")
+    print(f"Total: {total_legacy:.3f}s -> {total_current:.3f}s ({total_legacy / max(total_current, 1e-9):.1f}x)")
+
+
+def benchmark_chunk(args):
+    """
+    Chunks the QA set and all PDF sections with the TokenChunker and reports the throughput.
+    """
+    from langchain_core.documents import Document
+    from scripts.chunker import TokenChunker
+    from scripts.information_retriever import PDFRetriever
+    from scripts.qa_retriever import get_data_in_html_format
+
+    documents = get_data_in_html_format(os.path.join(BASE_DIR, "data/"))
+    for doc_title, sections in PDFRetriever(os.path.join(BASE_DIR, "data/pdfs")).process_pdfs().items():
+        documents.extend({"title": f"{doc_title} - {section_title}", "text": text.strip(), "url": ""}
+                         for section_title, text in sections.items())
+    docs = [Document(page_content=document["text"], metadata={"url": document["url"], "title": document["title"]})
+            for document in documents]
+
+    chunker = TokenChunker(overlap=args.overlap)
+    start = time.perf_counter()
+    chunks = chunker.chunk_documents(docs)
+    duration = time.perf_counter() - start
+
+    lengths = [len(ids) for ids in chunker.tokenizer([chunker.passage_prefix + chunk.page_content for chunk in chunks])
+               ["input_ids"]]
+    characters = sum(len(doc.page_content) for doc in docs)
+    print(f"{len(docs)} documents, {characters / 1e6:.1f}M characters -> {len(chunks)} chunks in {duration:.2f}s "
+          f"({characters / 1e6 / duration:.2f}M characters/s)")
+    print(f"Embedding tokens per chunk: mean {sum(lengths) / len(lengths):.0f}, max {max(lengths)} "
+          f"(budget {chunker.max_tokens})")
+
+
+def benchmark_embedding(args):
+    """
+    Compares the embedding backends on the QA set: cosine agreement between the torch (fp32) and ONNX (int8)
+    vectors, recall of the answer of a question among all answers and the latency of a single query.
+    :return: exit code 1 if the ONNX backend is not available or the parity is below the tolerances
+    """
+    import numpy as np
+    from backend.rag.embeddings import E5Embeddings, encoder_backend, load_encoder
+
+    data = get_data(os.path.join(BASE_DIR, "data/question_answer_set"))
+    questions, answers = list(data.keys())[:args.queries], list(data.values())[:args.queries]
+    vectors, recalls = {}, {}
+    for backend in ["torch", "onnx"]:
+        encoder = load_encoder(args.model, backend, device="cpu")
+        if encoder_backend(encoder) != backend:
+            print(f"Backend '{backend}' is not available, skipped.")
+            continue
+        embeddings = E5Embeddings(encoder)
+        embeddings.embed_query("warmup")
+
+        start = time.perf_counter()
+        passages = np.array(embeddings.embed_documents(answers))
+        passage_time = time.perf_counter() - start
+        queries = np.array(embeddings.embed_queries(questions))
+        latencies = []
+        for question in questions[:args.latency_queries]:
+            start = time.perf_counter()
+            embeddings.embed_query(question)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        ranking = np.argsort(-(queries @ passages.T), axis=1)
+        recall = {k: np.mean([i in ranking[i, :k] for i in range(len(questions))]) for k in (1, 5)}
+        vectors[backend], recalls[backend] = (queries, passages), recall
+        print(f"{backend:<6} recall@1 {recall[1]:.3f}, recall@5 {recall[5]:.3f}, "
+              f"query latency p50 {np.percentile(latencies, 50):.1f}ms, p95 {np.percentile(latencies, 95):.1f}ms, "
+              f"{len(answers) / passage_time:.1f} passages/s")
+
+    if len(vectors) != 2:
+        print("FAILED: parity not checked, both backends are needed.")
+        return 1
+    checks = []
+    for name, i in (("queries", 0), ("passages", 1)):
+        cosine = (vectors["torch"][i] * vectors["onnx"][i]).sum(axis=1)
+        print(f"Cosine agreement of the {name}: mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+        checks += [(f"mean cosine of the {name} < {args.min_mean_cosine}", cosine.mean() >= args.min_mean_cosine),
+                   (f"min cosine of the {name} < {args.min_cosine}", cosine.min() >= args.min_cosine)]
+    for k in (1, 5):
+        drop = recalls["torch"][k] - recalls["onnx"][k]
+        checks.append((f"recall@{k} drop > {args.max_recall_drop}", drop <= args.max_recall_drop))
+    failures = [name for name, passed in checks if not passed]
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        return 1
+    print("Parity within the tolerances.")
+    return 0
+
+
+def benchmark_reranker(args):
+    """
+    Compares the reranking backends on queries derived from the QA set. Every question is paired with its own answer
+    and randomly drawn other answers. Reports the ranking parity of the ONNX scores with the torch scores and the
+    p50/p95 latency of scoring the candidates of one query on the CPU.
+    :return: exit code 1 if the ONNX backend is not available or the parity is below the tolerances
+    """
+    import random
+    import numpy as np
+    from backend.rag.reranker import RERANKING_BACKENDS
+
+    data = get_data(os.path.join(BASE_DIR, "data/question_answer_set"))
+    questions, answers = list(data.keys()), list(data.values())
+    rng = random.Random(0)
+    samples = []
+    for i in rng.sample(range(len(questions)), min(args.queries, len(questions))):
+        candidates = [answers[i]] + rng.sample(answers[:i] + answers[i + 1:], args.candidates - 1)
+        samples.append([[questions[i], candidate] for candidate in candidates])
+
+    scores = {}
+    for backend, reranker_class in RERANKING_BACKENDS.items():
+        try:
+            reranker = reranker_class(args.model, max_length=512, device="cpu")
+        except Exception as e:
+            print(f"Backend '{backend}' is not available ({e}), skipped.")
+            continue
+        reranker.warmup()
+        latencies, scores[backend] = [], []
+        for pairs in samples:
+            start = time.perf_counter()
+            scores[backend].append(np.array(reranker.predict(pairs)))
+            latencies.append((time.perf_counter() - start) * 1000)
+        top1 = np.mean([np.argmax(query_scores) == 0 for query_scores in scores[backend]])
+        print(f"{backend:<6} {len(samples)} queries x {args.candidates} candidates: latency p50 "
+              f"{np.percentile(latencies, 50):.1f}ms, p95 {np.percentile(latencies, 95):.1f}ms, "
+              f"own answer ranked first {top1:.3f}")
+
+    if len(scores) == 2:
+        def ranks(values):
+            return np.argsort(np.argsort(-values))
+
+        spearman = [np.corrcoef(ranks(torch_scores), ranks(onnx_scores))[0, 1]
+                    for torch_scores, onnx_scores in zip(scores["torch"], scores["onnx"])]
+        same_top1 = np.mean([np.argmax(torch_scores) == np.argmax(onnx_scores)
+                             for torch_scores, onnx_scores in zip(scores["torch"], scores["onnx"])])
+        same_top3 = np.mean([set(np.argsort(-torch_scores)[:3]) == set(np.argsort(-onnx_scores)[:3])
+                             for torch_scores, onnx_scores in zip(scores["torch"], scores["onnx"])])
+        difference = np.concatenate([np.abs(torch_scores - onnx_scores)
+                                     for torch_scores, onnx_scores in zip(scores["torch"], scores["onnx"])])
+        same_decision = np.mean([(torch_scores.max() > args.threshold) == (onnx_scores.max() > args.threshold)
+                                 for torch_scores, onnx_scores in zip(scores["torch"], scores["onnx"])])
+        print(f"Parity: same top 1 {same_top1:.3f}, same top 3 {same_top3:.3f}, "
+              f"mean Spearman {np.mean(spearman):.4f}, score difference mean {difference.mean():.3f} "
+              f"max {difference.max():.3f}, same decision at threshold {args.threshold} {same_decision:.3f}")
+        failures = [name for name, passed in (
+            (f"same top 1 < {args.min_top1}", same_top1 >= args.min_top1),
+            (f"mean Spearman < {args.min_spearman}", np.mean(spearman) >= args.min_spearman),
+            (f"mean score difference > {args.max_difference}", difference.mean() <= args.max_difference),
+            (f"same decision < {args.min_decision}", same_decision >= args.min_decision)) if not passed]
+        if failures:
+            print(f"FAILED: {', '.join(failures)}")
+            return 1
+        print("Parity within the tolerances.")
+        return 0
+    print("FAILED: parity not checked, both backends are needed.")
+    return 1
+
+
+def benchmark_retrieval(args):
+    """
+    Tunes the thresholds of the adaptive retrieval policy offline on the questions of the QA set.
+    Every question is retrieved once with the maximum depth and all candidates are scored by the cross-encoder,
+    then every policy of a small grid is replayed against these scores. Reports the scored pairs per query, the
+    reranking latency estimated from them and the agreement of the context (top 3) and of the rag_threshold decision
+    with full reranking. The defaults of RetrievalPolicy are always part of the grid, the table is written to
+    --report.
+    """
+    import itertools
+    from backend.rag.retrieval_policy import RetrievalPolicy
+
+    model = load_chatbot().model
+    model.score_cache = None  # every policy is replayed against the same scores
+    queries = load_queries(args.queries)
+    max_k = 12
+    model.retrieval_policy = None
+    candidates = model.search_by_vectors(model.embed_queries(queries), args.alternative, max_k)
+    docs = [[doc for doc, _ in result] for result in candidates]
+    relevances = [[relevance for _, relevance in result] for result in candidates]
+    full_scores, scoring_time = {}, 0.0
+    for query, query_docs in zip(queries, docs):
+        start = time.perf_counter()
+        query_scores = model.reranker.predict([[query, doc.page_content] for doc in query_docs])
+        scoring_time += time.perf_counter() - start
+        for doc, score in zip(query_docs, query_scores):
+            full_scores[(query, doc.page_content)] = score
+    ms_per_pair = 1000 * scoring_time / max(len(full_scores), 1)
+    reranker_backend = model.reranker.backend
+
+    class ReplayReranker:  # serves the precomputed scores and counts the scored pairs
+        pairs = 0
+
+        def predict(self, pairs, batch_size=None):
+            ReplayReranker.pairs += len(pairs)
+            return [full_scores[(query, text)] for query, text in pairs]
+
+    model.reranker = ReplayReranker()
+    reference = model.rerank_batch(queries, [query_docs[:model.search_k] for query_docs in docs])
+    defaults = RetrievalPolicy()
+    default_params = (defaults.dominant_gap, defaults.flat_spread, defaults.decisive_relevance, defaults.decisive_gap,
+                      defaults.exit_margin)
+    grid = set(itertools.product([0.03, 0.05, 0.08], [0.01, 0.015, 0.02], [0.7, 0.75, 0.8], [0.05, 0.08, 0.12],
+                                 [0.02, 0.03, 0.05])) | {default_params}
+    results = []
+    for dominant_gap, flat_spread, decisive_relevance, decisive_gap, exit_margin in grid:
+        model.retrieval_policy = RetrievalPolicy(base_k=model.search_k, max_k=max_k, dominant_gap=dominant_gap,
+                                                 flat_spread=flat_spread, decisive_relevance=decisive_relevance,
+                                                 decisive_gap=decisive_gap, exit_margin=exit_margin)
+        ReplayReranker.pairs = 0
+        depths = [model.retrieval_policy.depth(query_relevances) for query_relevances in relevances]
+        ranked = model.rerank_batch(queries, [query_docs[:depth] for query_docs, depth in zip(docs, depths)],
+                                    [query_relevances[:depth] for query_relevances, depth in zip(relevances, depths)],
+                                    [args.threshold] * len(queries))
+        same_context = sum(set(doc.page_content for doc in result[0][:3]) ==
+                           set(doc.page_content for doc in expected[0][:3])
+                           for result, expected in zip(ranked, reference)) / len(queries)
+        same_decision = sum((result[1][0] < args.threshold) == (expected[1][0] < args.threshold)
+                            for result, expected in zip(ranked, reference)) / len(queries)
+        results.append((ReplayReranker.pairs / len(queries), same_context, same_decision,
+                        (dominant_gap, flat_spread, decisive_relevance, decisive_gap, exit_margin)))
+
+    print(f"Full reranking: {model.search_k:.1f} pairs per query, {model.search_k * ms_per_pair:.1f} ms per query")
+    print("pairs/query  rerank ms  same top 3  same decision  dominant_gap, flat_spread, decisive_relevance, "
+          "decisive_gap, exit_margin")
+    acceptable = [result for result in results if result[2] >= args.min_agreement]
+    shown = sorted(acceptable, key=lambda r: (-r[1], r[0]))[:10]
+    shown += [result for result in results if result[3] == default_params and result not in shown]
+    rows = []
+    for pairs, same_context, same_decision, params in shown:
+        marker = " (defaults)" if params == default_params else ""
+        print(f"{pairs:>11.2f}  {pairs * ms_per_pair:>9.1f}  {same_context:>10.3f}  {same_decision:>13.3f}  "
+              f"{params}{marker}")
+        rows.append([*params, f"{pairs:.2f}", f"{pairs * ms_per_pair:.1f}", f"{same_context:.3f}",
+                     f"{same_decision:.3f}", "yes" if marker else ""])
+    if args.report:
+        write_report(args.report, "Evaluation of the RetrievalPolicy thresholds", [
+            f"Set: {len(queries)} questions of the QA set, {'alternative' if args.alternative else 'main'} database, "
+            f"up to {max_k} candidates per question.",
+            f"Reference: full reranking of the first {model.search_k} candidates, rag_threshold {args.threshold}.",
+            f"Latency: {ms_per_pair:.2f} ms per scored pair ({reranker_backend}), full reranking "
+            f"{model.search_k * ms_per_pair:.1f} ms per query.",
+            f"Shown: the best policies with a decision agreement of at least {args.min_agreement} and the defaults."],
+            ["dominant_gap", "flat_spread", "decisive_relevance", "decisive_gap", "exit_margin", "pairs/query",
+             "rerank ms", "same top 3", "same decision", "defaults"], rows)
+
+
+def benchmark_score_cache(args):
+    """
+    Replays a stream of QA questions with a Zipf-like popularity through the retrieval pipeline,
+    once without and once with the reranking score cache, and reports the hit rate and the reranking time.
+    """
+    import random
+    from backend.rag.score_cache import RerankScoreCache
+
+    model = load_chatbot().model
+    questions = load_queries(args.queries)
+    random.seed(0)
+    stream = random.choices(questions, weights=[1 / (rank + 1) for rank in range(len(questions))], k=args.requests)
+    cache = RerankScoreCache()  # in memory, the persistent cache of the app stays untouched
+    for name, score_cache in (("uncached", None), ("cached", cache)):
+        model.score_cache = score_cache
+        start = time.perf_counter()
+        for query in stream:
+            model.prepare_response(query, [])
+        report(name, len(stream), time.perf_counter() - start)
+    print(f"Reranking score cache: {cache.stats()}")
+
+
+LEGACY_PROMPT = """You are a chatbot that should answer questions about the Technical University of Applied Sciences Augsburg (THA). Questions can appear in German or English. You should provide the most relevant information based on the given context and answer either in English or German depending on the user question. Answer without introduction of yourself and provide only relevant information.  Only answer questions that are related to the THA. Use the following pieces of context to answer the user question at the end. 
+CONTEXT: {context} 
+If the answer is not contained in the context, just say that you don't know, don't try to make up an answer. Answer in German, if the user question appeared in German or answer in English if the user question appeared in English!
+{chat_history} USER: {question} ASSISTANT:"""
+
+
+def start_stub_ollama(load_seconds: float, prefill_ms: float, idle_seconds: float):
+    """
+    Starts a local HTTP server that imitates the /api/generate endpoint of Ollama.
+    Prefill costs prefill_ms per token (4 characters) that is not shared with the previous prompt, like the KV cache
+    reuse of Ollama, and the model is loaded again if it was idle for longer than its keep_alive
+    (idle_seconds if the request sets none).
+    :return: tuple of (base URL, stats dict with the amount of requests, connections and prefilled tokens)
+    """
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {"prompt": "", "loaded_until": 0.0}
+    stats = {"requests": 0, "connections": set(), "prefill_tokens": 0, "loads": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are written separately, like real servers do
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompt = request.get("prompt", "")
+            keep_alive = request.get("keep_alive")
+            with lock:
+                stats["requests"] += 1
+                stats["connections"].add(self.client_address)
+                delay = 0.0
+                if time.time() > state["loaded_until"]:
+                    delay += load_seconds
+                    stats["loads"] += 1
+                    state["prompt"] = ""
+                shared = len(os.path.commonprefix([state["prompt"], prompt]))
+                tokens = (len(prompt) - shared) // 4
+                stats["prefill_tokens"] += tokens
+                delay += tokens * prefill_ms / 1000
+                state["prompt"] = prompt
+                alive = idle_seconds if keep_alive is None else float(str(keep_alive).rstrip("m")) * 60
+                alive = float("inf") if alive < 0 else alive  # a negative keep_alive keeps the model loaded
+                state["loaded_until"] = time.time() + delay + alive
+            time.sleep(delay)
+            words = ["Die", " Antwort", " steht", " im", " Kontext", "."] if prompt else []
+            if request.get("stream", True):
+                body = "".join(json.dumps({"response": word, "done": False}) + "\n" for word in words)
+                body += json.dumps({"response": "", "done": True}) + "\n"
+            else:
+                body = json.dumps({"response": "".join(words), "done": True})
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", stats
+
+
+def benchmark_generation(args):
+    """
+    Compares the former LangChain stuff chain with the OllamaClient on prompts of QA questions,
+    with the three following QA answers as context. Uses a local stub of Ollama unless --url is given.
+    """
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    from langchain_community.llms.ollama import Ollama
+    from langchain_core.documents import Document
+    from langchain_core.prompts import PromptTemplate
+    from backend.rag.ollama_client import SYSTEM_PROMPT, OllamaClient, build_prompt
+
+    qa = list(get_data(os.path.join(BASE_DIR, "data/question_answer_set")).items())[:args.queries + 3]
+    inputs = [(question.strip(), [Document(page_content=answer) for _, answer in qa[i + 1:i + 4]])
+              for i, (question, _) in enumerate(qa[:args.queries])]
+
+    def run(name, url, generate, warmup=None):
+        stats = None
+        if url is None:
+            url, stats = start_stub_ollama(args.load_seconds, args.prefill_ms, args.idle_seconds)
+        generate = generate(url)
+        if warmup:
+            warmup(url)
+        latencies = []
+        for i, (question, docs) in enumerate(inputs):
+            if i and args.pause:
+                time.sleep(args.pause)  # quiet period between two users
+            start = time.perf_counter()
+            generate(question, docs)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        summary = f"{name:<8} mean {1000 * sum(latencies) / len(latencies):8.1f} ms, " \
+                  f"p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:8.1f} ms"
+        if stats:
+            summary += f", {stats['loads']} model loads, {stats['prefill_tokens']} prefilled tokens, " \
+                       f"{len(stats['connections'])} connections"
+        print(summary)
+
+    def legacy(url):
+        llm = Ollama(model=args.model, temperature=0.1, base_url=url)
+        prompt = PromptTemplate(template=LEGACY_PROMPT, input_variables=["context", "chat_history", "question"])
+        chain = create_stuff_documents_chain(llm=llm, prompt=prompt)
+        return lambda question, docs: chain.invoke({"context": docs, "chat_history": "", "question": question})
+
+    clients = {}
+
+    def client(url):
+        clients[url] = OllamaClient(args.model, url, num_ctx=args.num_ctx, num_predict=args.num_predict)
+        return lambda question, docs: clients[url].generate(build_prompt(docs, "", question))
+
+    run("chain", args.url, legacy)
+    run("client", args.url, client, lambda url: clients[url].warmup(SYSTEM_PROMPT))
+
+
+def start_stub_rasa(parse_ms: float, trigger_ms: float):
+    """
+    Starts a local HTTP server that imitates the parse and trigger_intent endpoints of the Rasa server.
+    Like the tracker lock of Rasa, the intents of one conversation are processed one after another.
+    :return: tuple of (base URL, stats dict with the amount of parse requests and connections)
+    """
+    import json
+    import threading
+    from collections import defaultdict
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    trackers = defaultdict(threading.Lock)
+    stats = {"parses": 0, "connections": set()}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are written separately, like real servers do
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                stats["connections"].add(self.client_address)
+                if self.path == "/model/parse":
+                    stats["parses"] += 1
+            if self.path == "/model/parse":
+                time.sleep(parse_ms / 1000)
+                body = {"text": request["text"], "intent": {"name": "greet", "confidence": 0.98}, "entities": []}
+            else:
+                with trackers[self.path.split("/")[2]]:
+                    time.sleep(trigger_ms / 1000)
+                body = {"messages": [{"recipient_id": "user", "text": f"Answer to {request['name']}"}]}
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", stats
+
+
+def benchmark_rasa(args):
+    """
+    Simulates concurrent chat sessions against a local stub of Rasa and compares the former requests calls,
+    which triggered all intents on the conversation test_id, with the pooled RasaClient.
+    The questions of the sessions are drawn with a Zipf-like popularity from the QA set.
+    """
+    import random
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from app.rasa_client import RasaClient
+
+    questions = load_queries(args.queries)
+    random.seed(0)
+    sessions = [random.choices(questions, weights=[1 / (rank + 1) for rank in range(len(questions))],
+                               k=args.messages) for _ in range(args.sessions)]
+
+    def legacy(url):
+        def answer(session_id, query):
+            response = requests.post(f"{url}/model/parse", json={"text": query, "message_id": query.strip()})
+            real_response = requests.post(f"{url}/conversations/test_id/trigger_intent", json={
+                "name": response.json()["intent"]["name"], "entities": response.json()["entities"]})
+            return real_response.json()["messages"][0]["text"]
+        return answer
+
+    clients = {}
+
+    def client(url):
+        clients[url] = RasaClient(url)
+
+        def answer(session_id, query):
+            parse_result = clients[url].parse(query)
+            return clients[url].trigger_intent(session_id, parse_result["intent"]["name"],
+                                               parse_result["entities"])[0]["text"]
+        return answer
+
+    for name, make in (("requests", legacy), ("client", client)):
+        url, stats = start_stub_rasa(args.parse_ms, args.trigger_ms)
+        answer = make(url)
+        latencies = []
+
+        def run_session(session):
+            session_id, queries = session
+            for query in queries:
+                start = time.perf_counter()
+                answer(session_id, query)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            list(executor.map(run_session, [(f"session-{i}", queries) for i, queries in enumerate(sessions)]))
+        duration = time.perf_counter() - start
+        latencies.sort()
+        print(f"{name:<8} {len(latencies) / duration:8.1f} messages/s, "
+              f"p50 {1000 * latencies[len(latencies) // 2]:6.1f} ms, "
+              f"p95 {1000 * latencies[int(0.95 * (len(latencies) - 1))]:6.1f} ms, "
+              f"{stats['parses']} parse requests, {len(stats['connections'])} connections")
+    print(f"Parse cache: {list(clients.values())[0].stats()}")
+
+
+def benchmark_router(args):
+    """
+    Evaluates the intent router on the Rasa NLU training data and the QA questions.
+    The reference is the prediction of Rasa if --rasa-url is given, otherwise the annotated intent.
+    Reports for a grid of thresholds the share of queries that skip the Rasa NLU, the accuracy of these routes
+    and the saved latency. The defaults of IntentRouter are always part of the grid, the table is written to --report.
+    """
+    import itertools
+    import requests
+    from app.intent_router import RAG, RAG_INTENTS, IntentRouter, load_nlu_examples
+    from backend.rag.embeddings import E5Embeddings, load_encoder
+
+    nlu_path = os.path.join(BASE_DIR, "backend/rasa/data/nlu.yml")
+    qa_path = os.path.join(BASE_DIR, "data/question_answer_set")
+    embeddings = E5Embeddings(load_encoder(args.model, args.backend))
+    router = IntentRouter(embeddings.embed_queries, nlu_path, qa_path)
+    defaults = (router.min_similarity, router.min_margin)
+
+    examples, _ = load_nlu_examples(nlu_path)
+    texts = [(text, intent) for intent, intent_examples in examples.items() for text in intent_examples]
+    texts += [(question.strip(), RAG) for question in get_data(qa_path)]
+    references, parse_times = [], []
+    for text, intent in texts:
+        if args.rasa_url:
+            start = time.perf_counter()
+            intent = requests.post(f"{args.rasa_url}/model/parse", json={"text": text}).json()["intent"]["name"]
+            parse_times.append(time.perf_counter() - start)
+        references.append(RAG if intent in RAG_INTENTS else intent)
+    parse_ms = 1000 * sum(parse_times) / len(parse_times) if parse_times else args.parse_ms
+
+    start = time.perf_counter()
+    query_embeddings = embeddings.embed_queries([text for text, _ in texts])
+    embed_ms = 1000 * (time.perf_counter() - start) / len(texts)
+    start = time.perf_counter()
+    for embedding in query_embeddings:
+        router.classify(embedding)
+    route_ms = 1000 * (time.perf_counter() - start) / len(texts)
+    print(f"{len(texts)} examples, Rasa parse {parse_ms:.1f} ms"
+          f"{' (measured)' if parse_times else ''}, embedding {embed_ms:.1f} ms "
+          f"(reused by the retrieval), routing {route_ms:.3f} ms per query")
+
+    print("min_similarity  min_margin  bypass  accuracy  saved ms/query")
+    rows = []
+    for min_similarity, min_margin in sorted(set(itertools.product(args.similarities, args.margins)) | {defaults}):
+        router.min_similarity, router.min_margin = min_similarity, min_margin
+        routes = [router.classify(embedding) for embedding in query_embeddings]
+        bypassed = [(route, reference) for route, reference in zip(routes, references) if route.target is not None]
+        correct = sum(route.intent == reference for route, reference in bypassed)
+        bypass, accuracy = len(bypassed) / len(texts), correct / len(bypassed) if bypassed else 0.0
+        marker = " (defaults)" if (min_similarity, min_margin) == defaults else ""
+        print(f"{min_similarity:>14.2f}  {min_margin:>10.3f}  {bypass:>6.1%}  {accuracy:>8.1%}  "
+              f"{bypass * parse_ms:>14.1f}{marker}")
+        rows.append([min_similarity, min_margin, f"{bypass:.1%}", f"{accuracy:.1%}", f"{bypass * parse_ms:.1f}",
+                     "yes" if marker else ""])
+    if args.report:
+        write_report(args.report, "Evaluation of the IntentRouter thresholds", [
+            f"Set: {len(texts)} texts, the examples of backend/rasa/data/nlu.yml and the questions of the QA set.",
+            f"Reference: {'the prediction of Rasa at ' + args.rasa_url if args.rasa_url else 'the annotated intent'}"
+            f", out_of_scope and nlu_fallback count as RAG.",
+            f"Model: {args.model} ({args.backend}).",
+            f"Latency: Rasa parse {parse_ms:.1f} ms{' (measured)' if parse_times else ' (assumed)'}, embedding "
+            f"{embed_ms:.1f} ms (reused by the retrieval), routing {route_ms:.3f} ms per query.",
+            "Accuracy: share of the bypassed texts whose route matches the reference."],
+            ["min_similarity", "min_margin", "bypass", "accuracy", "saved ms/query", "defaults"], rows)
+
+
+def start_stub_website(pages: dict, latency_ms: float):
+    """
+    Starts a local HTTP server that serves the given pages with ETag or Last-Modified validators and answers
+    conditional GETs with 304 like a real web server.
+    :param pages: dict of path -> dict with "text", "etag" and "last_modified", changes are served immediately
+    :return: tuple of (base URL, stats dict with the amount of requests, 304 responses and the maximum amount of
+             parallel requests)
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    stats = {"requests": 0, "not_modified": 0, "active": 0, "max_active": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with lock:
+                stats["requests"] += 1
+                stats["active"] += 1
+                stats["max_active"] = max(stats["max_active"], stats["active"])
+            time.sleep(latency_ms / 1000)
+            page = pages.get(self.path)
+            with lock:
+                stats["active"] -= 1
+            if page is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            etag_matches = page["etag"] and self.headers.get("If-None-Match") == page["etag"]
+            date_matches = page["last_modified"] and self.headers.get("If-Modified-Since") == page["last_modified"]
+            if etag_matches or (not self.headers.get("If-None-Match") and date_matches):
+                with lock:
+                    stats["not_modified"] += 1
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            data = page["text"].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            if page["etag"]:
+                self.send_header("ETag", page["etag"])
+            if page["last_modified"]:
+                self.send_header("Last-Modified", page["last_modified"])
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", stats
+
+
+def benchmark_fetcher(args):
+    """
+    Checks the WebsiteFetcher against a local stub web server and compares it with sequential requests.get calls.
+    A third of the pages has an ETag, a third a Last-Modified date and a third no validator. Checks that
+    revalidated pages are answered with 304 and return the stored extraction result, that changed pages and pages
+    without validator are downloaded again, that another parser_version ignores the stored extraction results and
+    that the limit of parallel requests per host holds.
+    :return: exit code 1 if a check failed
+    """
+    import requests
+    import tempfile
+    from scripts.website_fetcher import WebsiteFetcher
+
+    pages = {}
+    for i in range(args.pages):
+        validator = i % 3
+        pages[f"/page{i}"] = {"text": f"<html><body>Page {i}</body></html>",
+                              "etag": f'"v1-{i}"' if validator == 0 else None,
+                              "last_modified": "Mon, 02 Sep 2024 10:00:00 GMT" if validator == 1 else None}
+    base_url, stats = start_stub_website(pages, args.latency_ms)
+    urls = [base_url + path for path in pages]
+    validated = [base_url + path for path, page in pages.items() if page["etag"] or page["last_modified"]]
+    failures = []
+
+    def check(name: str, passed: bool):
+        print(f"{'ok    ' if passed else 'FAILED'} {name}")
+        if not passed:
+            failures.append(name)
+
+    start = time.perf_counter()
+    for url in urls:
+        requests.get(url, timeout=15)
+    sequential = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fetcher = WebsiteFetcher(cache_dir, max_workers=args.workers, max_per_host=args.per_host)
+        stats.update(requests=0, not_modified=0, max_active=0)
+        start = time.perf_counter()
+        first = fetcher.fetch_all(urls)
+        concurrent = time.perf_counter() - start
+        check("first fetch downloads every page", all(result.status_code == 200 and result.modified
+                                                      for result in first.values()))
+        check(f"at most {args.per_host} parallel requests per host", stats["max_active"] <= args.per_host)
+        for url, result in first.items():
+            fetcher.store_parsed(url, [f"parsed {result.text}"])
+
+        stats.update(requests=0, not_modified=0)
+        start = time.perf_counter()
+        second = fetcher.fetch_all(urls)
+        revalidation = time.perf_counter() - start
+        check("pages with ETag or Last-Modified are answered with 304", stats["not_modified"] == len(validated))
+        check("unmodified pages return the cached text and extraction result",
+              all(not second[url].modified and second[url].text == first[url].text and
+                  second[url].parsed == [f"parsed {first[url].text}"] for url in validated))
+        check("pages without validator are downloaded again",
+              all(second[url].modified and second[url].parsed is None for url in urls if url not in validated))
+
+        changed = validated[:2]
+        for url in changed:
+            page = pages[url[len(base_url):]]
+            page["text"] = page["text"].replace("Page", "Changed page")
+            page["etag"] = page["etag"] and page["etag"].replace("v1", "v2")
+            page["last_modified"] = page["last_modified"] and "Tue, 03 Sep 2024 10:00:00 GMT"
+        third = fetcher.fetch_all(changed)
+        check("changed pages are downloaded again without the old extraction result",
+              all(third[url].modified and "Changed page" in third[url].text and third[url].parsed is None
+                  for url in changed))
+        fourth = fetcher.fetch_all(changed)
+        check("the new version of a changed page is revalidated", all(not fourth[url].modified for url in changed))
+
+        upgraded = WebsiteFetcher(cache_dir, max_workers=args.workers, max_per_host=args.per_host,
+                                  parser_version="2")
+        fifth = upgraded.fetch_all(validated)
+        check("another parser_version ignores the cached extraction results",
+              all(not result.modified and result.parsed is None for result in fifth.values()))
+
+    print(f"{len(urls)} pages with {args.latency_ms:.0f} ms latency: sequential {sequential:.2f}s, fetcher "
+          f"{concurrent:.2f}s ({sequential / concurrent:.1f}x), revalidation {revalidation:.2f}s")
+    return 1 if failures else 0
+
+
+def legacy_find_study_plan(actions, studiengang, study_type, language, correction=None):
+    """
+    Reference copy of the former slot handling of the study plan actions: pyspellchecker on every word and linear
+    scans over the link dicts.
+    :param correction: replacement of spell.correction, e.g. a memoized one to check the parity faster
+    """
+    correction = correction or actions.spell.correction
+    def studiengang_contained(links, studiengang):
+        for key in links.keys():
+            if isinstance(key, tuple):
+                for k in key:
+                    if studiengang in k:
+                        return True
+            elif studiengang in key:
+                return True
+        return False
+
+    def get_value_by_partial_key(d, partial_key):
+        for key in d:
+            if isinstance(key, tuple) and partial_key in key:
+                return d[key]
+            elif key == partial_key:
+                return d[key]
+        return None
+
+    bachelor_links = actions.bachelor_links_english if language == "en" else actions.bachelor_links_german
+    master_links = actions.master_links_english if language == "en" else actions.master_links_german
+    if studiengang:
+        studiengang = " ".join(correction(word) or word for word in studiengang.split())
+    if study_type:
+        study_type = " ".join(correction(word) or word for word in study_type.split())
+    if studiengang is None:
+        return "ask_program", studiengang, study_type, None
+    if study_type is None:
+        if studiengang_contained(bachelor_links, studiengang) or studiengang_contained(master_links, studiengang):
+            return "ask_study_type", studiengang, study_type, None
+        return "unknown_program", studiengang, study_type, None
+    if studiengang_contained(bachelor_links, studiengang) and not studiengang_contained(master_links, studiengang):
+        study_type = "bachelor"
+    elif studiengang_contained(master_links, studiengang) and not studiengang_contained(bachelor_links, studiengang):
+        study_type = "masters"
+    website_link = None
+    if study_type in actions.bachelor_synonyms:
+        website_link = get_value_by_partial_key(bachelor_links, str(studiengang).lower())
+    elif study_type in actions.master_synonyms:
+        website_link = get_value_by_partial_key(master_links, str(studiengang).lower())
+    return ("found" if website_link is not None else "not_found"), studiengang, study_type, website_link
+
+
+class SlotTracker:
+    """
+    Minimal tracker for the actions, they only read slots.
+    """
+
+    def __init__(self, slots: dict):
+        self.slots = slots
+
+    def get_slot(self, key: str):
+        return self.slots.get(key)
+
+
+class CollectingMessages:
+    def __init__(self):
+        self.messages = []
+
+    def utter_message(self, text: str = None, **kwargs):
+        self.messages.append(text)
+
+
+def benchmark_actions(args):
+    """
+    Compares the former slot handling of the study plan actions with the ProgramResolver on every alias of the
+    link dicts and on typos of them, for every study type. Needs rasa_sdk and pyspellchecker (rasa_requirements.txt).
+    Two results are the same if the user gets the same answer: outcome, program name in title case, study type and
+    links. A case counts as fixed if the former handling did not recognize the program and the resolver does,
+    as regressed if it is the other way round or both found different links, other differences are only in the
+    wording, e.g. "master" instead of "masters".
+    """
+    import random
+    from backend.rasa.actions import actions
+
+    random.seed(0)
+    cases = []  # (kind, (studiengang, study_type, language))
+    for language, dicts in (("en", (actions.bachelor_links_english, actions.master_links_english)),
+                            ("de", (actions.bachelor_links_german, actions.master_links_german))):
+        aliases = [alias for links in dicts for key in links for alias in (key if isinstance(key, tuple) else (key,))]
+        for alias in aliases:
+            variants = [("alias", alias), ("alias", alias.title())]
+            for _ in range(args.typos):
+                i = random.randrange(len(alias) - 1)
+                variants.append(("typo", random.choice([alias[:i] + alias[i + 1:],
+                                                        alias[:i] + alias[i + 1] + alias[i] + alias[i + 2:]])))
+            for kind, variant in variants:
+                for study_type in (None, "bachelor", "master", "masters", "Bachelor", "bachleor", "mastr"):
+                    cases.append((kind, (variant, study_type, language)))
+
+    def answer(result: tuple) -> tuple:
+        outcome, studiengang, study_type, links = result
+        return outcome, str(studiengang).title(), study_type, links
+
+    # the former correction takes seconds for long unknown words, so the parity is checked with a memoized copy
+    # and the latency on a random sample of the cases
+    correction = functools.lru_cache(maxsize=None)(actions.spell.correction)
+    recognized = ("found", "ask_study_type")
+    counts = {kind: {"same": 0, "fixed": 0, "regressed": 0, "changed": 0} for kind in ("alias", "typo")}
+    fixed, regressed = set(), []
+    for kind, case in cases:
+        old = answer(legacy_find_study_plan(actions, *case, correction=correction))
+        new = answer(actions.find_study_plan(*case))
+        if old == new:
+            counts[kind]["same"] += 1
+        elif new[0] in recognized and old[0] not in recognized:
+            counts[kind]["fixed"] += 1
+            fixed.add((case[0], old[1]))
+        elif old[0] in recognized and new[0] not in recognized or old[0] == new[0] == "found" and old[3] != new[3]:
+            counts[kind]["regressed"] += 1
+            regressed.append((kind, case, old[:3], new[:3]))
+        else:
+            counts[kind]["changed"] += 1
+    for kind, kind_counts in counts.items():
+        print(f"{kind:<5} cases: " + ", ".join(f"{count} {name}" for name, count in kind_counts.items()))
+    for kind, case, old, new in regressed[:args.show]:
+        print(f"  regressed {kind} {case}: {old} -> {new}")
+    print(f"fixed programs (input -> former correction): {sorted(fixed)[:args.show]}")
+
+    sample = random.sample([case for _, case in cases], min(args.sample, len(cases)))
+    legacy_times, current_times, run_times = [], [], []
+    for case in sample:
+        start = time.perf_counter()
+        legacy_find_study_plan(actions, *case)
+        legacy_times.append(1000 * (time.perf_counter() - start))
+    actions.resolver._corrections.clear()
+    for case in sample:
+        start = time.perf_counter()
+        actions.find_study_plan(*case)
+        current_times.append(1000 * (time.perf_counter() - start))
+    action = {"en": actions.ProvideGeneralStudyplanEnglish(), "de": actions.ProvideGeneralStudyplanGerman()}
+    actions.resolver._corrections.clear()
+    for studiengang, study_type, language in sample:
+        tracker = SlotTracker({"studiengang": studiengang, "study_type": study_type})
+        start = time.perf_counter()
+        action[language].run(CollectingMessages(), tracker, {})
+        run_times.append(1000 * (time.perf_counter() - start))
+    for name, times in (("legacy", legacy_times), ("resolver", current_times), ("run", run_times)):
+        times.sort()
+        print(f"{name:<8} mean {statistics.mean(times):8.3f} ms  p50 {times[len(times) // 2]:8.3f} ms  "
+              f"max {times[-1]:8.3f} ms over {len(times)} sampled calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the THA chatbot pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batch = subparsers.add_parser("batch", help="sequential get_response loop vs. batched get_responses")
+    batch.add_argument("--queries", type=int, default=32, help="amount of queries from the QA set")
+    batch.add_argument("--concurrency", type=int, default=4, help="maximum parallel generation requests")
+    batch.add_argument("--retrieval-only", action="store_true", help="skip the generation with Ollama")
+    batch.set_defaults(func=benchmark_batch)
+
+    pdf = subparsers.add_parser("pdf", help="former vs. current subchapter segmentation of the PDF extraction")
+    pdf.add_argument("--pdfs", type=int, default=5, help="amount of the biggest PDFs in data/pdfs")
+    pdf.set_defaults(func=benchmark_pdf)
+
+    chunk = subparsers.add_parser("chunk", help="throughput of the TokenChunker on the QA set and the PDFs")
+    chunk.add_argument("--overlap", type=int, default=48, help="overlap between chunks in tokens")
+    chunk.set_defaults(func=benchmark_chunk)
+
+    embedding = subparsers.add_parser("embedding", help="parity and latency of the torch and ONNX embedding backends")
+    embedding.add_argument("--model", default="intfloat/multilingual-e5-large", help="name of the embedding model")
+    embedding.add_argument("--queries", type=int, default=500, help="amount of question-answer pairs")
+    embedding.add_argument("--latency-queries", type=int, default=50, help="amount of single query measurements")
+    embedding.add_argument("--min-mean-cosine", type=float, default=0.99,
+                           help="minimum mean cosine similarity of the torch and ONNX vectors")
+    embedding.add_argument("--min-cosine", type=float, default=0.97,
+                           help="minimum cosine similarity of the torch and ONNX vectors of every text")
+    embedding.add_argument("--max-recall-drop", type=float, default=0.02,
+                           help="maximum drop of recall@1 and recall@5 of ONNX compared with torch")
+    embedding.set_defaults(func=benchmark_embedding)
+
+    reranker = subparsers.add_parser("reranker", help="parity and latency of the torch and ONNX reranking backends")
+    reranker.add_argument("--model", default="cross-encoder/msmarco-MiniLM-L6-en-de-v1",
+                          help="name of the reranking model")
+    reranker.add_argument("--queries", type=int, default=200, help="amount of questions from the QA set")
+    reranker.add_argument("--candidates", type=int, default=10, help="amount of candidate answers per question")
+    reranker.add_argument("--threshold", type=float, default=5.0, help="rag_threshold of the chatbot")
+    reranker.add_argument("--min-top1", type=float, default=0.95, help="minimum share of the same top 1")
+    reranker.add_argument("--min-spearman", type=float, default=0.95, help="minimum mean Spearman correlation")
+    reranker.add_argument("--max-difference", type=float, default=0.5, help="maximum mean absolute score difference")
+    reranker.add_argument("--min-decision", type=float, default=0.97,
+                          help="minimum share of the same rag_threshold decision")
+    reranker.set_defaults(func=benchmark_reranker)
+
+    retrieval = subparsers.add_parser("retrieval", help="offline tuning of the adaptive retrieval policy")
+    retrieval.add_argument("--queries", type=int, default=200, help="amount of queries from the QA set")
+    retrieval.add_argument("--alternative", action="store_true", help="tune on the alternative database")
+    retrieval.add_argument("--threshold", type=float, default=5.0, help="rag_threshold of the chatbot")
+    retrieval.add_argument("--min-agreement", type=float, default=0.98,
+                           help="minimum agreement of the rag_threshold decision with full reranking")
+    retrieval.add_argument("--report", default=os.path.join(BASE_DIR, "backend/rag/retrieval_policy_eval.md"),
+                           help="markdown file the evaluation is written to, empty to skip")
+    retrieval.set_defaults(func=benchmark_retrieval)
+
+    score_cache = subparsers.add_parser("score-cache", help="hit rate of the reranking score cache")
+    score_cache.add_argument("--queries", type=int, default=200, help="amount of distinct questions from the QA set")
+    score_cache.add_argument("--requests", type=int, default=1000, help="amount of requests in the replayed stream")
+    score_cache.set_defaults(func=benchmark_score_cache)
+
+    generation = subparsers.add_parser("generation", help="former LangChain chain vs. OllamaClient")
+    generation.add_argument("--queries", type=int, default=50, help="amount of questions from the QA set")
+    generation.add_argument("--url", default=None, help="URL of a real Ollama server, a local stub is used if None")
+    generation.add_argument("--model", default="marco/em_german_mistral_v01-coherent", help="Ollama model")
+    generation.add_argument("--num-ctx", type=int, default=4096, help="context window of the client")
+    generation.add_argument("--num-predict", type=int, default=512, help="maximum amount of generated tokens")
+    generation.add_argument("--pause", type=float, default=0.0, help="seconds between two requests")
+    generation.add_argument("--load-seconds", type=float, default=2.0, help="stub: time to load the model")
+    generation.add_argument("--prefill-ms", type=float, default=2.0, help="stub: prefill time per new token")
+    generation.add_argument("--idle-seconds", type=float, default=300.0,
+                            help="stub: default keep_alive of the model if the request sets none")
+    generation.set_defaults(func=benchmark_generation)
+
+    rasa = subparsers.add_parser("rasa", help="former requests calls vs. RasaClient against a stub of Rasa")
+    rasa.add_argument("--sessions", type=int, default=8, help="amount of concurrent chat sessions")
+    rasa.add_argument("--messages", type=int, default=25, help="amount of messages per session")
+    rasa.add_argument("--queries", type=int, default=100, help="amount of distinct questions from the QA set")
+    rasa.add_argument("--parse-ms", type=float, default=20.0, help="stub: time of a parse request")
+    rasa.add_argument("--trigger-ms", type=float, default=10.0, help="stub: time of a trigger_intent request")
+    rasa.set_defaults(func=benchmark_rasa)
+
+    router = subparsers.add_parser("router", help="accuracy and saved latency of the intent router")
+    router.add_argument("--model", default="intfloat/multilingual-e5-large", help="embedding model")
+    router.add_argument("--backend", default="torch", help="embedding backend, torch or onnx")
+    router.add_argument("--rasa-url", default=None, help="URL of the Rasa server, the annotations are used if None")
+    router.add_argument("--parse-ms", type=float, default=60.0,
+                        help="assumed latency of a parse request if no Rasa server is given")
+    router.add_argument("--similarities", type=float, nargs="+", default=[0.8, 0.85, 0.9], help="min_similarity grid")
+    router.add_argument("--margins", type=float, nargs="+", default=[0.01, 0.03, 0.05], help="min_margin grid")
+    router.add_argument("--report", default=os.path.join(BASE_DIR, "app/intent_router_eval.md"),
+                        help="markdown file the evaluation is written to, empty to skip")
+    router.set_defaults(func=benchmark_router)
+
+    fetcher = subparsers.add_parser("fetcher", help="WebsiteFetcher against a local stub web server")
+    fetcher.add_argument("--pages", type=int, default=60, help="amount of pages served by the stub")
+    fetcher.add_argument("--latency-ms", type=float, default=50.0, help="response time of the stub per request")
+    fetcher.add_argument("--workers", type=int, default=16, help="max_workers of the fetcher")
+    fetcher.add_argument("--per-host", type=int, default=4, help="max_per_host of the fetcher")
+    fetcher.set_defaults(func=benchmark_fetcher)
+
+    rasa_actions = subparsers.add_parser("actions", help="former slot handling vs. ProgramResolver of the actions")
+    rasa_actions.add_argument("--typos", type=int, default=2, help="amount of random typos per alias")
+    rasa_actions.add_argument("--show", type=int, default=20, help="amount of changed cases to print")
+    rasa_actions.add_argument("--sample", type=int, default=100, help="amount of cases for the latency comparison")
+    rasa_actions.set_defaults(func=benchmark_actions)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
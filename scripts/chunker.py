@@ -0,0 +1,173 @@
+import bisect
+import time
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+from transformers import AutoTokenizer
+
+"""
+Token-exact chunker for the ingestion pipeline.
+Whole documents are batch-tokenized with the fast tokenizer of the embedding model and split along the offset
+mapping, so every chunk fits into the token budget of the embedding model and of the cross-encoder.
+"""
+
+BREAKS = ["\n\n", "\n", ". "]  # preferred chunk boundaries, in this order
+
+
+def split_spans(text: str, offsets: List[Tuple[int, int]], budget: int, overlap: int) -> List[Tuple[int, int]]:
+    """
+    Splits a tokenized text into windows of at most budget tokens that overlap by the given amount of tokens.
+    A window ends at the last paragraph, line or sentence break within its last quarter if there is one.
+    :param text: the tokenized text
+    :param offsets: character offsets of the tokens
+    :param budget: maximum amount of tokens per window
+    :param overlap: amount of tokens shared by two consecutive windows
+    :return: list of character spans
+    """
+    budget = max(budget, 1)
+    token_starts = [start for start, _ in offsets]
+    spans, start = [], 0
+    while start < len(offsets):
+        end = min(start + budget, len(offsets))
+        if end < len(offsets):
+            window_start, window_end = offsets[start][0], offsets[end][0]
+            min_cut = offsets[start + (end - start) * 3 // 4][0]
+            for separator in BREAKS:
+                cut = text.rfind(separator, min_cut, window_end)
+                if cut > window_start:
+                    end = max(bisect.bisect_left(token_starts, cut + len(separator)), start + 1)
+                    break
+        spans.append((offsets[start][0], offsets[end - 1][1]))
+        if end >= len(offsets):
+            break
+        start = max(end - overlap, start + 1)
+    return spans
+
+
+class TokenChunker:
+    def __init__(self, embedding_model: str = "intfloat/multilingual-e5-large",
+                 reranking_model: Optional[str] = "cross-encoder/msmarco-MiniLM-L6-en-de-v1",
+                 max_tokens: int = 512, rerank_max_tokens: int = 512, query_tokens: int = 64, overlap: int = 48,
+                 passage_prefix: str = "passage: ", batch_size: int = 256):
+        """
+        :param embedding_model: model whose tokenizer determines the chunk boundaries
+        :param reranking_model: cross-encoder whose budget the chunks must also fit, skipped if None
+        :param max_tokens: token budget of the embedding model including special tokens and the passage prefix
+        :param rerank_max_tokens: max_length of the cross-encoder for a (query, chunk) pair
+        :param query_tokens: tokens of the cross-encoder budget reserved for the query
+        :param overlap: amount of tokens shared by consecutive chunks of a document
+        :param passage_prefix: instruction prepended to every chunk when it is embedded
+        :param batch_size: amount of documents tokenized at once
+        """
+        self.embedding_model = embedding_model
+        self.reranking_model = reranking_model
+        self.tokenizer = AutoTokenizer.from_pretrained(embedding_model, use_fast=True)
+        self.rerank_tokenizer = AutoTokenizer.from_pretrained(reranking_model, use_fast=True) \
+            if reranking_model else None
+        self.max_tokens = max_tokens
+        self.rerank_max_tokens = rerank_max_tokens
+        self.query_tokens = query_tokens
+        self.overlap = overlap
+        self.passage_prefix = passage_prefix
+        self.batch_size = batch_size
+
+    def params(self) -> dict:
+        """
+        Parameters that influence the chunks, used for the content hashes of the indexer.
+        """
+        return {"chunker": "token", "embedding_model": self.embedding_model, "reranking_model": self.reranking_model,
+                "max_tokens": self.max_tokens, "rerank_max_tokens": self.rerank_max_tokens,
+                "query_tokens": self.query_tokens, "overlap": self.overlap, "passage_prefix": self.passage_prefix}
+
+    def chunk_documents(self, docs: List[Document]) -> List[Document]:
+        """
+        Chunks the documents, the title of a document is prepended to each of its chunks.
+        :param docs: documents with the text as page_content and the title in the metadata
+        :return: chunks as documents with the metadata of their document
+        """
+        start = time.perf_counter()
+        pieces = []  # (document, header, piece) tuples
+        for i in range(0, len(docs), self.batch_size):
+            pieces.extend(self._split_batch(docs[i:i + self.batch_size]))
+        pieces = self._fit(pieces, self.tokenizer, self.max_tokens, self.passage_prefix, True)
+        if self.rerank_tokenizer is not None:  # [CLS] query [SEP] chunk [SEP]
+            pieces = self._fit(pieces, self.rerank_tokenizer, self.rerank_max_tokens - self.query_tokens - 3, "",
+                               False)
+
+        chunks = [Document(page_content=header + piece, metadata=dict(doc.metadata)) for doc, header, piece in pieces]
+        duration = time.perf_counter() - start
+        print(f"Chunked {len(docs)} documents into {len(chunks)} chunks in {duration:.2f}s "
+              f"({len(docs) / max(duration, 1e-9):.1f} documents/s, {len(chunks) / max(duration, 1e-9):.1f} chunks/s).")
+        return chunks
+
+    def _token_lengths(self, tokenizer, texts: List[str], add_special_tokens: bool) -> List[int]:
+        return [len(ids) for ids in tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]]
+
+    def _split(self, tokenizer, items: List[tuple], header_lengths: List[int], limit: int) -> List[tuple]:
+        """
+        Splits the texts of the (document, header, text) items into pieces that fit into the limit
+        together with their header.
+        """
+        encodings = tokenizer([text for _, _, text in items], add_special_tokens=False, return_offsets_mapping=True)
+        pieces = []
+        for (doc, header, text), header_length, offsets in zip(items, header_lengths, encodings["offset_mapping"]):
+            for start, end in split_spans(text, offsets, limit - header_length, self.overlap):
+                piece = text[start:end].strip()
+                if piece:
+                    pieces.append((doc, header, piece))
+        return pieces
+
+    def _split_batch(self, docs: List[Document]) -> List[tuple]:
+        items = [(doc, f"{doc.metadata.get('title', '')}\n", doc.page_content) for doc in docs if doc.page_content]
+        header_lengths = self._token_lengths(self.tokenizer, [self.passage_prefix + header for _, header, _ in items],
+                                             True)
+        return self._split(self.tokenizer, items, header_lengths, self.max_tokens)
+
+    def _fit(self, pieces: List[tuple], tokenizer, limit: int, prefix: str, add_special_tokens: bool) -> List[tuple]:
+        """
+        Verifies the exact token length of every chunk and splits chunks that exceed the limit.
+        Tokenizing a header and a piece together can differ slightly from tokenizing them separately,
+        therefore pieces are re-split with the measured excess and a growing margin. Pieces that still exceed the
+        limit afterwards are hard-split on token offsets, so every returned chunk fits.
+        """
+        for margin in range(1, 6):
+            lengths = self._token_lengths(tokenizer, [prefix + header + piece for _, header, piece in pieces],
+                                          add_special_tokens)
+            too_long = [i for i, length in enumerate(lengths) if length > limit]
+            if not too_long:
+                return pieces
+
+            items = [pieces[i] for i in too_long]
+            piece_lengths = self._token_lengths(tokenizer, [piece for _, _, piece in items], False)
+            # everything that is not the piece itself counts as header
+            header_lengths = [lengths[i] - piece_length for i, piece_length in zip(too_long, piece_lengths)]
+            replacements = {}
+            for i, item, header_length in zip(too_long, items, header_lengths):
+                replacements[i] = self._split(tokenizer, [item], [header_length + margin], limit)
+            pieces = [new_piece for i, piece in enumerate(pieces)
+                      for new_piece in (replacements[i] if i in replacements else [piece])]
+
+        lengths = self._token_lengths(tokenizer, [prefix + header + piece for _, header, piece in pieces],
+                                      add_special_tokens)
+        return [new_piece for piece, length in zip(pieces, lengths)
+                for new_piece in (self._hard_split(piece, tokenizer, limit, prefix, add_special_tokens)
+                                  if length > limit else [piece])]
+
+    def _hard_split(self, item: tuple, tokenizer, limit: int, prefix: str, add_special_tokens: bool) -> List[tuple]:
+        """
+        Cuts a (document, header, piece) item into consecutive token windows without overlap and ignoring the
+        preferred breaks, the windows are shrunk until every chunk fits into the limit.
+        """
+        doc, header, piece = item
+        offsets = tokenizer(piece, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        budget = min(limit - self._token_lengths(tokenizer, [prefix + header], add_special_tokens)[0], len(offsets))
+        while budget > 0:
+            windows = [piece[offsets[i][0]:offsets[min(i + budget, len(offsets)) - 1][1]].strip()
+                       for i in range(0, len(offsets), budget)]
+            windows = [window for window in windows if window]
+            lengths = self._token_lengths(tokenizer, [prefix + header + window for window in windows],
+                                          add_special_tokens)
+            if max(lengths) <= limit:
+                return [(doc, header, window) for window in windows]
+            budget -= max(max(lengths) - limit, 1)
+        raise ValueError(f"The title '{header.strip()}' alone exceeds the token budget of {limit} tokens.")
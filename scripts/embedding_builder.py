@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+"""
+Embedding build engine of the ingestion pipeline.
+Chunks are sorted into length buckets, so a batch only contains chunks of similar length and little compute is
+wasted on padding. Short buckets use bigger batches with the same token budget. The buckets are encoded in blocks,
+optionally with a multi-process pool of sentence-transformers, and every finished block is committed to a
+checkpoint folder. An interrupted build resumes after the last committed block.
+"""
+
+BUCKET_LIMITS = [64, 128, 256, 512]  # upper token length of each bucket, longer chunks go into the last bucket
+
+
+class EmbeddingBuilder:
+    def __init__(self, encoder, model_name: str, checkpoint_dir: Optional[str] = None, batch_size: int = 32,
+                 max_tokens: int = 512, block_size: int = 1024, processes: int = 1, prefix: str = "passage: "):
+        """
+        :param encoder: SentenceTransformer of the embedding model
+        :param model_name: name of the embedding model, checkpoints of another model are discarded
+        :param checkpoint_dir: folder for the committed blocks, checkpointing is disabled if None
+        :param batch_size: batch size for chunks of max_tokens tokens, shorter buckets get proportionally more
+        :param max_tokens: token budget of the embedding model
+        :param block_size: amount of chunks encoded and committed at once
+        :param processes: amount of encoding processes, a multi-process pool is started if greater than 1
+        :param prefix: instruction prepended to every chunk
+        """
+        self.encoder = encoder
+        self.model_name = model_name
+        self.checkpoint_dir = checkpoint_dir
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.block_size = block_size
+        self.processes = processes
+        self.prefix = prefix
+
+    def prepare(self, text: str) -> str:
+        """
+        Same input as HuggingFaceBgeEmbeddings.embed_documents with the passage instruction.
+        """
+        return self.prefix + text.replace("\n", " ")
+
+    def bucket_batch_size(self, limit: int) -> int:
+        return max(1, self.batch_size * self.max_tokens // limit)
+
+    def plan(self, texts: List[str]) -> List[tuple]:
+        """
+        Sorts the texts by token length and splits them into blocks that never span two buckets.
+        :return: list of (indices, batch size) tuples
+        """
+        lengths = [len(ids) for ids in self.encoder.tokenizer(texts, add_special_tokens=True)["input_ids"]]
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        buckets: Dict[int, List[int]] = {limit: [] for limit in BUCKET_LIMITS}
+        for i in order:
+            limit = next((limit for limit in BUCKET_LIMITS if lengths[i] <= limit), BUCKET_LIMITS[-1])
+            buckets[limit].append(i)
+
+        blocks = []
+        for limit, indices in buckets.items():
+            for start in range(0, len(indices), self.block_size):
+                blocks.append((indices[start:start + self.block_size], self.bucket_batch_size(limit)))
+        return blocks
+
+    def load_checkpoint(self) -> Dict[str, np.ndarray]:
+        """
+        :return: dict of chunk ID -> embedding of all committed blocks
+        """
+        if not self.checkpoint_dir or not os.path.isdir(self.checkpoint_dir):
+            return {}
+        state_path = os.path.join(self.checkpoint_dir, "state.json")
+        state = {}
+        if os.path.isfile(state_path):
+            with open(state_path, encoding="utf-8") as file:
+                state = json.load(file)
+        if state.get("model") != self.model_name or state.get("prefix") != self.prefix:
+            shutil.rmtree(self.checkpoint_dir)
+            return {}
+
+        embeddings = {}
+        for block in state.get("blocks", []):
+            matrix = np.load(os.path.join(self.checkpoint_dir, f"{block}.npy"))
+            with open(os.path.join(self.checkpoint_dir, f"{block}.json"), encoding="utf-8") as file:
+                embeddings.update(zip(json.load(file), matrix))
+        return embeddings
+
+    def commit(self, ids: List[str], matrix: np.ndarray):
+        """
+        Stores an encoded block, it is only part of the checkpoint once the state file lists it.
+        """
+        if not self.checkpoint_dir:
+            return
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        state_path = os.path.join(self.checkpoint_dir, "state.json")
+        state = {"model": self.model_name, "prefix": self.prefix, "blocks": []}
+        if os.path.isfile(state_path):
+            with open(state_path, encoding="utf-8") as file:
+                state = json.load(file)
+
+        name = f"block-{len(state['blocks']):05d}"
+        np.save(os.path.join(self.checkpoint_dir, f"{name}.npy"), matrix)
+        with open(os.path.join(self.checkpoint_dir, f"{name}.json"), "w", encoding="utf-8") as file:
+            json.dump(ids, file)
+        state["blocks"].append(name)
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(f"{state_path}.tmp", state_path)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_dir and os.path.isdir(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+
+    def encode(self, ids: List[str], texts: List[str]) -> np.ndarray:
+        """
+        Encodes the texts, chunks of committed blocks are not encoded again.
+        :param ids: chunk IDs, used to resume from the checkpoint
+        :param texts: chunk texts without the passage instruction
+        :return: normalized embeddings aligned with the texts
+        """
+        start = time.perf_counter()
+        committed = self.load_checkpoint()
+        pending = [i for i, chunk_hash in enumerate(ids) if chunk_hash not in committed]
+        if committed:
+            print(f"Resuming from checkpoint, {len(ids) - len(pending)} of {len(ids)} chunks already embedded.")
+
+        results: Dict[int, np.ndarray] = {i: committed[chunk_hash] for i, chunk_hash in enumerate(ids)
+                                          if chunk_hash in committed}
+        blocks = self.plan([texts[i] for i in pending]) if pending else []
+        # only sentence-transformers has a process pool, ONNX Runtime already uses all cores
+        use_pool = self.processes > 1 and blocks and hasattr(self.encoder, "start_multi_process_pool")
+        pool = self.encoder.start_multi_process_pool(["cpu"] * self.processes) if use_pool else None
+        encoded = 0
+        try:
+            for indices, batch_size in blocks:
+                block_indices = [pending[i] for i in indices]
+                block_texts = [self.prepare(texts[i]) for i in block_indices]
+                if pool is not None:
+                    matrix = self.encoder.encode_multi_process(block_texts, pool, batch_size=batch_size,
+                                                               normalize_embeddings=True)
+                else:
+                    matrix = self.encoder.encode(block_texts, batch_size=batch_size, normalize_embeddings=True,
+                                                 show_progress_bar=False, convert_to_numpy=True)
+                matrix = np.asarray(matrix, dtype=np.float32)
+                self.commit([ids[i] for i in block_indices], matrix)
+                results.update(zip(block_indices, matrix))
+
+                encoded += len(block_indices)
+                duration = time.perf_counter() - start
+                print(f"Embedded {encoded}/{len(pending)} chunks (batch size {batch_size}, "
+                      f"{encoded / max(duration, 1e-9):.1f} chunks/s).")
+        finally:
+            if pool is not None:
+                self.encoder.stop_multi_process_pool(pool)
+
+        if not ids:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([results[i] for i in range(len(ids))]).astype(np.float32)
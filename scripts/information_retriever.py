@@ -1,17 +1,19 @@
 import json
 import os
 import re
-from typing import List, Dict
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional
 from urllib.parse import urljoin
 
 import fitz  # PyMuPDF
-import requests
 from bs4 import BeautifulSoup
 from tabulate import tabulate
-from transformers import AutoTokenizer
+
+from scripts.website_fetcher import FetchResult, WebsiteFetcher
 
 """
-This is a helper file to retrieve data from websites and optionally organize it in chunks.
+This is a helper file to retrieve data from websites and PDF files.
 The data is usually stored in a JSON file in the data folder.
 """
 
@@ -22,18 +24,75 @@ def get_websites(filepath: str) -> List[Dict[str, str]]:
     return data
 
 
+def find_first_occurrences(text: str, patterns: List[str]) -> Dict[str, int]:
+    """
+    Finds the first occurrence of every pattern in the text with a single scan over the text.
+    The scan reports the longest pattern starting at each position. A shorter pattern starting at the same
+    position is a prefix of the reported one, so its first occurrence is the earliest report of itself or of
+    a pattern it is a prefix of.
+    :param text: text to search in
+    :param patterns: literal patterns
+    :return: dict of pattern -> index of its first occurrence, patterns that do not occur are missing
+    """
+    unique_patterns = sorted({pattern for pattern in patterns if pattern}, key=len, reverse=True)
+    first_occurrences = {"": 0} if "" in patterns else {}
+    if not unique_patterns:
+        return first_occurrences
+
+    reported = {}
+    matcher = re.compile("(?=(" + "|".join(re.escape(pattern) for pattern in unique_patterns) + "))")
+    for match in matcher.finditer(text):
+        reported.setdefault(match.group(1), match.start())
+        if len(reported) == len(unique_patterns):
+            break
+
+    for pattern in unique_patterns:
+        positions = [position for candidate, position in reported.items() if candidate.startswith(pattern)]
+        if positions:
+            first_occurrences[pattern] = min(positions)
+    return first_occurrences
+
+
+def insert_paragraph_breaks(text: str, positions: List[int]) -> str:
+    """
+    Inserts two new lines at the given positions, processed in the given order like repeated inserts
+    into a list of the characters of the text. Every insert is one list element, so later inserts are shifted
+    by the amount of earlier inserts in front of them.
+    :param text: text to insert the breaks into
+    :param positions: positions in the original text
+    :return: text with the paragraph breaks, built with a single join
+    """
+    insert_indices = []  # list indices of the inserted elements
+    for position in positions:
+        insert_indices = [index + 1 if index >= position else index for index in insert_indices]
+        insert_indices.append(min(position, len(text) + len(insert_indices)))
+    insert_indices.sort()
+
+    parts, previous = [], 0
+    for amount_before, index in enumerate(insert_indices):
+        char_index = index - amount_before  # amount of original characters in front of this insert
+        parts.append(text[previous:char_index])
+        parts.append("\n\n")
+        previous = char_index
+    parts.append(text[previous:])
+    return "".join(parts)
+
+
 class WebsiteRetriever:
-    def __init__(self, data_folder_path: str, website_file: str = "websites.json"):
+    def __init__(self, data_folder_path: str, website_file: str = "websites.json",
+                 fetcher: Optional[WebsiteFetcher] = None):
         """
         Website Retriever initialization
         :param data_folder_path: path to the folder containing the websites.json file and the PDF files
         :param website_file: set the filename, only alternative
+        :param fetcher: fetcher used to download the websites, defaults to a fetcher with a response cache
+               in the data folder
         """
         self.data_folder_path = data_folder_path
+        self.fetcher = fetcher or WebsiteFetcher(os.path.join(data_folder_path, "website_cache"), parser_version="2")
         self.websites = get_websites(os.path.join(data_folder_path, website_file))
         self.structured_data = []
         self.unstructured_data = []
-        self.tokenizer = AutoTokenizer.from_pretrained("intfloat/multilingual-e5-large")
 
     def extract_text_from_url(self, response: str, url: str):
         """
@@ -135,98 +194,91 @@ class WebsiteRetriever:
             return False
         return True
 
-    def tokenize(self, text):
-        return self.tokenizer.tokenize(text)
-
-    def chunk_text(self, text, title, max_tokens=500):
+    def get_data(self, pdf_included=True) -> List:
         """
-        Split text into chunks according to paragraph breaks.
-        It is not splitting paragraphs, so it could appear that the length is longer than max_tokens.
-        This will be handled by another chunking step in the pipeline.
-        Also appends the title to the beginning of each chunk.
+        Extracts the text from the websites and returns them as a list of dictionaries with the title, text, and url.
+        Optionally extracts information from PDF files.
+        The documents are not chunked, this is done by the TokenChunker in the ingestion pipeline.
         """
-        chunks = []
-        current_chunk = ""
-        current_tokens = 0
-        len_title = len(self.tokenize(title))
-
-        paragraphs = text.split('\n\n')  # Split text into paragraphs
-        for p in paragraphs:
-            tokens = self.tokenize(p)
-            if current_tokens + len(tokens) <= max_tokens - len_title:
-                current_chunk += p + '\n'
-                current_tokens += len(tokens)
-            else:
-                if current_chunk.strip():
-                    chunks.append(f"{title}\n{current_chunk}".strip().replace("\r\n\r\n", ""))
-                current_chunk = p + '\n'
-                current_tokens = len(tokens)
-
-        current_chunk = current_chunk.strip()
-
-        if current_chunk and current_chunk != title.strip():
-            chunks.append(f"{title}\n{current_chunk}".strip().replace("\r\n\r\n", ""))
+        self.structured_data.extend(self.extract_pages(self.fetch_pages()))
+        if pdf_included:  # Extract information from PDF files
+            self.structured_data.extend(self.extract_pdfs())
+        return self.structured_data
 
-        return chunks
+    def fetch_pages(self) -> Dict[str, FetchResult]:
+        """
+        Fetches all websites of the website file.
+        :return: dict of url -> FetchResult
+        """
+        return self.fetcher.fetch_all([raw_document["url"] for raw_document in self.websites])
 
-    def get_data(self, pdf_included=True) -> List:
+    def extract_pages(self, results: Dict[str, FetchResult]) -> List[Dict[str, str]]:
         """
-        Extracts the text from the websites and returns them as a list of dictionaries with the title, text, and url.
-        Optionally extracts information from PDF files.
+        Extracts the text from the fetched websites, unchanged pages reuse their cached extraction result.
+        :param results: dict of url -> FetchResult
+        :return: list of dictionaries with the title, text, and url
         """
+        documents = []
         for raw_document in self.websites:
             url = raw_document["url"]
             try:
-                response = requests.get(url)
+                response = results[url]
                 title_json = raw_document["title"]
+                if response.error:
+                    raise Exception(response.error)
                 if response.status_code == 200:
-                    text, title = self.extract_text_from_url(response.text, url)
-                    chunks = self.chunk_text(text, title)
-
-                    for chunk in chunks:
-                        self.structured_data.append(
-                            {
-                                "title": title,
-                                "text": str(chunk),
-                                "url": url,
-                            })
+                    page_documents = response.parsed
+                    if page_documents is None:  # page is new or has changed
+                        text, title = self.extract_text_from_url(response.text, url)
+                        text = text.strip().replace("\r\n\r\n", "")
+                        page_documents = [{"title": title, "text": text, "url": url}] if text else []
+                        self.fetcher.store_parsed(url, page_documents)
+
+                    documents.extend(page_documents)
                     print(f"Information from '{title_json}' extracted and saved successfully.")
                 else:
                     print(f"Failed to retrieve information from '{url}'. Status code: {response.status_code}")
             except Exception as e:
                 print(f"An error occurred while processing '{url}': {e}")
+        return documents
 
-        if pdf_included:  # Extract information from PDF files
-            pdf_retriever = PDFRetriever(os.path.join(self.data_folder_path, 'pdfs'))
-            pdf_contents = pdf_retriever.process_pdfs()
-
-            for doc_title, sections in pdf_contents.items():
-                try:  # chunk all sections of the document
-                    for section_title, text in sections.items():
-                        chunks = self.chunk_text(text, doc_title)
-                        for chunk in chunks:
-                            title = f"{doc_title} - {section_title}"
-                            self.structured_data.append(
-                                {
-                                    "title": title,
-                                    "text": str(chunk),
-                                    "url": "",
-                                })
-                    print(f"Information from '{doc_title}' extracted and saved successfully.")
-                except Exception as e:
-                    print(f"An error occurred while processing '{doc_title}': {e}")
-        return self.structured_data
+    def extract_pdfs(self) -> List[Dict[str, str]]:
+        """
+        Extracts the sections of the PDF files in the pdfs folder, every section is a separate document.
+        :return: list of dictionaries with the title, text, and url
+        """
+        documents = []
+        pdf_retriever = PDFRetriever(os.path.join(self.data_folder_path, 'pdfs'))
+        pdf_contents = pdf_retriever.process_pdfs()
+
+        for doc_title, sections in pdf_contents.items():
+            try:  # every section of the document is a separate document
+                for section_title, text in sections.items():
+                    documents.append(
+                        {
+                            "title": f"{doc_title} - {section_title}",
+                            "text": text.strip().replace("\r\n\r\n", ""),
+                            "url": "",
+                        })
+                print(f"Information from '{doc_title}' extracted and saved successfully.")
+            except Exception as e:
+                print(f"An error occurred while processing '{doc_title}': {e}")
+        return documents
 
 
 class PDFRetriever:
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, workers: Optional[int] = None, pages_per_job: int = 150):
         """
         Extracts the content of PDF files
         :param folder_path: path to the folder containing the PDF files
+        :param workers: amount of worker processes, defaults to the amount of CPU cores. 1 extracts in this process.
+        :param pages_per_job: PDFs with more pages are split into several jobs along the table of content
         """
         self.folder_path = folder_path
-        self.pdf_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.pdf')]
+        self.workers = workers or os.cpu_count() or 1
+        self.pages_per_job = pages_per_job
+        self.pdf_files = sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.pdf'))
 
     def extract_title(self, file_path) -> str:
         return os.path.splitext(os.path.basename(file_path))[0]
@@ -236,10 +288,36 @@ class PDFRetriever:
         Extracts the sections from a PDF document based on first two levels of table of content and returns them as a dictionary.
         """
         toc = doc.get_toc(simple=True)
+        sections = self.extract_section_range(doc, toc, 0, len(toc))
+
+        # remove empty sections
+        sections = {title: text for title, text in sections.items() if text.strip()}
+        return sections
+
+    def extract_section_range(self, doc, toc, start: int, end: int) -> Dict[str, str]:
+        """
+        Extracts the sections of the table of content entries start to end (exclusive).
+        Empty sections are included, so that the results of several ranges can be merged in order.
+        The text of every page is only extracted once, even if it belongs to several sections.
+        """
         sections = {}
+        next_chapters = self.find_next_chapters(toc)
+        page_texts = [None] * doc.page_count
+
+        def page_text(page: int) -> str:
+            page = page + doc.page_count if page < 0 else page  # negative numbers count from the end like in fitz
+            if page_texts[page] is None:
+                page_texts[page] = doc.load_page(page).get_text()
+            return page_texts[page]
 
         level_1_header = ""  # store the current level 1 headline to include it later for more context
-        for i, (level, title, page_num) in enumerate(toc):
+        for level, title, _ in reversed(toc[:start]):  # headline of a level 1 chapter before the range
+            if level == 1:
+                level_1_header = title
+                break
+
+        for i in range(start, end):
+            level, title, page_num = toc[i]
             if level <= 2:  # only extract first two levels
                 if title not in sections:
                     sections[title] = ""
@@ -247,16 +325,13 @@ class PDFRetriever:
                 if level == 1:  # store the current level 1 headline
                     level_1_header = title
 
-                # find next chapter to determine the end of the current section
-                next_page_num = self.find_next_chapter(toc, i)[2] \
-                    if self.find_next_chapter(toc, i) != -1 else doc.page_count - 1
+                # the next chapter determines the end of the current section
+                next_page_num = toc[next_chapters[i]][2] if next_chapters[i] != -1 else doc.page_count - 1
 
-                section_text = ""  # store the text of the determined pages
-                for page in range(page_num - 1, next_page_num):
-                    section_text += doc.load_page(page).get_text()
+                section_text = "".join(page_text(page) for page in range(page_num - 1, next_page_num))
 
                 # filter the text of the current section to only receive the text of the current section
-                section_text = self.filter_text_section(section_text, toc, i)
+                section_text = self.filter_text_section(section_text, toc, i, next_chapters)
 
                 # if section has no text, skip it
                 if section_text.strip() == title.strip():
@@ -264,10 +339,22 @@ class PDFRetriever:
 
                 sections[title] += f"{level_1_header}\n{section_text}"
 
-        # remove empty sections
-        sections = {title: text for title, text in sections.items() if text.strip()}
         return sections
 
+    def find_next_chapters(self, toc) -> List[int]:
+        """
+        Computes the index of the next chapter for every entry of the table of content in one pass.
+        The next chapter is the next entry with the same or a higher level, like in find_next_chapter.
+        :return: list of indices, -1 if an entry has no next chapter
+        """
+        next_chapters = [-1] * len(toc)
+        open_entries = []  # indices whose next chapter was not found yet, their levels are strictly increasing
+        for i, (level, _, _) in enumerate(toc):
+            while open_entries and toc[open_entries[-1]][0] >= level:
+                next_chapters[open_entries.pop()] = i
+            open_entries.append(i)
+        return next_chapters
+
     def find_next_chapter(self, toc, index):
         """
         Finds the next chapter in the table of content based on the current index. Because only the first two levels are extracted, all the other levels will be skipped.
@@ -280,43 +367,42 @@ class PDFRetriever:
             return -1
         return toc[index]
 
-    def filter_text_section(self, section_text, toc, index):
+    def filter_text_section(self, section_text, toc, index, next_chapters: Optional[List[int]] = None):
         """
         Filters the text of the current section to only include the text of the current section and not the text of the next or previous chapter.
+        :param next_chapters: precomputed result of find_next_chapters, computed if not given
         """
         current_title = toc[index][1]
         next_title = toc[index + 1][1] if index + 1 < len(toc) else None
 
         if toc[index][0] == 2:  # Add new lines before each subchapter (level 3 or higher)
             new_index = index + 1
-            section_text_list = list(section_text)
-            # search for subchapters using the table of content
             while new_index < len(toc) and toc[new_index][0] > 2:
-                pattern_subchapters = re.compile(re.escape(toc[new_index][1].strip()), re.MULTILINE)
-                match = pattern_subchapters.search(section_text)
-                if match:
-                    section_text_list.insert(match.start(), '\n\n')  # Insert two new lines before subchapter
                 new_index += 1
-            section_text = ''.join(section_text_list)
+            subchapters = [entry[1].strip() for entry in toc[index + 1:new_index]]
+            # search for all subchapters of the table of content in one pass
+            first_occurrences = find_first_occurrences(section_text, subchapters)
+            section_text = insert_paragraph_breaks(section_text, [first_occurrences[subchapter]
+                                                                  for subchapter in subchapters
+                                                                  if subchapter in first_occurrences])
 
             # find text before current chapter
-            pattern_chapter = re.compile(re.escape(current_title.strip()), re.MULTILINE)
-            match = pattern_chapter.search(section_text)
+            match = section_text.find(current_title.strip())
 
             # find text after current chapter
-            next_chapter = self.find_next_chapter(toc, index)[1] if self.find_next_chapter(toc, index) != -1 else None
+            if next_chapters is None:
+                next_chapters = self.find_next_chapters(toc)
+            next_chapter = toc[next_chapters[index]][1] if next_chapters[index] != -1 else None
             if next_chapter:
-                pattern_next_chapter = re.compile(re.escape(next_chapter.strip()), re.MULTILINE)
-                match_next_chapter = pattern_next_chapter.search(section_text)
-                if match:  # shorten text before current chapter
-                    section_text = section_text[match.start():]
-                    if match_next_chapter:  # shorten text if next chapter is found
-                        section_text = section_text[:match_next_chapter.start()]
+                match_next_chapter = section_text.find(next_chapter.strip())
+                if match != -1:  # shorten text before current chapter
+                    section_text = section_text[match:]
+                    if match_next_chapter != -1:  # shorten text if next chapter is found
+                        section_text = section_text[:match_next_chapter]
         elif next_title:  # exclude text of next chapter
-            pattern_subchapters = re.compile(re.escape(next_title.strip()), re.MULTILINE)
-            match = pattern_subchapters.search(section_text)
-            if match:
-                section_text = section_text[:match.start()]
+            match = section_text.find(next_title.strip())
+            if match != -1:
+                section_text = section_text[:match]
 
         return section_text
 
@@ -333,14 +419,64 @@ class PDFRetriever:
             with open(file_path, 'w', encoding='utf-8') as file:
                 file.write(text.strip())
 
+    def split_jobs(self, pdf_file: str) -> List[tuple]:
+        """
+        Splits a PDF into extraction jobs. Big PDFs are split into ranges of table of content entries
+        that cover about pages_per_job pages each.
+        :return: list of (pdf_file, start, end) jobs, end is None for the whole table of content
+        """
+        with fitz.open(pdf_file) as doc:
+            toc = doc.get_toc(simple=True)
+            if doc.page_count <= self.pages_per_job or self.workers == 1 or not toc:
+                return [(pdf_file, 0, None)]
+
+        jobs, start, start_page = [], 0, toc[0][2]
+        for i, (level, _, page_num) in enumerate(toc):
+            if level == 1 and page_num - start_page >= self.pages_per_job:
+                jobs.append((pdf_file, start, i))
+                start, start_page = i, page_num
+        jobs.append((pdf_file, start, len(toc)))
+        return jobs
+
     def process_pdfs(self) -> Dict[str, Dict[str, str]]:
         """
         Extracts the text from all PDF files in the folder and returns them as a dictionary with the title as key and the dict of sections as value.
+        The PDFs are extracted in worker processes, the results are merged in a deterministic order.
         """
-        all_docs = {}
-        for pdf_file in self.pdf_files:
-            with fitz.open(pdf_file) as doc:
-                title = self.extract_title(pdf_file)
-                sections = self.extract_sections(doc)
-                all_docs[title] = sections
+        start = time.perf_counter()
+        jobs = [job for pdf_file in self.pdf_files for job in self.split_jobs(pdf_file)]
+        if self.workers == 1:
+            results = [extract_pdf_job(self.folder_path, job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(extract_pdf_job, [self.folder_path] * len(jobs), jobs))
+
+        all_docs, durations = {}, {}
+        for (pdf_file, _, _), (sections, duration) in zip(jobs, results):  # jobs are ordered by file and range
+            title = self.extract_title(pdf_file)
+            merged = all_docs.setdefault(title, {})
+            for section_title, text in sections.items():
+                merged[section_title] = merged.get(section_title, "") + text
+            durations[title] = durations.get(title, 0.0) + duration
+
+        for title in all_docs:  # remove empty sections
+            all_docs[title] = {section: text for section, text in all_docs[title].items() if text.strip()}
+            print(f"Extracted '{title}' in {durations[title]:.2f}s ({len(all_docs[title])} sections).")
+        print(f"Extracted {len(all_docs)} PDFs with {self.workers} workers in {time.perf_counter() - start:.2f}s.")
         return all_docs
+
+
+def extract_pdf_job(folder_path: str, job: tuple):
+    """
+    Worker function of PDFRetriever.process_pdfs, extracts the sections of one job.
+    :param folder_path: folder of the PDF retriever
+    :param job: tuple (pdf_file, start, end) of PDFRetriever.split_jobs
+    :return: tuple of (sections including empty ones, duration in seconds)
+    """
+    start_time = time.perf_counter()
+    pdf_file, start, end = job
+    retriever = PDFRetriever(folder_path, workers=1)
+    with fitz.open(pdf_file) as doc:
+        toc = doc.get_toc(simple=True)
+        sections = retriever.extract_section_range(doc, toc, start, len(toc) if end is None else end)
+    return sections, time.perf_counter() - start_time
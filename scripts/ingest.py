@@ -0,0 +1,313 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from backend.rag.embeddings import embedding_key, load_encoder
+from backend.rag.indexer import IncrementalIndexer, chunk_id
+from scripts.chunker import TokenChunker
+from scripts.embedding_builder import EmbeddingBuilder
+from scripts.qa_retriever import get_data_in_html_format
+
+"""
+Staged ingestion pipeline for the vector databases. Run from the project folder, e.g.:
+python -m scripts.ingest --index all
+python -m scripts.ingest --index website --from chunk
+Every stage writes a versioned artifact to data/artifacts/<index>/ and only reads the artifact of the previous stage,
+so a failed or changed stage can be re-run without crawling, parsing or embedding everything again.
+The chatbot only loads the finished databases.
+"""
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+ARTIFACT_FORMAT = 1  # increase if the layout of the artifacts changes
+STAGES = ["fetch", "extract", "chunk", "embed", "load"]
+INDEXES = {  # index name -> default database and sources
+    "qa": {"db": "backend/rag/intfloat-qa", "sources": ["qa"]},
+    "website": {"db": "backend/rag/intfloat-website", "sources": ["html", "pdf"]},
+}
+
+
+def write_artifact(path: str, header: dict, records: Iterable[dict]) -> dict:
+    """
+    Writes a gzip compressed JSONL artifact, the first line is the header.
+    The version of the artifact is the hash of its records.
+    :return: the header including the version and the amount of records
+    """
+    records = list(records)
+    digest = hashlib.sha256()
+    lines = []
+    for record in records:
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        digest.update(line.encode("utf-8"))
+        lines.append(line)
+    header = dict(header, format=ARTIFACT_FORMAT, version=digest.hexdigest(), count=len(records),
+                  created_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+        file.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for line in lines:
+            file.write(line + "\n")
+    os.replace(tmp_path, path)  # a failed stage never leaves a half written artifact behind
+    return header
+
+
+def read_artifact(path: str) -> Tuple[dict, List[dict]]:
+    """
+    Reads an artifact written by write_artifact.
+    :return: tuple of header and records
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Artifact '{path}' does not exist, run the previous stage first.")
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        if header.get("format") != ARTIFACT_FORMAT:
+            raise ValueError(f"Artifact '{path}' has format {header.get('format')}, expected {ARTIFACT_FORMAT}. "
+                             f"Re-run the stage that writes it.")
+        return header, [json.loads(line) for line in file if line.strip()]
+
+
+class IngestionPipeline:
+    def __init__(self, data_path: str = os.path.join(BASE_DIR, "data"), artifacts_dir: Optional[str] = None,
+                 embedding_model: str = "intfloat/multilingual-e5-large",
+                 reranking_model: str = "cross-encoder/msmarco-MiniLM-L6-en-de-v1", chunk_overlap: int = 48,
+                 batch_size: int = 32, device: Optional[str] = None, encoder=None, processes: int = 1,
+                 block_size: int = 1024, embedding_backend: str = "torch"):
+        """
+        :param data_path: folder containing the websites.json file, the PDF files and the question-answer set
+        :param artifacts_dir: folder for the artifacts, defaults to the artifacts folder in the data folder
+        :param embedding_model: name of the embedding model
+        :param reranking_model: name of the reranking model, the chunks also fit its token budget
+        :param chunk_overlap: amount of tokens shared by consecutive chunks of a document
+        :param batch_size: amount of chunks embedded at once
+        :param device: device for the embedding model, defaults to cuda if available
+        :param encoder: already loaded encoder of the embedding model, loaded on demand if None
+        :param processes: amount of encoding processes of the embed stage
+        :param block_size: amount of chunks the embed stage encodes and checkpoints at once
+        :param embedding_backend: backend of the embedding model if it is loaded on demand, "torch" or "onnx"
+        """
+        self.data_path = data_path
+        self.artifacts_dir = artifacts_dir or os.path.join(data_path, "artifacts")
+        self.embedding_model = embedding_model
+        self.reranking_model = reranking_model
+        self.chunk_overlap = chunk_overlap
+        self.batch_size = batch_size
+        self.device = device
+        self.encoder = encoder
+        self.processes = processes
+        self.block_size = block_size
+        self.embedding_backend = embedding_backend
+        self._website_retriever = None
+
+    def artifact_path(self, index: str, name: str) -> str:
+        return os.path.join(self.artifacts_dir, index, name)
+
+    @property
+    def website_retriever(self):
+        if self._website_retriever is None:  # imported on demand, the QA index does not need the crawler
+            from scripts.information_retriever import WebsiteRetriever
+            self._website_retriever = WebsiteRetriever(self.data_path)
+        return self._website_retriever
+
+    def fetch(self, index: str) -> Optional[dict]:
+        """
+        Downloads all websites of the index and stores the raw responses.
+        """
+        if "html" not in INDEXES[index]["sources"]:
+            print(f"[{index}] fetch: nothing to fetch.")
+            return None
+        results = self.website_retriever.fetch_pages()
+        titles = {website["url"]: website["title"] for website in self.website_retriever.websites}
+        records = [{"url": url, "title": titles.get(url, ""), "status_code": result.status_code, "text": result.text,
+                    "modified": result.modified, "parsed": result.parsed, "error": result.error}
+                   for url, result in results.items()]
+        return write_artifact(self.artifact_path(index, "fetch.jsonl.gz"), {"stage": "fetch", "index": index},
+                              records)
+
+    def extract(self, index: str) -> dict:
+        """
+        Extracts the documents of all sources of the index: fetched HTML pages, PDF sections and the QA set.
+        """
+        from scripts.website_fetcher import FetchResult
+
+        documents, input_version = [], None
+        sources = INDEXES[index]["sources"]
+        if "html" in sources:
+            header, records = read_artifact(self.artifact_path(index, "fetch.jsonl.gz"))
+            input_version = header["version"]
+            results = {record["url"]: FetchResult(record["url"], record["status_code"], record["text"],
+                                                  record["modified"], record["parsed"], record["error"])
+                       for record in records}
+            documents.extend(self.website_retriever.extract_pages(results))
+        if "pdf" in sources:
+            documents.extend(self.website_retriever.extract_pdfs())
+        if "qa" in sources:
+            documents.extend(get_data_in_html_format(self.data_path))
+
+        records = [{"title": document["title"], "text": document["text"], "url": document["url"]}
+                   for document in documents]
+        return write_artifact(self.artifact_path(index, "extract.jsonl.gz"),
+                              {"stage": "extract", "index": index, "input": input_version}, records)
+
+    def chunk(self, index: str) -> dict:
+        """
+        Chunks the extracted documents, every chunk gets the content hash used as ID in the database.
+        """
+        header, records = read_artifact(self.artifact_path(index, "extract.jsonl.gz"))
+        docs = [Document(page_content=record["text"], metadata={"url": record["url"], "title": record["title"]})
+                for record in records]
+        chunker = TokenChunker(self.embedding_model, self.reranking_model, overlap=self.chunk_overlap)
+        params = chunker.params()
+
+        chunks = {}
+        for chunk in chunker.chunk_documents(docs):
+            chunks.setdefault(chunk_id(chunk, params), chunk)  # identical chunks are only stored once
+        records = [{"id": chunk_hash, "text": chunk.page_content, "metadata": chunk.metadata}
+                   for chunk_hash, chunk in chunks.items()]
+        return write_artifact(self.artifact_path(index, "chunks.jsonl.gz"),
+                              {"stage": "chunk", "index": index, "input": header["version"], "params": params},
+                              records)
+
+    def load_encoder(self):
+        if self.encoder is None:
+            self.encoder = load_encoder(self.embedding_model, self.embedding_backend, self.device)
+        return self.encoder
+
+    def embed(self, index: str) -> dict:
+        """
+        Embeds the chunks as passages, in the same way as the HuggingFaceBgeEmbeddings of the chatbot.
+        Embeddings of chunks that did not change since the last run are taken from the previous artifact,
+        the others are encoded by the EmbeddingBuilder, which resumes from its checkpoint after a crash.
+        The matrix is stored as .npy file, its rows are aligned with the IDs in the JSON header next to it.
+        """
+        header, records = read_artifact(self.artifact_path(index, "chunks.jsonl.gz"))
+        matrix_path = self.artifact_path(index, "embeddings.npy")
+        header_path = self.artifact_path(index, "embeddings.json")
+
+        encoder = self.load_encoder()
+        model_key = embedding_key(self.embedding_model, encoder)
+        previous, previous_matrix = {}, None
+        if os.path.isfile(matrix_path) and os.path.isfile(header_path):
+            with open(header_path, encoding="utf-8") as file:
+                previous_header = json.load(file)
+            if previous_header.get("format") == ARTIFACT_FORMAT and \
+                    previous_header.get("model") == model_key:
+                previous_matrix = np.load(matrix_path, mmap_mode="r")
+                previous = {chunk_hash: row for row, chunk_hash in enumerate(previous_header["ids"])}
+
+        start = time.perf_counter()
+        ids = [record["id"] for record in records]
+        missing = [i for i, chunk_hash in enumerate(ids) if chunk_hash not in previous]
+        new_embeddings = None
+        if missing:
+            builder = EmbeddingBuilder(encoder, model_key,
+                                       self.artifact_path(index, "embed_checkpoint"), batch_size=self.batch_size,
+                                       block_size=self.block_size, processes=self.processes)
+            new_embeddings = builder.encode([ids[i] for i in missing], [records[i]["text"] for i in missing])
+        if new_embeddings is not None:
+            dimension = new_embeddings.shape[1]
+        else:
+            dimension = previous_matrix.shape[1] if previous_matrix is not None else 0
+        matrix = np.zeros((len(ids), dimension), dtype=np.float32)
+        for i, chunk_hash in enumerate(ids):
+            if chunk_hash in previous:
+                matrix[i] = previous_matrix[previous[chunk_hash]]
+        if missing:
+            matrix[missing] = new_embeddings
+        duration = time.perf_counter() - start
+        print(f"[{index}] embed: {len(missing)} of {len(ids)} chunks embedded in {duration:.1f}s "
+              f"({len(missing) / max(duration, 1e-9):.1f} chunks/s), {len(ids) - len(missing)} reused.")
+
+        embed_header = {"stage": "embed", "index": index, "format": ARTIFACT_FORMAT, "input": header["version"],
+                        "model": model_key, "version": hashlib.sha256(matrix.tobytes()).hexdigest(),
+                        "count": len(ids), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "ids": ids}
+        np.save(f"{matrix_path}.tmp.npy", matrix)
+        with open(f"{header_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(embed_header, file)
+        os.replace(f"{matrix_path}.tmp.npy", matrix_path)
+        os.replace(f"{header_path}.tmp", header_path)
+        if missing:
+            builder.clear_checkpoint()  # the blocks are part of the artifact now
+        return embed_header
+
+    def load(self, index: str, db_path: Optional[str] = None) -> dict:
+        """
+        Synchronizes the Chroma database with the chunks and embeddings of the previous stages.
+        :param db_path: persist directory of the database, defaults to the database of the index
+        """
+        from langchain_community.vectorstores.chroma import Chroma
+
+        header, records = read_artifact(self.artifact_path(index, "chunks.jsonl.gz"))
+        with open(self.artifact_path(index, "embeddings.json"), encoding="utf-8") as file:
+            embed_header = json.load(file)
+        if embed_header["input"] != header["version"]:
+            raise ValueError(f"The embeddings of '{index}' do not belong to the current chunks, re-run the embed stage.")
+        matrix = np.load(self.artifact_path(index, "embeddings.npy"), mmap_mode="r")
+
+        db_path = db_path or os.path.join(BASE_DIR, INDEXES[index]["db"])
+        # the IDs in the database also depend on the embedding model and backend, so a database that was built
+        # with another backend is replaced completely instead of keeping the vectors of unchanged chunks
+        params = {**header["params"], "embedding": embed_header["model"]}
+        rows = {chunk_hash: row for row, chunk_hash in enumerate(embed_header["ids"])}
+        chunks, embeddings = [], {}
+        for record in records:
+            chunk = Document(page_content=record["text"], metadata=record["metadata"])
+            chunks.append(chunk)
+            embeddings[chunk_id(chunk, params)] = matrix[rows[record["id"]]]
+        vector_index = Chroma(persist_directory=db_path)
+        return IncrementalIndexer(vector_index, db_path, params).update(chunks, embeddings)
+
+    def run(self, index: str, stages: Optional[List[str]] = None, db_path: Optional[str] = None):
+        """
+        Runs the given stages of the pipeline in order.
+        :param index: name of the index, see INDEXES
+        :param stages: stages to run, defaults to all stages
+        :param db_path: persist directory of the database, defaults to the database of the index
+        """
+        for stage in stages or STAGES:
+            start = time.perf_counter()
+            result = self.load(index, db_path) if stage == "load" else getattr(self, stage)(index)
+            if isinstance(result, dict) and "version" in result:
+                print(f"[{index}] {stage}: {result['count']} records, version {result['version'][:12]}")
+            print(f"[{index}] {stage} finished in {time.perf_counter() - start:.1f}s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Staged ingestion pipeline for the THA chatbot databases")
+    parser.add_argument("--index", choices=list(INDEXES) + ["all"], default="all", help="index to build")
+    parser.add_argument("--from", dest="from_stage", choices=STAGES, default=STAGES[0],
+                        help="first stage to run, the previous stages are read from their artifacts")
+    parser.add_argument("--to", dest="to_stage", choices=STAGES, default=STAGES[-1], help="last stage to run")
+    parser.add_argument("--data", default=os.path.join(BASE_DIR, "data"), help="data folder")
+    parser.add_argument("--artifacts", default=None, help="artifact folder, defaults to <data>/artifacts")
+    parser.add_argument("--embedding-model", default="intfloat/multilingual-e5-large")
+    parser.add_argument("--embedding-backend", choices=["torch", "onnx"], default="torch",
+                        help="onnx runs the embedding model quantized to int8 in ONNX Runtime")
+    parser.add_argument("--reranking-model", default="cross-encoder/msmarco-MiniLM-L6-en-de-v1")
+    parser.add_argument("--overlap", type=int, default=48, help="overlap between chunks in tokens")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="amount of chunks of full length embedded at once, shorter chunks use bigger batches")
+    parser.add_argument("--processes", type=int, default=1, help="amount of embedding processes")
+    parser.add_argument("--block-size", type=int, default=1024,
+                        help="amount of chunks embedded between two checkpoints")
+    args = parser.parse_args()
+
+    stages = STAGES[STAGES.index(args.from_stage):STAGES.index(args.to_stage) + 1]
+    if not stages:
+        parser.error("--from must not come after --to")
+    pipeline = IngestionPipeline(args.data, args.artifacts, args.embedding_model, args.reranking_model, args.overlap,
+                                 args.batch_size, processes=args.processes, block_size=args.block_size,
+                                 embedding_backend=args.embedding_backend)
+    for index in (INDEXES if args.index == "all" else [args.index]):
+        pipeline.run(index, stages)
+
+
+if __name__ == "__main__":
+    main()
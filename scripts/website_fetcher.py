@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""
+Concurrent website fetcher used by the WebsiteRetriever.
+All requests share one pooled session, the amount of parallel requests per host is limited and responses are
+cached on disk. Cached pages are revalidated with conditional GETs (ETag / Last-Modified), so unchanged pages are
+neither downloaded nor parsed again.
+"""
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status_code: int = 0
+    text: str = ""
+    modified: bool = True  # False if the server confirmed that the cached page is still up to date
+    parsed: Optional[list] = None  # cached extraction result of an unmodified page
+    error: Optional[str] = None
+
+
+class WebsiteFetcher:
+    def __init__(self, cache_dir: Optional[str] = None, max_workers: int = 16, max_per_host: int = 4,
+                 timeout: float = 15.0, retries: int = 3, backoff_factor: float = 0.5, parser_version: str = "1"):
+        """
+        :param cache_dir: folder for the response cache, caching is disabled if None
+        :param max_workers: maximum amount of parallel requests
+        :param max_per_host: maximum amount of parallel requests to the same host
+        :param timeout: timeout of a single request in seconds
+        :param retries: amount of retries on connection errors and 429/5xx responses
+        :param backoff_factor: factor of the exponential backoff between retries
+        :param parser_version: cached extraction results of another parser version are ignored
+        """
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.parser_version = parser_version
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._host_limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_limits[host]
+
+    def _cache_path(self, url: str) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_cache(self, url: str) -> Optional[dict]:
+        path = self._cache_path(url)
+        if not path or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url: str, entry: dict):
+        path = self._cache_path(url)
+        if not path:
+            return
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def store_parsed(self, url: str, parsed: list):
+        """
+        Stores the extraction result of a page, it is returned as long as the page does not change.
+        """
+        entry = self._read_cache(url)
+        if entry is not None:
+            entry["parsed"] = parsed
+            entry["parser_version"] = self.parser_version
+            self._write_cache(url, entry)
+
+    def fetch(self, url: str) -> FetchResult:
+        """
+        Fetches a single page, revalidating the cached version if there is one.
+        """
+        cached = self._read_cache(url)
+        headers = {}
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            with self._host_limit(url):
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            return FetchResult(url, error=str(e))
+
+        if response.status_code == 304 and cached:
+            parsed = cached.get("parsed") if cached.get("parser_version") == self.parser_version else None
+            return FetchResult(url, 200, cached["text"], modified=False, parsed=parsed)
+
+        if response.status_code == 200 and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+            self._write_cache(url, {"url": url, "etag": response.headers.get("ETag"),
+                                    "last_modified": response.headers.get("Last-Modified"),
+                                    "text": response.text, "fetched_at": time.time()})
+        return FetchResult(url, response.status_code, response.text)
+
+    def fetch_all(self, urls: List[str]) -> Dict[str, FetchResult]:
+        """
+        Fetches all pages concurrently.
+        :param urls: list of urls, duplicates are only fetched once
+        :return: dict of url -> FetchResult
+        """
+        start = time.perf_counter()
+        unique_urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(zip(unique_urls, executor.map(self.fetch, unique_urls)))
+        unmodified = sum(1 for result in results.values() if not result.modified)
+        print(f"Fetched {len(results)} pages ({unmodified} unchanged) in {time.perf_counter() - start:.1f}s.")
+        return results
@@ -1,6 +1,6 @@
 import base64
 import re
-import time
+import uuid
 from dataclasses import dataclass
 from io import BytesIO
 from typing import Literal, Optional
@@ -25,6 +25,7 @@ class Message:
     avatar: Optional[str] = None
     image: str = None
     out_of_scope: bool = False
+    source: str = ""  # shown below answers that are taken directly from the question-answer set
 
 
 def initialize_session_state():
@@ -37,6 +38,8 @@ def initialize_session_state():
             st.session_state.messages = []
         if "token_count" not in st.session_state:
             st.session_state.token_count = 0
+        if "session_id" not in st.session_state:  # the chatbot is shared, every session has its own Rasa tracker
+            st.session_state.session_id = str(uuid.uuid4())
         if "conversation" not in st.session_state:
             @st.cache_resource(ttl=3600 * 24, show_spinner=False)  # Reload the model at least every 24 hours
             def load_llm():
@@ -131,6 +134,8 @@ def generate_messages():
                 st.markdown(message.message)
                 if message.image:
                     st.image(message.image, use_column_width=True)
+                if message.source:
+                    st.caption(message.source)
 
 
 def get_base64_image(image_path: str):
@@ -212,40 +217,54 @@ if prompt := st.chat_input("Hey, I'm here to help you. Please type in your quest
         # try:
         # Get the last two messages (= 1 question and answer pair) to use as history for generating new answers
         chat_history = st.session_state.messages[-2:]
-        full_response, relevant_docs, reranked_docs, confidence = st.session_state.conversation.run(prompt,
-                                                                                                    chat_history)
-        image_urls = extract_image_urls(full_response)
-        llm_image = ""
-        for url in image_urls:
-            llm_image = url
-            full_response = full_response.replace(url, "")
-
-        st.session_state.messages.append(
-            Message(origin="human", message=prompt,
-                    avatar=user_avatar_path,
-                    out_of_scope=True if relevant_docs and relevant_docs[0] == "none" else False))
-        st.session_state.messages.append(
-            Message(origin="ai", message=full_response,
-                    avatar=ai_avatar_path, image=llm_image,
-                    out_of_scope=True if relevant_docs and relevant_docs[0] == "none" else False,
-                    context=reranked_docs, confidence=confidence)
-        )
-
-        print(confidence)
 
         with st.chat_message("ai", avatar=ai_avatar_path):
+            # render the tokens as they arrive, the last element of the stream contains the metadata
             typing_placeholder = st.empty()
-            typing_accumulator = ""
-            for char in full_response:
-                typing_accumulator += char
-                typing_placeholder.markdown(typing_accumulator)
-                time.sleep(0.003)
+            full_response, metadata = "", None
+            for chunk in st.session_state.conversation.stream(prompt, chat_history,
+                                                                 st.session_state.session_id):
+                if not isinstance(chunk, str):
+                    metadata = chunk
+                    continue
+                full_response += chunk
+                typing_placeholder.markdown(full_response)
+
+            relevant_docs, reranked_docs, confidence = (metadata.relevant_docs, metadata.reranked_docs,
+                                                        metadata.confidence)
+            source = ""
+            if metadata.direct_answer is not None:
+                direct_answer = metadata.direct_answer
+                source = (f"Antwort aus den häufig gestellten Fragen der THA. Quelle: {direct_answer.source}"
+                          if direct_answer.language == "de" else
+                          f"Answer from the frequently asked questions of the THA. Source: {direct_answer.source}")
+            image_urls = extract_image_urls(full_response)
+            llm_image = ""
+            for url in image_urls:
+                llm_image = url
+                full_response = full_response.replace(url, "")
+            typing_placeholder.markdown(full_response)
+
+            st.session_state.messages.append(
+                Message(origin="human", message=prompt,
+                        avatar=user_avatar_path,
+                        out_of_scope=True if relevant_docs and relevant_docs[0] == "none" else False))
+            st.session_state.messages.append(
+                Message(origin="ai", message=full_response,
+                        avatar=ai_avatar_path, image=llm_image,
+                        out_of_scope=True if relevant_docs and relevant_docs[0] == "none" else False,
+                        context=reranked_docs, confidence=confidence, source=source)
+            )
+
+            print(confidence)
 
             if llm_image != "":
                 st.image(llm_image, use_column_width=True)
+            if source:
+                st.caption(source)
 
-            detected_lang = detect_language(typing_accumulator)
-            audio_fp = text_to_speech(typing_accumulator, detected_lang)
+            detected_lang = detect_language(full_response)
+            audio_fp = text_to_speech(full_response, detected_lang)
 
             if relevant_docs and relevant_docs[0] == "none":
                 if detected_lang == "en":